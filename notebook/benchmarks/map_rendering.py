@@ -0,0 +1,69 @@
+"""
+Compares the HTML size and rendering time of the connections map with one folium object per marker against the
+GeoJSON/canvas renderer, on a synthetic network the size of Vienna's, as well as revisiting a cached map.
+
+Run from the notebook directory:
+    python -m benchmarks.map_rendering --stops 4400 --connections 7000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from src.components import presentation as present
+from src.components.types import ConnectionTable, StopTable
+
+
+def generate_network(stop_count: int, connection_count: int, seed: int = 0) -> ConnectionTable:
+    """
+    Scatters stops over the area of Vienna and connects random pairs of them by bus, tram or subway.
+    """
+
+    rng = np.random.default_rng(seed)
+    lats, lons = 48.12 + rng.random(stop_count) * 0.2, 16.18 + rng.random(stop_count) * 0.38
+    stops = StopTable.from_rows(
+        (f"at:49:{i}:0:1", f"Stop {i}", lat, lon, False, None, None, None)
+        for i, (lat, lon) in enumerate(zip(lats, lons))
+    )
+
+    # Pair up stops that are close to each other along the diagonal, such that lines stay short like real connections
+    order = np.argsort(lats + lons)
+    positions = rng.integers(0, stop_count - 10, connection_count)
+    from_rows, to_rows = order[positions], order[positions + rng.integers(1, 10, connection_count)]
+    modes = rng.choice(["BUS_CONNECTS_TO", "TRAM_CONNECTS_TO", "SUBWAY_CONNECTS_TO"], connection_count, p=[0.6, 0.3, 0.1])
+    return ConnectionTable.from_triples(zip(stops.ids[from_rows], modes, stops.ids[to_rows]), stops)
+
+
+def render(connections: ConnectionTable, renderer: str, cache: present.MapHtmlCache | None = None) -> tuple[str, float]:
+    started_at = time.perf_counter()
+    transport_map = present.TransportMap(lat=48.2102331, lon=16.3796424, zoom=12, renderer=renderer, cache=cache,
+                                         visible_layers=present.VisibleLayers.STOPS | present.VisibleLayers.CONNECTIONS)
+    transport_map.add_transit_nodes(connections.stops)
+    transport_map.add_transit_connections(connections)
+    html = transport_map.as_html()
+    return html, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stops", type=int, default=4400)
+    parser.add_argument("--connections", type=int, default=7000)
+    args = parser.parse_args()
+
+    connections = generate_network(args.stops, args.connections)
+    print(f"Generated {len(connections.stops)} stops and {len(connections)} connections")
+
+    for renderer in ["markers", "geojson"]:
+        html, seconds = render(connections, renderer)
+        print(f"{renderer:>8}: {len(html.encode()) / 1_000_000:6.2f} MB of HTML in {seconds:.2f} s")
+
+    # Revisiting a map with the same data is served from the cache of rendered maps
+    cache = present.MapHtmlCache()
+    render(connections, "geojson", cache)
+    _, seconds = render(connections, "geojson", cache)
+    print(f"{'cached':>8}: revisited in {seconds:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
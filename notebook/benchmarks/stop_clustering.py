@@ -0,0 +1,60 @@
+"""
+Compares the serial and the partitioned (parallel) stop clustering on a synthetic multi-feed stop set.
+
+Run from the notebook directory:
+    python -m benchmarks.stop_clustering --stations 50000 --tile-size 20000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from src.components import geo_spatial as geo
+from src.components.types import Stop
+
+
+def generate_stops(station_count: int, seed: int = 0) -> list[Stop]:
+    """
+    Scatters stations over a region of roughly 400 x 300 km around Vienna, where each station has up to a dozen
+    platforms/exits spread over a few hundred metres.
+    """
+
+    rng = np.random.default_rng(seed)
+    stops = []
+    for station in range(station_count):
+        lat, lon = 46.5 + rng.random() * 2.7, 13.0 + rng.random() * 5.5
+        for platform in range(rng.integers(1, 13)):
+            stops.append(Stop(f"at:{station}:{platform}", lat + rng.normal(0, 0.0012), lon + rng.normal(0, 0.0018), ""))
+    return stops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stations", type=int, default=50_000)
+    parser.add_argument("--tile-size", type=float, default=20_000, help="edge length of a tile in metres")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cluster-distance", type=int, default=200)
+    parser.add_argument("--max-diameter", type=int, default=400)
+    args = parser.parse_args()
+
+    stops = generate_stops(args.stations)
+    print(f"Generated {len(stops)} stops of {args.stations} stations")
+
+    started_at = time.perf_counter()
+    serial = geo.find_stop_clusters(stops, args.cluster_distance, args.max_diameter)
+    serial_seconds = time.perf_counter() - started_at
+    print(f"Serial:      {len(serial)} clusters in {serial_seconds:.2f} s")
+
+    started_at = time.perf_counter()
+    partitioned = geo.find_stop_clusters(stops, args.cluster_distance, args.max_diameter,
+                                         tile_size_metres=args.tile_size, max_workers=args.workers)
+    partitioned_seconds = time.perf_counter() - started_at
+    print(f"Partitioned: {len(partitioned)} clusters in {partitioned_seconds:.2f} s "
+          f"({serial_seconds / partitioned_seconds:.1f}x)")
+
+    print("✅ Identical clusters" if serial == partitioned else "❌ WARNING: The clusters differ!")
+
+
+if __name__ == "__main__":
+    main()
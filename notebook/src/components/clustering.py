@@ -0,0 +1,169 @@
+from typing import Iterable
+
+import numpy as np
+
+
+class UnionFind:
+    """
+    Disjoint-set forest over the integers 0..size-1, backed by numpy arrays. Uses union by size and path halving,
+    so any sequence of unions and finds runs in practically linear time.
+    """
+
+    def __init__(self, size: int):
+        self.parent: np.ndarray = np.arange(size, dtype=np.int64)
+        self.size: np.ndarray = np.ones(size, dtype=np.int64)
+
+    def find(self, element: int) -> int:
+        parent = self.parent
+        while parent[element] != element:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
+        return int(element)
+
+    def union(self, left: int, right: int) -> int:
+        left, right = self.find(left), self.find(right)
+        if left == right:
+            return left
+        if self.size[left] < self.size[right]:
+            left, right = right, left
+        self.parent[right] = left
+        self.size[left] += self.size[right]
+        return left
+
+    def union_all(self, elements: Iterable[int]) -> None:
+        first = None
+        for element in elements:
+            if first is None:
+                first = element
+            else:
+                first = self.union(first, element)
+
+    def labels(self) -> np.ndarray:
+        """
+        Returns the representative of every element, after fully compressing all paths.
+        """
+
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent.copy()
+            parent[:] = grandparent
+
+
+def station_prefix(stop_id: str) -> str | None:
+    """
+    Returns the station part of a stop ID, i.e. its first four colon-delimited components, or None if the ID
+    does not follow the hierarchical structure.
+    """
+
+    parts = stop_id.split(":")
+    return ":".join(parts[:4]) if len(parts) >= 4 else None
+
+
+def merge_related_clusters(stop_ids: list[str], cluster_roots: list[str | None]) -> dict[str, str]:
+    """
+    Merges the existing stop clusters with all stops that belong to the same station according to their ID, such
+    that every resulting cluster is flat (all members point to one root) and no stop is in two clusters.
+
+    Args:
+        stop_ids: the IDs of all stops
+        cluster_roots: for each stop in stop_ids, the ID of the root of its current cluster or None
+
+    Returns:
+        dict: the ID of the new cluster root for every stop that is part of a cluster (with at least two members),
+        where roots map to themselves. If clusters are merged, the root of the largest one is kept.
+    """
+
+    index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+    union_find = UnionFind(len(stop_ids))
+
+    # Existing clusters
+    root_indices = np.array([index.get(root, -1) if root is not None else -1 for root in cluster_roots], dtype=np.int64)
+    for member, root in enumerate(root_indices):
+        if root >= 0:
+            union_find.union(member, root)
+
+    # Stops of the same station
+    stations: dict[str, list[int]] = {}
+    for i, stop_id in enumerate(stop_ids):
+        prefix = station_prefix(stop_id)
+        if prefix is not None:
+            stations.setdefault(prefix, []).append(i)
+    for members in stations.values():
+        union_find.union_all(members)
+
+    labels = union_find.labels()
+    group_sizes = np.bincount(labels, minlength=len(stop_ids))
+
+    # Pick the root of the largest existing cluster in each group (ties by ID), or the smallest ID otherwise
+    existing_cluster_sizes = np.bincount(root_indices[root_indices >= 0], minlength=len(stop_ids))
+    new_roots: dict[int, int] = {}
+    for i in np.flatnonzero(group_sizes[labels] > 1):
+        group = labels[i]
+        current = new_roots.get(group)
+        if current is None or (existing_cluster_sizes[i], stop_ids[current]) > (existing_cluster_sizes[current], stop_ids[i]):
+            new_roots[group] = i
+
+    return {stop_ids[i]: stop_ids[new_roots[labels[i]]] for i in np.flatnonzero(group_sizes[labels] > 1)}
+
+
+class ClusterEdits:
+    """
+    The minimal changes to go from one assignment of stops to cluster roots to another.
+    """
+
+    def __init__(self, removed: list[tuple[str, str]], added: list[tuple[str, str]], promoted: list[str], demoted: list[str]):
+        self.removed: list[tuple[str, str]] = removed  # (stop, old root) IN_CLUSTER relationships to delete
+        self.added: list[tuple[str, str]] = added  # (stop, new root) IN_CLUSTER relationships to create
+        self.promoted: list[str] = promoted  # stops that become cluster roots
+        self.demoted: list[str] = demoted  # cluster roots that are no root anymore
+
+    def __len__(self):
+        return len(self.removed) + len(self.added) + len(self.promoted) + len(self.demoted)
+
+
+def diff_clusters(current_roots: dict[str, str | None], clusters: list[list[str]], reclustered_ids: set[str]) -> ClusterEdits:
+    """
+    Computes the edits that replace the clusters of all stops in reclustered_ids with the given clusters.
+
+    Each new cluster keeps the root of the old cluster it overlaps most with if that root is still a member, so
+    unchanged clusters cause no edits at all. Stops outside reclustered_ids that belong to the cluster of a root in
+    reclustered_ids (e.g. merged in by station) follow their root to its new cluster, or are unclustered if the
+    root is no longer clustered.
+
+    Args:
+        current_roots: the current cluster root (or None) of every stop in reclustered_ids and of all stops that
+            share a cluster root with them
+        clusters: the new clusters of the stops in reclustered_ids
+        reclustered_ids: the IDs of all stops whose cluster was recomputed
+    """
+
+    new_roots: dict[str, str | None] = {}
+    for cluster in clusters:
+        members = set(cluster)
+        overlaps: dict[str, int] = {}
+        for stop_id in cluster:
+            root = current_roots.get(stop_id)
+            if root is not None and root in members:
+                overlaps[root] = overlaps.get(root, 0) + 1
+        root = max(overlaps, key=lambda candidate: (overlaps[candidate], candidate)) if overlaps else cluster[0]
+        new_roots.update((stop_id, root) for stop_id in cluster)
+
+    # Stops outside of the reclustered neighbourhoods stay with their root, wherever that root ends up
+    for stop_id, root in current_roots.items():
+        if stop_id not in reclustered_ids and root is not None:
+            new_roots[stop_id] = new_roots.get(root) if root in reclustered_ids else root
+
+    removed, added = [], []
+    for stop_id in set(current_roots) | set(new_roots):
+        old_root, new_root = current_roots.get(stop_id), new_roots.get(stop_id)
+        if old_root != new_root:
+            if old_root is not None:
+                removed.append((stop_id, old_root))
+            if new_root is not None:
+                added.append((stop_id, new_root))
+
+    old_root_ids = {root for root in current_roots.values() if root is not None}
+    new_root_ids = {root for root in new_roots.values() if root is not None}
+    return ClusterEdits(removed, added, sorted(new_root_ids - old_root_ids), sorted(old_root_ids - new_root_ids))
@@ -1,91 +1,207 @@
+import concurrent.futures
+
 import geopandas as gpd
 import numpy as np
-from pyproj import Transformer
-from shapely.ops import transform
-from shapely.geometry import MultiPoint, Point
-from shapely.geometry.base import BaseGeometry
-from shapely.wkt import loads
+import pandas as pd
+import shapely
+from shapely.geometry import MultiPoint
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import pdist
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import KDTree
 
+from src.components import geometry_store
 from src.components.graph import SubDistrict, Stop
+from src.components.types import StopTable
 
 
 def find_neighbouring_subdistricts(subdistricts: list[SubDistrict], buffer_metres: int = 20, crs="EPSG:4326") -> dict[str, list[str]]:
+    """
+    Finds all pairs of subdistricts whose polygons are at most buffer_metres apart. Rather than testing every
+    polygon against every other one, the buffered polygons are matched against an STRtree of the projected
+    polygons in a single bulk query.
+
+    Returns:
+        dict[str, list[str]]: the IDs of all neighbouring subdistricts for every subdistrict ID
+    """
+
     if buffer_metres < 0:
         raise ValueError("The buffer distance must be positive!")
 
-    district_polygons: dict[str, BaseGeometry] = {dist.id: loads(dist.shape) for dist in subdistricts}
-
-    # Project all polygons to a CRS with distances in metres
-    target_crs = "EPSG:3857"  # Web Mercator, units in meters
-    transformer = Transformer.from_crs(crs, target_crs, always_xy=True)
-    projected_polygons = {
-        dist_id: transform(transformer.transform, poly)
-        for dist_id, poly in district_polygons.items()
-    }
+    geometries = geometry_store.geometries_of(subdistricts, crs)
+    district_ids = geometries.ids
 
-    # Buffer all polygons by the given number of metres
-    buffered_polygons = {
-        dist_id: poly.buffer(buffer_metres)
-        for dist_id, poly in projected_polygons.items()
-    }
+    # Buffer all (metric) polygons by the given number of metres and find all intersections with the original polygons
+    left_indices, right_indices = geometries.tree.query(geometries.buffered(buffer_metres), predicate="intersects")
 
-    # Find intersections
-    neighbours = {dist_id: [] for dist_id in district_polygons.keys()}
-    for id_left, buffered_poly in buffered_polygons.items():
-        for id_right, original_poly in projected_polygons.items():
-            if id_left != id_right and buffered_poly.intersects(original_poly):
-                neighbours[id_left].append(id_right)
+    neighbours = {dist_id: [] for dist_id in district_ids}
+    for left, right in sorted(zip(left_indices.tolist(), right_indices.tolist())):
+        if left != right:
+            neighbours[district_ids[left]].append(district_ids[right])
 
     return neighbours
 
 
-def match_stops_to_subdistricts(stops: list[Stop], subdistricts: list[SubDistrict], buffer_metres: int = 0, crs="EPSG:4326"):
+def match_stops_to_subdistricts(stops: list[Stop] | StopTable, subdistricts: list[SubDistrict], buffer_metres: int = 0, crs="EPSG:4326"):
     """
     Match each Stops (points) to all SubDistricts (polygons) that either surround the stop or are within buffer_metres
     of the point. The function drops stops that have no matching subdistricts.
 
     Args:
-        stops (list[Stop]): list of Stop objects
+        stops (list[Stop] | StopTable): list or table of stops
         subdistricts (list[SubDistrict]): list of SubDistrict objects
         buffer_metres (int): The tolerance distance that a stop might be outside a district and still be counted as within it
         crs (str): coordinate reference system (default EPSG:4326)
 
     Returns:
-        GeoDataFrame: each stop with its matched subdistrict ID.
+        list: (stop_id, [list of subdistrict IDs]) for each stop.
         Stops that don't correspond to any subdistrict are dropped.
     """
 
-    if buffer_metres < 0:
+    return match_stops_to_subdistricts_within(stops, subdistricts, [buffer_metres], crs)[buffer_metres]
+
+
+def match_stops_to_subdistricts_within(stops: list[Stop] | StopTable, subdistricts: list[SubDistrict], radii_metres: list[int],
+                                       crs="EPSG:4326") -> dict[int, list[tuple[str, list[str]]]]:
+    """
+    Multi-radius version of match_stops_to_subdistricts(): Matches the stops to the subdistricts in a single spatial
+    join at the largest radius, then assigns each match to every radius that is at least the distance between the
+    stop and the subdistrict.
+
+    Args:
+        stops (list[Stop] | StopTable): list or table of stops
+        subdistricts (list[SubDistrict]): list of SubDistrict objects
+        radii_metres (list[int]): The tolerance distances that a stop might be outside a district and still be matched
+        crs (str): coordinate reference system (default EPSG:4326)
+
+    Returns:
+        dict: for each radius, a list of (stop_id, [list of subdistrict IDs]), without stops that match no subdistrict
+    """
+
+    if any(radius < 0 for radius in radii_metres):
         raise ValueError("The buffer distance must be positive!")
 
-    subdistricts_geoframe = gpd.GeoDataFrame(
-        {"subdistrict_id": [sd.id for sd in subdistricts]},
-        geometry=[loads(sd.shape) for sd in subdistricts],
-        crs=crs
-    ).to_crs("EPSG:3857") # convert to 'Web Mercator' projection where coordinates are in metres
+    geometries = geometry_store.geometries_of(subdistricts, crs)
+    stop_ids, stop_lats, stop_lons = _stop_columns(stops)
+    stop_points = geometry_store.project_points(stop_lons, stop_lats, crs)
+
+    # Spatial join: Match each stop with all subdistricts that either surround the stop or are within the largest radius
+    stop_indices, district_indices = geometries.tree.query(stop_points, predicate="dwithin", distance=max(radii_metres))
+    matches = pd.DataFrame({
+        "stop_id": stop_ids[stop_indices],
+        "subdistrict_id": np.array(geometries.ids, dtype=object)[district_indices],
+        "distance": shapely.distance(stop_points[stop_indices], geometries.metric_geometries[district_indices]),
+    })
+
+    # Group the matches within each radius into (stop_id, [list of subdistricts])
+    return {
+        radius: list(matches[matches["distance"] <= radius]
+                     .groupby("stop_id", sort=False)["subdistrict_id"].agg(list)
+                     .items())
+        for radius in radii_metres
+    }
 
-    stop_geoframe = gpd.GeoDataFrame(
-        {"stop_id": [s.id for s in stops]},
-        geometry=[Point(s.lon, s.lat) for s in stops],  # Point(x=lon, y=lat)
-        crs=crs
-    ).to_crs("EPSG:3857") # convert to 'Web Mercator' projection where coordinates are in metres
 
-    # Spatial join: Match each stop with all subdistricts that either surround the stop or are within buffer_metres.
-    # Beware: inner join -> drops points that are within no district
-    matches = gpd.sjoin(stop_geoframe, subdistricts_geoframe, how="inner", predicate="dwithin", distance=buffer_metres)
+def find_close_stop_pairs(stops: list[Stop] | StopTable, radius_metres: float = 800, crs="EPSG:4326") -> list[tuple[str, str, float]]:
+    """
+    Finds all pairs of stops whose display positions (the midpoint of the cluster for cluster roots) are less than
+    radius_metres apart. Instead of comparing every pair of stops, the stops are put into a KD-tree in a metric
+    projection, which only visits the stops in the vicinity of each stop.
+
+    Args:
+        stops (list[Stop] | StopTable): list or table of stops
+        radius_metres (float): The maximum distance between two stops to be considered close to each other
+        crs (str): coordinate reference system of the stop coordinates (default EPSG:4326)
+
+    Returns:
+        list[tuple[str, str, float]]: (stop_id, other_stop_id, distance in metres) for every pair of close stops,
+        each unordered pair is only contained once.
+    """
+
+    if radius_metres < 0:
+        raise ValueError("The radius must be positive!")
+    if len(stops) < 2:
+        return []
+
+    stop_ids, stop_lats, stop_lons = _stop_columns(stops, display_positions=True)
+    stop_geoseries = gpd.GeoSeries(gpd.points_from_xy(stop_lons, stop_lats), crs=crs)  # Point(x=lon, y=lat)
+    # Use the local UTM zone, since Web Mercator heavily distorts distances at Vienna's latitude
+    projected_stops = stop_geoseries.to_crs(stop_geoseries.estimate_utm_crs())
+    coords = np.column_stack([projected_stops.x.to_numpy(), projected_stops.y.to_numpy()])
+
+    neighbour_indices, neighbour_distances = KDTree(coords).query_radius(coords, r=radius_metres, return_distance=True)
+
+    stop_pairs = []
+    for left, (indices, distances) in enumerate(zip(neighbour_indices, neighbour_distances)):
+        # Each pair is found from both sides, keep only one direction (and drop the stop itself)
+        keep = (indices > left) & (distances < radius_metres)
+        stop_pairs.extend((stop_ids[left], stop_ids[right], float(distance))
+                          for right, distance in zip(indices[keep], distances[keep]))
+
+    return stop_pairs
+
+
+def compute_cluster_hulls(stops: list[Stop] | StopTable) -> dict[str, str]:
+    """
+    Computes the (slightly buffered) convex hull of the members of every cluster.
+
+    Returns:
+        dict: the outline of each hull as encoded polyline of (lat, lon) coordinates, by the ID of the cluster root
+    """
+
+    if not isinstance(stops, StopTable):
+        stops = StopTable.from_stops(stops)
+
+    outlines = geometry_store.cluster_outlines(stops, use_precomputed=False)
+    return {stops.ids[row]: geometry_store.encode_polyline(outline) for row, outline in outlines.items()}
+
+
+def district_centres(subdistricts: list[SubDistrict], crs="EPSG:4326") -> dict[str, tuple[float, float]]:
+    """
+    Returns the (lat, lon) center of the bounding box of every district, i.e. of all subdistricts with the same
+    district number, by district number.
+    """
+
+    geometries = geometry_store.geometries_of(subdistricts, crs)
+    bounds_per_district: dict[str, list[np.ndarray]] = {}
+    for district, bounds in zip(subdistricts, shapely.bounds(geometries.geometries)):
+        bounds_per_district.setdefault(district.id.split("-")[0], []).append(bounds)
+
+    centres = {}
+    for district_num, bounds in bounds_per_district.items():
+        bounds = np.array(bounds)
+        min_lon, min_lat = bounds[:, 0].min(), bounds[:, 1].min()
+        max_lon, max_lat = bounds[:, 2].max(), bounds[:, 3].max()
+        centres[district_num] = (float(min_lat + max_lat) / 2, float(min_lon + max_lon) / 2)
+    return centres
+
 
-    # Group into (stop_id, [list of subdistricts])
-    grouped = matches.groupby("stop_id", sort=False)["subdistrict_id"].agg(list)
-    return grouped.items()
+def find_stop_clusters(stops: list[Stop] | StopTable, cluster_distance_metres: int = 50, max_diameter_meters: int = 250, *,
+                       tile_size_metres: float | None = None, max_workers: int | None = None) -> list[list[str]]:
+    """
+    Clusters stops that are within cluster_distance_metres of each other, splitting clusters that are wider than
+    max_diameter_meters.
 
+    If tile_size_metres is given, the initial clustering is partitioned into square tiles of that size which are
+    clustered in parallel by up to max_workers processes (see _cluster_stops_partitioned()), and oversized clusters
+    are split in parallel as well. The result is the same as without partitioning, which is only worth it for stop
+    sets far larger than a single city.
+    """
 
-def find_stop_clusters(stops: list[Stop], cluster_distance_metres: int = 50, max_diameter_meters: int = 250) -> list[list[str]]:
     # Step 1: Initial clustering
-    stops_geoframe = _cluster_stops(stops, cluster_distance_metres)
+    if tile_size_metres is None:
+        stops_geoframe = _cluster_stops(stops, cluster_distance_metres)
+
+        # Step 2: Enforce diameter constraint
+        stops_geoframe = _enforce_diameter_constraint(stops_geoframe, cluster_distance_metres, max_diameter_meters)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            stops_geoframe = _cluster_stops_partitioned(stops, cluster_distance_metres, tile_size_metres, executor)
 
-    # Step 2: Enforce diameter constraint
-    stops_geoframe = _enforce_diameter_constraint(stops_geoframe, cluster_distance_metres, max_diameter_meters)
+            # Step 2: Enforce diameter constraint
+            stops_geoframe = _enforce_diameter_constraint(stops_geoframe, cluster_distance_metres, max_diameter_meters,
+                                                          executor)
 
     # Step 3: Filter invalid clusters
     stops_geoframe = _filter_invalid_clusters(stops_geoframe)
@@ -94,61 +210,248 @@ def find_stop_clusters(stops: list[Stop], cluster_distance_metres: int = 50, max
     clusters = stops_geoframe.groupby("cluster")["stop_id"].agg(list).tolist()
     return clusters
 
-def _cluster_stops(stops: list[Stop], tolerance_metres: int, crs="EPSG:4326"):
-    if tolerance_metres < 0:
-        raise ValueError("The cluster tolerance must be positive!")
+def find_stop_clusters_incremental(stops: list[Stop] | StopTable, previous_stops: list[Stop] | StopTable, cluster_distance_metres: int = 50,
+                                   max_diameter_meters: int = 250) -> tuple[list[list[str]], set[str]]:
+    """
+    Incremental version of find_stop_clusters(): Compares the stops with the stops of the previous clustering and
+    only reclusters the neighbourhoods of stops that were added, moved or removed since.
 
+    A cluster can only ever contain stops of one group of stops that are chained together within
+    cluster_distance_metres of each other. Hence, reclustering all such groups that contain a stop within
+    cluster_distance_metres of an old or new position of a changed stop gives the same result as clustering
+    all stops from scratch, while all other clusters stay untouched.
+
+    Returns:
+        A tuple of the clusters within the reclustered neighbourhoods and the IDs of all stops whose cluster may
+        have changed (including removed stops). Stops in this set that are in none of the clusters are unclustered.
+    """
+
+    if isinstance(stops, StopTable):
+        stops = stops.to_stops()
+    if isinstance(previous_stops, StopTable):
+        previous_stops = previous_stops.to_stops()
+
+    previous_positions = {s.id: (s.lat, s.lon) for s in previous_stops}
+    current_ids = {s.id for s in stops}
+    changed = [s for s in stops if previous_positions.get(s.id) != (s.lat, s.lon)]  # added or moved
+    changed_ids = {s.id for s in changed}
+    # Removed stops and the old positions of moved stops
+    vacated = [s for s in previous_stops if s.id not in current_ids or s.id in changed_ids]
+    if not changed and not vacated:
+        return [], set()
+
+    stops_geoframe = _cluster_stops(stops, cluster_distance_metres)
+    coords = np.column_stack([stops_geoframe.geometry.x.to_numpy(), stops_geoframe.geometry.y.to_numpy()])
+    _, changed_coords = _project_stops(changed + vacated)
+
+    # Find all chained groups of stops within reach of a changed position
+    labels = stops_geoframe["cluster"].to_numpy()
+    is_reached = np.zeros(len(stops), dtype=bool)
+    is_reached[np.concatenate(KDTree(coords).query_radius(changed_coords, r=cluster_distance_metres))] = True
+    is_affected = np.isin(labels, labels[is_reached & (labels != -1)])
+
+    stops_geoframe = _enforce_diameter_constraint(stops_geoframe[is_affected].copy(), cluster_distance_metres,
+                                                  max_diameter_meters)
+    stops_geoframe = _filter_invalid_clusters(stops_geoframe)
+    clusters = stops_geoframe.groupby("cluster")["stop_id"].agg(list).tolist()
+
+    reclustered_ids = set(np.array([s.id for s in stops], dtype=object)[is_affected | is_reached])
+    return clusters, reclustered_ids | changed_ids | {s.id for s in vacated}
+
+def _stop_columns(stops: list[Stop] | StopTable, display_positions = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the IDs, latitudes and longitudes of the stops as arrays, optionally the display position (the midpoint
+    of the cluster for cluster roots) instead of the stop's own position.
+    """
+
+    if isinstance(stops, StopTable):
+        if display_positions:
+            return stops.ids, stops.display_lat(), stops.display_lon()
+        return stops.ids, stops.lat, stops.lon
+
+    stop_ids = np.array([s.id for s in stops], dtype=object)
+    if display_positions:
+        return stop_ids, np.array([s.display_lat() for s in stops], dtype=float), np.array([s.display_lon() for s in stops], dtype=float)
+    return stop_ids, np.array([s.lat for s in stops], dtype=float), np.array([s.lon for s in stops], dtype=float)
+
+def _project_stops(stops: list[Stop] | StopTable, crs="EPSG:4326") -> tuple[gpd.GeoDataFrame, np.ndarray]:
+    stop_ids, stop_lats, stop_lons = _stop_columns(stops)
     stop_geoframe = gpd.GeoDataFrame(
-        {"stop_id": [s.id for s in stops]},
-        geometry=[Point(s.lon, s.lat) for s in stops],  # Point(x=lon, y=lat)
+        {"stop_id": stop_ids},
+        geometry=gpd.points_from_xy(stop_lons, stop_lats),  # Point(x=lon, y=lat)
         crs=crs
     ).to_crs("EPSG:3857") # convert to 'Web Mercator' projection where coordinates are in metres
 
-    coords = np.array([(geom.x, geom.y) for geom in stop_geoframe.geometry])
+    coords = np.column_stack([stop_geoframe.geometry.x.to_numpy(), stop_geoframe.geometry.y.to_numpy()])
+    return stop_geoframe, coords
+
+def _cluster_stops(stops: list[Stop] | StopTable, tolerance_metres: int, crs="EPSG:4326"):
+    if tolerance_metres < 0:
+        raise ValueError("The cluster tolerance must be positive!")
+
+    stop_geoframe, coords = _project_stops(stops, crs)
     cluster_assignment = DBSCAN(eps=tolerance_metres, min_samples=2, algorithm="ball_tree", metric="euclidean").fit(coords)
 
     # Assign cluster labels back to the GeoDataFrame
     stop_geoframe["cluster"] = cluster_assignment.labels_
     return stop_geoframe
 
-def _enforce_diameter_constraint(gdf_stops: gpd.GeoDataFrame, cluster_distance: int, max_diameter_meters: int) -> gpd.GeoDataFrame:
+def _cluster_stops_partitioned(stops: list[Stop] | StopTable, tolerance_metres: int, tile_size_metres: float,
+                               executor: concurrent.futures.Executor, crs="EPSG:4326"):
+    """
+    Partitioned version of _cluster_stops(): Splits the projected stops into a grid of square tiles and clusters
+    each tile together with a halo of all stops within tolerance_metres around it on the given (process) executor. Since every
+    pair of stops within tolerance_metres is seen by at least one tile, merging all tile clusters that share a stop
+    yields exactly the clusters of clustering all stops at once. These are then numbered like DBSCAN would.
+    """
+
+    if tolerance_metres < 0:
+        raise ValueError("The cluster tolerance must be positive!")
+    if tile_size_metres <= 0:
+        raise ValueError("The tile size must be positive!")
+
+    stop_geoframe, coords = _project_stops(stops, crs)
+    origin = coords.min(axis=0)
+    tiles = np.floor((coords - origin) / tile_size_metres).astype(np.int64)
+
+    # Group the stops by tile once, the halo of a tile can only contain stops of the surrounding tiles
+    order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+    tile_keys, tile_starts = np.unique(tiles[order], axis=0, return_index=True)
+    stops_per_tile = {tuple(key): indices for key, indices in zip(tile_keys.tolist(), np.split(order, tile_starts[1:]))}
+    rings = int(np.ceil(tolerance_metres / tile_size_metres))
+
+    tile_members = []
+    for tile in tile_keys:
+        candidates = np.concatenate([
+            stops_per_tile.get((tile[0] + dx, tile[1] + dy), np.empty(0, dtype=np.int64))
+            for dx in range(-rings, rings + 1) for dy in range(-rings, rings + 1)
+        ])
+        lower = origin + tile * tile_size_metres - tolerance_metres
+        upper = lower + tile_size_metres + 2 * tolerance_metres
+        in_halo = np.all((coords[candidates] >= lower) & (coords[candidates] <= upper), axis=1)
+        tile_members.append(np.sort(candidates[in_halo]))
+
+    tile_labels = list(executor.map(_cluster_tile, [coords[members] for members in tile_members],
+                                    [tolerance_metres] * len(tile_members)))
+
+    # Reconcile: link every clustered stop to the first stop of its tile cluster, then merge across tiles
+    left, right = [], []
+    for members, labels in zip(tile_members, tile_labels):
+        clustered = labels != -1
+        first_member = np.full(labels.max(initial=-1) + 1, len(coords), dtype=np.int64)
+        np.minimum.at(first_member, labels[clustered], members[clustered])
+        left.append(members[clustered])
+        right.append(first_member[labels[clustered]])
+    left, right = np.concatenate(left), np.concatenate(right)
+
+    adjacency = coo_matrix((np.ones(len(left), dtype=np.int8), (left, right)), shape=(len(coords), len(coords)))
+    _, components = connected_components(adjacency, directed=False)
+
+    # Number the clusters by their first stop (as DBSCAN does), stops that are in no tile cluster are noise
+    is_clustered = np.zeros(len(coords), dtype=bool)
+    is_clustered[left] = True
+    first_stop = np.full(len(coords), len(coords), dtype=np.int64)
+    np.minimum.at(first_stop, components[is_clustered], np.flatnonzero(is_clustered))
+    cluster_numbers = np.argsort(np.argsort(first_stop))
+
+    stop_geoframe["cluster"] = np.where(is_clustered, cluster_numbers[components], -1)
+    return stop_geoframe
+
+def _cluster_tile(coords: np.ndarray, tolerance_metres: int) -> np.ndarray:
+    if len(coords) < 2:
+        return np.full(len(coords), -1, dtype=np.int64)
+    return DBSCAN(eps=tolerance_metres, min_samples=2, algorithm="ball_tree", metric="euclidean").fit(coords).labels_
+
+def _enforce_diameter_constraint(gdf_stops: gpd.GeoDataFrame, cluster_distance: int, max_diameter_meters: int,
+                                 executor: concurrent.futures.Executor | None = None) -> gpd.GeoDataFrame:
+    """
+    Splits every cluster whose diameter exceeds max_diameter_meters by clustering its stops again with a
+    stepwise smaller distance, until all resulting sub-clusters are small enough. If an executor is given, the
+    clusters are split in parallel.
+    """
+
+    coords = np.column_stack([gdf_stops.geometry.x.to_numpy(), gdf_stops.geometry.y.to_numpy()])
+    labels = gdf_stops["cluster"].to_numpy().copy()
+
     # Drop noise clusters and then group stops by cluster
-    clusters = gdf_stops[gdf_stops["cluster"] != -1].groupby("cluster")
+    clustered = np.flatnonzero(labels != -1)
+    clustered = clustered[np.argsort(labels[clustered], kind="stable")]
+    _, cluster_starts = np.unique(labels[clustered], return_index=True)
+    cluster_members = np.split(clustered, cluster_starts[1:])
+
+    cluster_points = [coords[members] for members in cluster_members]
+    distances, diameters = [cluster_distance] * len(cluster_points), [max_diameter_meters] * len(cluster_points)
+    if executor is None:
+        split_labels = map(_split_cluster, cluster_points, distances, diameters)
+    else:
+        split_labels = executor.map(_split_cluster, cluster_points, distances, diameters, chunksize=256)
+
+    # Give each sub-cluster a fresh label, such that it can never collide with the label of another cluster
+    next_label = labels.max(initial=-1) + 1
+    for members, sub_labels in zip(cluster_members, split_labels):
+        if sub_labels is not None:
+            labels[members] = np.where(sub_labels != -1, next_label + sub_labels, -1)
+            next_label += sub_labels.max(initial=-1) + 1
+
+    gdf_stops["cluster"] = labels
+    return gdf_stops
 
-    for cluster_id, cluster_group in clusters:
-        diameter = _approximate_diameter(cluster_group.geometry.tolist())
-        max_distance: float = cluster_distance * 1.0
+def _split_cluster(points: np.ndarray, cluster_distance: int, max_diameter_meters: int) -> np.ndarray | None:
+    """
+    Returns the sub-cluster labels of the points of a cluster (-1 for noise), or None if the cluster is small enough.
 
-        # If the diameter exceeds the limit, split the cluster iteratively
-        while diameter > max_diameter_meters:
-            max_distance = max_distance * 0.8
+    With min_samples=2, DBSCAN clusters are exactly the connected components of the graph that links all stops
+    within eps of each other. Hence, the neighbour graph of the cluster is only computed once for the initial
+    distance and filtered down for every smaller distance.
+    """
 
-            # Reset the entire "cluster" column to -1 for this group
-            gdf_stops.loc[cluster_group.index, "cluster"] = -1
-            cluster_group = cluster_group.copy()
-            cluster_group["cluster"] = -1
+    if _diameter(points) <= max_diameter_meters:
+        return None
 
-            # Split the cluster into smaller sub-clusters using DBSCAN with a smaller eps
-            coords = np.array([(geom.x, geom.y) for geom in cluster_group.geometry])
-            new_cluster_assignment = DBSCAN(eps=max_distance, min_samples=2, algorithm="ball_tree", metric="euclidean").fit(coords)
+    left, right, distances = _neighbour_graph(points, cluster_distance)
+    max_distance: float = cluster_distance * 1.0
 
-            # Update the cluster_group with new sub-cluster labels
-            for idx, label in zip(cluster_group.index, new_cluster_assignment.labels_):
-                cluster_group.at[idx, "cluster"] = cluster_id * 1000 + label if label != -1 else -1
+    # If the diameter exceeds the limit, split the cluster iteratively
+    diameter = np.inf
+    while diameter > max_diameter_meters:
+        max_distance = max_distance * 0.8
+        sub_labels = _connected_clusters(len(points), left, right, distances, max_distance)
 
-            # Find the largest diameter among all sub-clusters
-            sub_clusters = cluster_group[cluster_group["cluster"] != -1].groupby("cluster")
-            diameter = 0
-            for sub_cluster_id, sub_cluster_group in sub_clusters:
-                sub_diameter = _approximate_diameter(sub_cluster_group.geometry.tolist())
-                if sub_diameter > diameter:
-                    diameter = sub_diameter
+        # Find the largest diameter among all sub-clusters
+        diameter = max((_diameter(points[sub_labels == label]) for label in np.unique(sub_labels[sub_labels != -1])),
+                       default=0.0)
 
-        # Assign final sub-cluster labels back to gdf_stops, excluding noise
-        valid_sub_clusters = cluster_group[cluster_group["cluster"] != -1]
-        gdf_stops.loc[valid_sub_clusters.index, "cluster"] = valid_sub_clusters["cluster"]
+    return sub_labels
 
-    return gdf_stops
+def _neighbour_graph(points: np.ndarray, radius: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns all pairs of distinct points at most radius apart as (left indices, right indices, distances).
+    """
+
+    neighbours, distances = KDTree(points).query_radius(points, r=radius, return_distance=True)
+    left = np.repeat(np.arange(len(points)), [len(indices) for indices in neighbours])
+    right = np.concatenate(neighbours)
+    distances = np.concatenate(distances)
+    distinct = left != right
+    return left[distinct], right[distinct], distances[distinct]
+
+def _connected_clusters(point_count: int, left: np.ndarray, right: np.ndarray, distances: np.ndarray, eps: float) -> np.ndarray:
+    """
+    Labels the connected components of the neighbour graph restricted to edges of at most eps, equivalent to
+    DBSCAN(eps, min_samples=2). Points without any neighbour are labeled -1 (noise).
+    """
+
+    within = distances <= eps
+    adjacency = coo_matrix((np.ones(within.sum(), dtype=np.int8), (left[within], right[within])), shape=(point_count, point_count))
+    _, components = connected_components(adjacency, directed=False)
+
+    has_neighbour = np.zeros(point_count, dtype=bool)
+    has_neighbour[left[within]] = True
+    # Renumber the components of non-noise points consecutively
+    _, sub_labels = np.unique(components[has_neighbour], return_inverse=True)
+    labels = np.full(point_count, -1, dtype=np.int64)
+    labels[has_neighbour] = sub_labels
+    return labels
 
 def _filter_invalid_clusters(gdf_stops: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     # For each stop, keep only the largest cluster it belongs to
@@ -165,12 +468,17 @@ def _filter_invalid_clusters(gdf_stops: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
     return gdf_stops
 
-def _approximate_diameter(points: list[Point]) -> float:
+def _diameter(points: np.ndarray) -> float:
     """
-    Approximates the diameter of the point cloud by calculating the diagonal of its bounding box
+    Calculates the exact diameter of the point cloud, i.e. the largest distance between any two of its points,
+    which is always found between two vertices of its convex hull.
     """
 
-    point_cloud = MultiPoint(points)
-    bounds = point_cloud.bounds  # (minx, miny, maxx, maxy)
-    # Calculate diameter of bounding box using the Pythagorean theorem
-    return ((bounds[2] - bounds[0]) ** 2 + (bounds[3] - bounds[1]) ** 2) ** 0.5
+    if len(points) < 2:
+        return 0.0
+    if len(points) <= 64:
+        # Comparing all pairs is cheaper than building the hull for the small clusters we usually deal with
+        return float(pdist(points).max())
+    hull = MultiPoint(points).convex_hull
+    vertices = np.asarray(hull.exterior.coords if hull.geom_type == "Polygon" else hull.coords)
+    return float(pdist(vertices).max()) if len(vertices) > 1 else 0.0
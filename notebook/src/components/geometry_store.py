@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from functools import cache, cached_property
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely import STRtree
+
+from src.components.types import StopTable, SubDistrict
+
+METRIC_CRS = "EPSG:3857"  # Web Mercator, units in meters
+CLUSTER_HULL_BUFFER = 0.00004  # Degrees that cluster hulls are grown by, such that two-point clusters become a thick line
+POLYLINE_PRECISION = 6  # Decimal places of encoded polylines (about 10 cm)
+SIMPLIFICATION_TOLERANCES = (1, 4, 16, 64)  # Metres (of the metric CRS) that simplified subdistrict shapes may deviate
+
+
+class SubDistrictGeometries:
+    """
+    The geometries of a list of subdistricts as vectorized shapely arrays, both in their original CRS (WGS84) and
+    projected to a CRS with distances in metres, along with a spatial index over the projected geometries.
+    """
+
+    def __init__(self, ids: list[str], names: list[str], geometries: np.ndarray, metric_geometries: np.ndarray):
+        self.ids: list[str] = ids
+        self.names: list[str] = names
+        self.geometries: np.ndarray = geometries
+        self.metric_geometries: np.ndarray = metric_geometries
+        self._buffered: dict[float, np.ndarray] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @cached_property
+    def tree(self) -> STRtree:
+        return STRtree(self.metric_geometries)
+
+    def buffered(self, buffer_metres: float) -> np.ndarray:
+        if buffer_metres not in self._buffered:
+            self._buffered[buffer_metres] = shapely.buffer(self.metric_geometries, buffer_metres)
+        return self._buffered[buffer_metres]
+
+
+class GeometryStore:
+    """
+    Parses the WKT shape of every subdistrict only once and keeps the parsed and projected geometries, so repeated
+    spatial operations and map renders on the same subdistricts share them. The most recently requested lists of
+    subdistricts are kept as SubDistrictGeometries (including their spatial index and buffers).
+
+    Simplified shapes are kept per subdistrict and tolerance. They are simplified as a coverage, i.e. the boundary
+    that two subdistricts share is simplified the same way for both of them, which leaves no gaps or overlaps.
+    """
+
+    def __init__(self, crs: str = "EPSG:4326", max_entries: int = 8):
+        self.crs: str = crs
+        self.max_entries: int = max_entries
+        self._parsed: dict[tuple[str, str], tuple[shapely.Geometry, shapely.Geometry]] = {}
+        self._collections: OrderedDict[tuple[tuple[str, str], ...], SubDistrictGeometries] = OrderedDict()
+        self._simplified: dict[tuple[tuple[str, str], float], shapely.Geometry] = {}
+
+    def for_subdistricts(self, subdistricts: list[SubDistrict]) -> SubDistrictGeometries:
+        keys = tuple((district.id, district.shape) for district in subdistricts)
+        collection = self._collections.get(keys)
+        if collection is not None:
+            self._collections.move_to_end(keys)
+            return collection
+
+        missing = list(dict.fromkeys(key for key in keys if key not in self._parsed))
+        if missing:
+            geometries = shapely.from_wkt([shape for _, shape in missing])
+            metric_geometries = project(geometries, self.crs, METRIC_CRS)
+            self._parsed.update(zip(missing, zip(geometries, metric_geometries)))
+
+        collection = SubDistrictGeometries(
+            ids=[district.id for district in subdistricts],
+            names=[district.name for district in subdistricts],
+            geometries=np.array([self._parsed[key][0] for key in keys], dtype=object),
+            metric_geometries=np.array([self._parsed[key][1] for key in keys], dtype=object),
+        )
+        self._collections[keys] = collection
+        if len(self._collections) > self.max_entries:
+            self._collections.popitem(last=False)
+        return collection
+
+    def simplify(self, subdistricts: list[SubDistrict], tolerances: tuple[float, ...] = SIMPLIFICATION_TOLERANCES) -> None:
+        """
+        Simplifies the shapes of the given subdistricts as one coverage for every tolerance (in metres), replacing
+        earlier simplifications of them. Pass all subdistricts of a map, such that all shared boundaries match.
+        """
+
+        keys = [(district.id, district.shape) for district in subdistricts]
+        geometries = self.for_subdistricts(subdistricts)
+        for tolerance in tolerances:
+            simplified = shapely.coverage_simplify(geometries.metric_geometries, tolerance)
+            self._simplified.update(zip(((key, tolerance) for key in keys), project(simplified, METRIC_CRS, self.crs)))
+
+    def simplified_for_subdistricts(self, subdistricts: list[SubDistrict], tolerance: float) -> np.ndarray:
+        """
+        Returns the shapes of the given subdistricts (in the CRS of the store), simplified with the given tolerance
+        in metres. Subdistricts that were not simplified before are simplified now, as a coverage of their own.
+        """
+
+        keys = [(district.id, district.shape) for district in subdistricts]
+        missing = [district for district, key in zip(subdistricts, keys) if (key, tolerance) not in self._simplified]
+        if missing:
+            self.simplify(missing, (tolerance,))
+        return np.array([self._simplified[key, tolerance] for key in keys], dtype=object)
+
+    def clear(self) -> None:
+        self._parsed.clear()
+        self._collections.clear()
+        self._simplified.clear()
+
+
+def project(geometries: np.ndarray, source_crs: str, target_crs: str = METRIC_CRS) -> np.ndarray:
+    transformer = transformer_for(source_crs, target_crs)
+    return shapely.transform(
+        geometries,
+        lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    )
+
+
+def project_points(lons: np.ndarray, lats: np.ndarray, source_crs: str, target_crs: str = METRIC_CRS) -> np.ndarray:
+    x, y = transformer_for(source_crs, target_crs).transform(lons, lats)
+    return shapely.points(x, y)
+
+
+@cache
+def transformer_for(source_crs: str, target_crs: str) -> Transformer:
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def geometries_of(subdistricts: list[SubDistrict], crs: str = "EPSG:4326") -> SubDistrictGeometries:
+    """
+    Returns the (cached) geometries of the given subdistricts, whose shapes are given in the given CRS.
+    """
+
+    return store_for(crs).for_subdistricts(subdistricts)
+
+
+def simplified_geometries_of(subdistricts: list[SubDistrict], tolerance: float, crs: str = "EPSG:4326") -> np.ndarray:
+    """
+    Returns the (cached) shapes of the given subdistricts, simplified along their shared boundaries with the given
+    tolerance in metres (see GeometryStore.simplify() to simplify all subdistricts of a map as one coverage).
+    """
+
+    return store_for(crs).simplified_for_subdistricts(subdistricts, tolerance)
+
+
+def precompute_simplifications(subdistricts: list[SubDistrict], tolerances: tuple[float, ...] = SIMPLIFICATION_TOLERANCES,
+                               crs: str = "EPSG:4326") -> None:
+    store_for(crs).simplify(subdistricts, tolerances)
+
+
+def tolerance_for_zoom(zoom: float, tolerances: tuple[float, ...] = SIMPLIFICATION_TOLERANCES) -> float:
+    """
+    Returns the largest of the given tolerances that is still below half a pixel of a web map at the given zoom level,
+    i.e. the coarsest simplification whose difference to the original shape is not visible.
+    """
+
+    half_pixel_metres = 156_543.03 / 2 ** zoom / 2  # Size of a pixel at the equator in web mercator metres
+    suitable = [tolerance for tolerance in tolerances if tolerance <= half_pixel_metres]
+    return max(suitable) if suitable else min(tolerances)
+
+
+@cache
+def store_for(crs: str) -> GeometryStore:
+    return GeometryStore(crs)
+
+
+def cluster_hulls(point_groups: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Returns the outline [(lat, lon), ...] of the slightly buffered convex hull of every (non-empty) group of
+    (lat, lon) points, computed for all groups at once.
+    """
+
+    if not point_groups:
+        return []
+
+    sizes = [len(points) for points in point_groups]
+    points = np.concatenate(point_groups)
+    multi_points = shapely.multipoints(shapely.points(points[:, 0], points[:, 1]), indices=np.repeat(np.arange(len(sizes)), sizes))
+    # A few segments per quarter circle suffice for a buffer of a few metres and keep the outlines short
+    hulls = shapely.buffer(shapely.convex_hull(multi_points), CLUSTER_HULL_BUFFER, quad_segs=4)
+    return [shapely.get_coordinates(shapely.get_exterior_ring(hull)) for hull in hulls]
+
+
+def cluster_outlines(stops: StopTable, use_precomputed: bool = True) -> dict[int, np.ndarray]:
+    """
+    Returns the outline [(lat, lon), ...] of the hull of every cluster by the row of its root. Precomputed hulls
+    (see StopTable.cluster_hulls) are only decoded, the hulls of all other clusters are computed from their points.
+    """
+
+    outlines = {}
+    missing = []
+    for row in np.flatnonzero(stops.is_root).tolist():
+        if use_precomputed and stops.cluster_hulls is not None and stops.cluster_hulls[row] is not None:
+            outlines[row] = decode_polyline(stops.cluster_hulls[row])
+        elif stops.cluster_point_offsets[row + 1] > stops.cluster_point_offsets[row]:
+            missing.append(row)
+
+    outlines.update(zip(missing, cluster_hulls([stops.cluster_points_of(row) for row in missing])))
+    return outlines
+
+
+def encode_polyline(coordinates: np.ndarray, precision: int = POLYLINE_PRECISION) -> str:
+    """
+    Encodes a sequence of (lat, lon) coordinates with the Encoded Polyline Algorithm (as used by many map services),
+    i.e. as the differences between consecutive coordinates in a compact string of printable characters.
+    """
+
+    values = np.round(np.asarray(coordinates, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+    characters = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            characters.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        characters.append(chr(value + 63))
+    return "".join(characters)
+
+
+def decode_polyline(polyline: str, precision: int = POLYLINE_PRECISION) -> np.ndarray:
+    """
+    Decodes a string created by encode_polyline() into an (n, 2) array of (lat, lon) coordinates.
+    """
+
+    values, value, shift = [], 0, 0
+    for character in polyline:
+        chunk = ord(character) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    return np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
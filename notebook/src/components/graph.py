@@ -1,19 +1,161 @@
+import asyncio
+import concurrent.futures
+import json
 import logging
 import os
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Coroutine, Iterator
 
 import neo4j.graph
-from neo4j import GraphDatabase, ResultSummary, Record
+import pandas as pd
+from neo4j import AsyncGraphDatabase, GraphDatabase, ResultSummary, Record
+from neo4j.spatial import WGS84Point
 
-from src.components.types import SubDistrict, Stop, Connection, ClusterStop, parse_mode_of_transport, parse_frequency
+from src.components import clustering
+from src.components.types import SubDistrict, Stop, Connection, ClusterStop, StopTable, ConnectionTable, BoundingBox, parse_mode_of_transport, parse_frequency
 
 URI = "bolt://" + os.getenv('NEO4J_URI', "localhost:7687")
 AUTH = ("neo4j", "")
+DEFAULT_FETCH_SIZE = 1000  # Number of records pulled from the database at once when streaming results
 logging.getLogger("neo4j").setLevel(logging.ERROR)
 
 # Create a driver instance
 driver = GraphDatabase.driver(URI, auth=AUTH)
 
 
+class PlanCacheRecord:
+    """
+    Client-side bookkeeping of how often a query template was sent to neo4j. Neo4j caches execution plans by the
+    query text (and the types of its parameters), so every repetition of an already seen template can reuse the
+    cached plan, while every new template has to go through the query planner first.
+    """
+
+    def __init__(self, template: str):
+        self.template: str = template
+        self.hits: int = 0
+        self.misses: int = 0
+
+# Query plan records, keyed by the query text and the types of its parameters
+_plan_cache: dict[tuple[str, tuple[tuple[str, str], ...]], PlanCacheRecord] = {}
+
+
+class QueryResultCache:
+    """
+    Size-bounded LRU cache for the records returned by read queries, keyed by the query text and its parameters.
+
+    The cache is tied to the current graph epoch: every write operation on the graph starts a new epoch and thereby
+    drops all cached results, since they might no longer reflect the state of the graph.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries: int = max_entries
+        self.epoch: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[str, list[Record]] = OrderedDict()
+
+    def get(self, key: str) -> list[Record] | None:
+        records = self._entries.get(key)
+        if records is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return records
+
+    def put(self, key: str, records: list[Record], epoch: int) -> None:
+        # Results that were queried before the latest write might already be outdated
+        if epoch != self.epoch:
+            return
+
+        self._entries[key] = records
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)  # Evict the least recently used entry
+
+    def invalidate(self) -> None:
+        self.epoch += 1
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+result_cache = QueryResultCache()
+
+
+class QueryProfile:
+    def __init__(self, name: str, wall_time: float, rows: int, counters: dict[str, int], db_hits: int | None, plan: str | None):
+        self.name: str = name
+        self.wall_time: float = wall_time
+        self.rows: int = rows
+        self.counters: dict[str, int] = counters
+        self.db_hits: int | None = db_hits
+        self.plan: str | None = plan
+
+class QueryProfiler:
+    """
+    Records the wall time, number of returned rows and update counters of every statement sent to neo4j in a
+    bounded ring buffer. If profile_plans is set, statements are additionally run with the PROFILE prefix to
+    record the database hits and the execution plan of each statement (this slows down the statements themselves).
+    Schema and administration commands cannot be profiled by neo4j and are always sent unchanged.
+    """
+
+    Unprofiled_Command_Pattern: re.Pattern = re.compile(
+        r"^\s*(?:(?:CREATE|DROP)\s+(?:OR\s+REPLACE\s+)?(?:\w+\s+)*?(?:INDEX|CONSTRAINT)\b|SHOW\b|(?:CREATE|DROP|ALTER|START|STOP)\s+DATABASE\b)",
+        re.IGNORECASE
+    )
+
+    Counter_Names: list[str] = [
+        "nodes_created", "nodes_deleted", "relationships_created", "relationships_deleted", "properties_set",
+        "labels_added", "labels_removed", "indexes_added", "indexes_removed", "constraints_added", "constraints_removed"
+    ]
+
+    def __init__(self, max_entries: int = 1000, enabled: bool = True, profile_plans: bool = False):
+        self.enabled: bool = enabled
+        self.profile_plans: bool = profile_plans
+        self.profiles: deque[QueryProfile] = deque(maxlen=max_entries)
+
+    def prepare(self, cypher_query: str) -> str:
+        if not (self.enabled and self.profile_plans) or self.Unprofiled_Command_Pattern.match(cypher_query):
+            return cypher_query
+        return "PROFILE " + cypher_query
+
+    def record(self, name: str, started_at: float, rows: int, summary: ResultSummary | None) -> None:
+        if not self.enabled:
+            return
+
+        wall_time = time.perf_counter() - started_at
+        counters, db_hits, plan = {}, None, None
+        if summary is not None:
+            counters = {counter: getattr(summary.counters, counter) for counter in self.Counter_Names
+                        if getattr(summary.counters, counter, 0)}
+            if summary.profile:
+                db_hits = self._sum_db_hits(summary.profile)
+                plan = self._format_plan(summary.profile)
+
+        self.profiles.append(QueryProfile(name, wall_time, rows, counters, db_hits, plan))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            [(p.name, p.wall_time, p.rows, p.counters, p.db_hits, p.plan) for p in self.profiles],
+            columns=["query", "wall_time_s", "rows", "counters", "db_hits", "plan"]
+        )
+
+    @classmethod
+    def _sum_db_hits(cls, plan: dict) -> int:
+        return plan.get("dbHits", 0) + sum(cls._sum_db_hits(child) for child in plan.get("children", []))
+
+    @classmethod
+    def _format_plan(cls, plan: dict, depth: int = 0) -> str:
+        line = f"{'  ' * depth}{plan.get('operatorType', '?')} (rows: {plan.get('rows', 0)}, db hits: {plan.get('dbHits', 0)})"
+        return "\n".join([line] + [cls._format_plan(child, depth + 1) for child in plan.get("children", [])])
+
+profiler = QueryProfiler()
+
+
 # noinspection PyBroadException
 def is_available():
     try:
@@ -38,7 +180,7 @@ def get_subdistricts(id_list: list[str] = None) -> list[SubDistrict]:
            s.area as area,
            s.shape as shape;
     """
-    results = execute_query(query, id_list=id_list)
+    results = execute_cached_query(query, id_list=id_list)
 
     return [SubDistrict(
         record["district"],
@@ -49,17 +191,28 @@ def get_subdistricts(id_list: list[str] = None) -> list[SubDistrict]:
         record["shape"]
     ) for record in results]
 
-def get_stops(*, with_clusters = False, only_in_use: bool = False, id_list: list[str] = None, name_list: list[str] = None) -> list[Stop] | None:
+def get_stops(*, with_clusters = False, only_in_use: bool = False, id_list: list[str] = None, name_list: list[str] = None,
+              within: BoundingBox | None = None, with_hulls: bool = False, as_table: bool = False) -> list[Stop] | StopTable | None:
+    """
+    Returns all stops that match any of the given IDs or names (or all stops). If a bounding box is given, only the
+    stops displayed within it (at the position of their cluster, if any) are returned, which requires the stop
+    locations created by create_stop_locations(). With with_hulls, clusters come with their precomputed hull (see
+    store_cluster_hulls()) instead of the positions of their members.
+    """
+
+    # Only the shape of the filter goes into the query text, the actual values are passed as parameters
     conditions = []
     if id_list:
-        conditions.append(f"s.id IN [\"{'", "'.join(id_list)}\"]")
+        conditions.append("s.id IN $id_list")
     if name_list:
-        conditions.append(f"""ANY(
-          elem IN [\"{'", "'.join(name_list)}\"]
+        conditions.append("""ANY(
+          elem IN $names
           WHERE s.name CONTAINS elem
         )""")
 
     where_clause = f"WHERE {' OR '.join(conditions)}" if conditions else ""
+    if within is not None:
+        where_clause = f"WHERE {within_bbox('s')}" + (f" AND ({' OR '.join(conditions)})" if conditions else "")
     in_use_label = f":InUse" if only_in_use else ""
 
     base_query = f"""
@@ -67,19 +220,17 @@ def get_stops(*, with_clusters = False, only_in_use: bool = False, id_list: list
     {where_clause}
     """
 
-    query = _finalize_stop_query(base_query, "s", with_clusters)
-    response = execute_query(query)
-    return _parse_stops_from_response(response)
+    query = _finalize_stop_query(base_query, "s", with_clusters, with_hulls)
+    response = execute_cached_query(query, id_list=id_list, names=name_list, **_bbox_params(within))
+    return StopTable.from_records(response) if as_table else _parse_stops_from_response(response)
 
-def get_stop_cluster(stop_identifier = None) -> list[Stop] | None:
+def get_stop_cluster(stop_identifier = None, with_hulls: bool = False) -> list[Stop] | None:
     if stop_identifier is None:
-        return get_stops(with_clusters=True)
+        return get_stops(with_clusters=True, with_hulls=with_hulls)
 
-    where_clause: str = f"start.id = '{stop_identifier}' OR start.name CONTAINS '{stop_identifier}'"
-
-    base_query = f"""
+    base_query = """
     MATCH (start:Stop)
-    WHERE {where_clause}
+    WHERE start.id = $stop_identifier OR start.name CONTAINS $stop_identifier
     OPTIONAL MATCH (start)-[:IN_CLUSTER]->(c:Stop)<-[:IN_CLUSTER]-(d:Stop)
     
     WITH start, c, collect(d) AS others
@@ -88,19 +239,20 @@ def get_stop_cluster(stop_identifier = None) -> list[Stop] | None:
     WHERE node IS NOT NULL
     """
 
-    query = _finalize_stop_query(base_query, "node", with_clusters=True)
-    response = execute_query(query)
+    query = _finalize_stop_query(base_query, "node", with_clusters=True, with_hulls=with_hulls)
+    response = execute_cached_query(query, stop_identifier=stop_identifier)
     return _parse_stops_from_response(response)
 
-def get_stops_for_subdistrict(district_code: int, subdistrict_code: int, only_stops_within = False, with_clusters=True) -> list[Stop] | None:
+def get_stops_for_subdistrict(district_code: int, subdistrict_code: int, only_stops_within = False, with_clusters=True,
+                              with_hulls: bool = False) -> list[Stop] | None:
     base_query = f"""
     MATCH (d:SubDistrict)
     WHERE d.district_num = $dist_num AND d.sub_district_num = $subdist_num
     MATCH (s:Stop)-[:{"LOCATED_IN" if only_stops_within else "LOCATED_NEARBY"}]->(d)
     """
 
-    query = _finalize_stop_query(base_query, "s", with_clusters=with_clusters)
-    response = execute_query(query, dist_num=district_code, subdist_num=subdistrict_code)
+    query = _finalize_stop_query(base_query, "s", with_clusters=with_clusters, with_hulls=with_hulls)
+    response = execute_cached_query(query, dist_num=district_code, subdist_num=subdistrict_code)
     return _parse_stops_from_response(response)
 
 
@@ -114,7 +266,7 @@ def get_nearby_stops(*, id_list: list[str] = None, one_directional = True, only_
     :return:
     """
 
-    id_filter_clause = f"s.id IN [\"{'", "'.join(id_list)}\"]" if id_list else "True"
+    id_filter_clause = "s.id IN $id_list" if id_list else "True"
     direction_filter_clause = "s.id < t.id" if one_directional else "True"
     targets_filter_clause = f"NOT (s)-[:BUS_CONNECTS_TO|TRAM_CONNECTS_TO|SUBWAY_CONNECTS_TO]-(t)" if only_disconnected else "True"
 
@@ -127,14 +279,23 @@ def get_nearby_stops(*, id_list: list[str] = None, one_directional = True, only_
     RETURN s.id as start, potential_targets
     """
 
-    records = execute_query(query)
+    records = execute_cached_query(query, id_list=id_list)
     return [(record["start"], record["potential_targets"]) for record in records]
 
-def get_connections(connection_query: str):
-    query_result = execute_query(connection_query)
+def get_connections(connection_query: str, fetch_size: int = DEFAULT_FETCH_SIZE, *, within: BoundingBox | None = None,
+                    as_table: bool = False, **params) -> list[Connection] | ConnectionTable:
+    """
+    Streams the connections returned by the given query (as 'from', 'to' and 'label'). If a bounding box is given,
+    it is passed to the query as the $lower_left and $upper_right parameters, which the query can filter on with
+    the condition returned by within_bbox().
+    """
+
+    params.update(_bbox_params(within))
+    if as_table:
+        return ConnectionTable.from_records(stream_query(connection_query, fetch_size, **params))
 
     connections = []
-    for record in query_result:
+    for record in stream_query(connection_query, fetch_size, **params):
         from_stop = _parse_stop(record["from"], [])
         to_stop = _parse_stop(record["to"], [])
         mode_of_transport = parse_mode_of_transport(record["label"])
@@ -145,7 +306,79 @@ def get_connections(connection_query: str):
     return connections
 
 
-def cluster_stops(stop_clusters: list[list[str]]) -> ResultSummary | None:
+def within_bbox(stop_variable: str) -> str:
+    """
+    Returns the Cypher condition that the given stop is displayed within the bounding box passed as the $lower_left
+    and $upper_right parameters, which is answered by the point index on the display locations of stops.
+    """
+
+    return f"point.withinBBox({stop_variable}.display_location, $lower_left, $upper_right)"
+
+def has_cluster_hulls() -> bool:
+    return len(execute_query("MATCH (c:ClusterStop) WHERE c.cluster_hull IS NOT NULL RETURN 1 LIMIT 1")) > 0
+
+def store_cluster_hulls(hulls: dict[str, str], batch_size: int = 10_000) -> dict[str, ResultSummary | None]:
+    """
+    Stores the given hulls (encoded polylines of their outline, by the ID of the cluster root) as the cluster_hull
+    property of the cluster roots and drops the hulls of all stops that are no cluster root (anymore).
+    """
+
+    summaries = {}
+    summaries["hulls"] = execute_batched_operation("""
+    UNWIND $hulls AS row
+    CALL (row) {
+      MATCH (c:ClusterStop {id: row.id})
+      SET c.cluster_hull = row.hull
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """, hulls=[{"id": stop_id, "hull": hull} for stop_id, hull in hulls.items()], batch_size=batch_size)
+    summaries["outdated_hulls"] = execute_operation("""
+    MATCH (s:Stop)
+    WHERE s.cluster_hull IS NOT NULL AND NOT s:ClusterStop
+    REMOVE s.cluster_hull
+    """)
+    return summaries
+
+def has_stop_locations() -> bool:
+    return len(execute_query("MATCH (s:Stop) WHERE s.display_location IS NOT NULL RETURN 1 LIMIT 1")) > 0
+
+def create_stop_locations() -> dict[str, ResultSummary | None]:
+    """
+    Stores the position of every stop as a point ('location') along with the position it is displayed at, which is
+    the position of its cluster for cluster roots ('display_location'), and indexes both for bounding box queries.
+    Needs to be repeated whenever the cluster positions change.
+    """
+
+    summaries = {}
+    summaries["locations"] = execute_batched_operation("""
+    MATCH (s:Stop)
+    CALL (s) {
+      SET s.location = point({latitude: s.lat, longitude: s.lon}),
+          s.display_location = CASE
+            WHEN s:ClusterStop AND s.cluster_lat IS NOT NULL THEN point({latitude: s.cluster_lat, longitude: s.cluster_lon})
+            ELSE point({latitude: s.lat, longitude: s.lon})
+          END
+    } IN TRANSACTIONS OF 10000 ROWS
+    """)
+    summaries["location_index"] = execute_operation(
+        "CREATE POINT INDEX stop_location IF NOT EXISTS FOR (s:Stop) ON (s.location)")
+    summaries["display_location_index"] = execute_operation(
+        "CREATE POINT INDEX stop_display_location IF NOT EXISTS FOR (s:Stop) ON (s.display_location)")
+    return summaries
+
+
+def cluster_stops(stop_clusters: list[list[str]], *, reclustered_ids: set[str] | None = None) -> ResultSummary | None:
+    """
+    Creates the given clusters of stops, where the first stop of each cluster becomes its root.
+
+    In incremental mode (if reclustered_ids is given), the clusters replace the current clusters of only these stops
+    (see geo_spatial.find_stop_clusters_incremental()), and only the IN_CLUSTER relationships and ClusterStop labels
+    that actually differ are written.
+    """
+
+    if reclustered_ids is not None:
+        edits = clustering.diff_clusters(get_current_cluster_roots(reclustered_ids), stop_clusters, reclustered_ids)
+        return apply_cluster_edits(edits) if len(edits) > 0 else None
+
     if stop_clusters and len(stop_clusters[0]) > 0:
         operation = """
         UNWIND $cluster_list AS cluster
@@ -162,56 +395,159 @@ def cluster_stops(stop_clusters: list[list[str]]) -> ResultSummary | None:
 
     return None
 
-def merge_related_clusters() -> int:
+def get_current_cluster_roots(stop_ids: set[str]) -> dict[str, str | None]:
+    """
+    Returns the ID of the cluster root (or None) of each of the given stops and of all other stops in their clusters.
+    """
+
+    query = """
+    MATCH (s:Stop)
+    WHERE s.id IN $stop_ids
+    OPTIONAL MATCH (s)-[:IN_CLUSTER]->(root:Stop)
+    OPTIONAL MATCH (member:Stop)-[:IN_CLUSTER]->(root)
+    WITH collect([s.id, root.id]) + collect([member.id, root.id]) AS assignments
+    UNWIND assignments AS assignment
+    WITH assignment WHERE assignment[0] IS NOT NULL
+    RETURN DISTINCT assignment[0] AS stop, assignment[1] AS root
+    """
+    return {record["stop"]: record["root"] for record in execute_query(query, stop_ids=list(stop_ids))}
+
+def apply_cluster_edits(edits: clustering.ClusterEdits) -> ResultSummary | None:
     operation = """
-    // Find stops that are related according to their ID but not in the same cluster
-    MATCH (left:Stop)
-    WITH left, split(left.id, ':') as parts
-    WITH left, parts[0] + ':' + parts[1] + ':' + parts[2] + ':' + parts[3] + ':' as prefix
-    MATCH (right:Stop)
-    WHERE right.id STARTS WITH prefix
-      AND right.id <> left.id
-      AND NOT (left)-[:IN_CLUSTER]->()<-[:IN_CLUSTER]-(right)
-    
-    // Check if they already have a cluster parent
-    OPTIONAL MATCH (left)-[:IN_CLUSTER]->(leftParent:Stop)
-    OPTIONAL MATCH (right)-[:IN_CLUSTER]->(rightParent:Stop)
-    
-    // Handle the four different cases to put the two nodes into the same cluster
-    WITH left, right, leftParent, rightParent
-    CALL apoc.do.case([
-        // Case 1: left has parent, right is orphan
-        leftParent IS NOT NULL AND rightParent IS NULL,
-        'MERGE (right)-[:IN_CLUSTER]->(leftParent)
-         RETURN 1 as result',
-        
-        // Case 2: right has parent, left is orphan
-        leftParent IS NULL AND rightParent IS NOT NULL,
-        'MERGE (left)-[:IN_CLUSTER]->(rightParent)
-         RETURN 2 as result',
-        
-        // Case 3: both are orphans - make right the parent
-        leftParent IS NULL AND rightParent IS NULL,
-        'SET right:ClusterStop
-         MERGE (left)-[:IN_CLUSTER]->(right)
-         RETURN 3 as result',
-        
-        // Case 4: both have parents - merge clusters
-        leftParent IS NOT NULL AND rightParent IS NOT NULL,
-        'REMOVE leftParent:ClusterStop
-         WITH leftParent, rightParent
-         MATCH (leftParent)<-[rel:IN_CLUSTER]-()
-         CALL apoc.refactor.to(rel, rightParent) YIELD output
-         RETURN 4 as result'
-      ],
-      '', // else clause (will never be reached)
-      {left: left, right: right, leftParent: leftParent, rightParent: rightParent}
-    ) YIELD value
-    
-    RETURN count(*) as mergedClusters
+    CALL () {
+      UNWIND $removed AS edit
+      MATCH (:Stop {id: edit.stop})-[r:IN_CLUSTER]->(:Stop {id: edit.root})
+      DELETE r
+    }
+    CALL () {
+      UNWIND $demoted AS stopId
+      MATCH (s:Stop:ClusterStop {id: stopId})
+      REMOVE s:ClusterStop
+    }
+    CALL () {
+      UNWIND $added AS edit
+      MATCH (s:Stop {id: edit.stop})
+      MATCH (root:Stop {id: edit.root})
+      MERGE (s)-[:IN_CLUSTER]->(root)
+    }
+    CALL () {
+      UNWIND $promoted AS stopId
+      MATCH (s:Stop {id: stopId})
+      SET s:ClusterStop
+    }
+    """
+    return execute_operation(
+        operation,
+        removed=[{"stop": stop_id, "root": root_id} for stop_id, root_id in edits.removed],
+        added=[{"stop": stop_id, "root": root_id} for stop_id, root_id in edits.added],
+        demoted=edits.demoted,
+        promoted=edits.promoted,
+    )
+
+def get_clustering_snapshot() -> tuple[list[Stop], dict[str, Any]] | None:
+    """
+    Returns the stops (with their positions) that the clusters were last computed from, along with the clustering
+    parameters, or None if no snapshot was saved yet.
+    """
+
+    query = """
+    MATCH (snapshot:ClusteringSnapshot)
+    RETURN snapshot
+    """
+    result = execute_query(query)
+    if not result:
+        return None
+
+    snapshot = result[0]["snapshot"]
+    stops = [Stop(stop_id, lat, lon, "") for stop_id, lat, lon in zip(snapshot["stop_ids"], snapshot["lats"], snapshot["lons"])]
+    return stops, {"cluster_distance_metres": snapshot["cluster_distance_metres"], "max_diameter_meters": snapshot["max_diameter_meters"]}
+
+def save_clustering_snapshot(stops: list[Stop], cluster_distance_metres: int, max_diameter_meters: int) -> ResultSummary | None:
+    """
+    Remembers the stops (with their positions) that the clusters were computed from, such that the next clustering
+    can be done incrementally.
     """
 
-    return execute_operation_returning_count(operation)
+    operation = """
+    MERGE (snapshot:ClusteringSnapshot)
+    SET snapshot.stop_ids = $stop_ids,
+        snapshot.lats = $lats,
+        snapshot.lons = $lons,
+        snapshot.cluster_distance_metres = $cluster_distance_metres,
+        snapshot.max_diameter_meters = $max_diameter_meters,
+        snapshot.created_at = datetime()
+    """
+    return execute_operation(operation, stop_ids=[s.id for s in stops], lats=[s.lat for s in stops], lons=[s.lon for s in stops],
+                             cluster_distance_metres=cluster_distance_metres, max_diameter_meters=max_diameter_meters)
+
+def get_cluster_roots() -> tuple[list[str], list[str | None]]:
+    """
+    Returns the IDs of all stops along with the ID of the root of each stop's cluster (None if not clustered).
+    """
+
+    query = """
+    MATCH (s:Stop)
+    OPTIONAL MATCH (s)-[:IN_CLUSTER]->(root:Stop)
+    RETURN s.id AS stop, root.id AS root
+    """
+    stop_ids, roots = [], []
+    for record in stream_query(query):
+        stop_ids.append(record["stop"])
+        roots.append(record["root"])
+    return stop_ids, roots
+
+def assign_clusters(cluster_roots: dict[str, str], batch_size: int = 10_000) -> ResultSummary | None:
+    """
+    Writes the given stop -> cluster root assignment to the graph in a single batched UNWIND: every stop ends up
+    with exactly one IN_CLUSTER relationship to its root, and only roots carry the ClusterStop label.
+    """
+
+    operation = """
+    UNWIND $assignments AS assignment
+    CALL (assignment) {
+      MATCH (s:Stop {id: assignment.stop})
+      MATCH (root:Stop {id: assignment.root})
+      OPTIONAL MATCH (s)-[previous:IN_CLUSTER]->(other:Stop)
+      WHERE other <> root
+      DELETE previous
+      WITH DISTINCT s, root
+      MERGE (s)-[:IN_CLUSTER]->(root)
+      SET root:ClusterStop
+      FOREACH (_ IN CASE WHEN s <> root THEN [1] ELSE [] END | REMOVE s:ClusterStop)
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """
+    assignments = [{"stop": stop_id, "root": root_id} for stop_id, root_id in cluster_roots.items()]
+    return execute_batched_operation(operation, assignments=assignments, batch_size=batch_size)
+
+def move_stop_relations_to_root(batch_size: int = 100, concurrency: int = 4) -> int:
+    """
+    Moves the STOPS_AT relationships of all clustered stops over to their cluster root, keeping all properties.
+    The VISITS relationships of trip patterns are moved along with them, so trips whose STOPS_AT relationships
+    were dropped (see drop_pattern_stop_times()) end up at the cluster roots as well.
+    Each relationship is re-created at the root and the old one deleted, in concurrent transactions partitioned
+    by cluster root: every batch handles batch_size whole clusters. Batches never share stops, but they do share
+    the Trip nodes at the other end of the moved relationships, so concurrent batches can still deadlock.
+
+    Batches that fail in the concurrent pass are redone in a serial pass afterwards, which only finds the
+    relationships that have not been moved yet. Progress is printed after each batch.
+
+    Returns:
+        int: the total number of moved relationships
+
+    Raises:
+        RuntimeError: if some relationships could not be moved even in the serial pass
+    """
+
+    total_moved, failed = _move_stop_relations_pass(batch_size, concurrency)
+    if failed > 0:
+        print(f"Retrying the {failed} failed batches in a serial pass...")
+        moved, failed = _move_stop_relations_pass(batch_size, 1)
+        total_moved += moved
+    if failed > 0:
+        raise RuntimeError(f"{failed} batches of STOPS_AT relationships could not be moved to their cluster roots "
+                           f"(moved {total_moved} relationships before giving up)")
+
+    return total_moved
 
 def connect_stop_to_subdistricts(stops_with_districts: list[tuple[str, list[str]]], relation_name: str) -> ResultSummary | None:
     # Prepare the data as a list of dictionaries for neo4j's UNWIND operation
@@ -234,16 +570,238 @@ def connect_stop_to_subdistricts(stops_with_districts: list[tuple[str, list[str]
     return execute_operation(query, stop_district_pairs=stop_district_pairs)
 
 
-def query_triples(names_queries: dict[str, str]) -> list[tuple[str, str, str]]:
-    triples = []
-    for name, query in names_queries.items():
-        print(f"Running query '{name}'...")
-        records = execute_query(query)
-        triples.extend([(triple["head"], triple["rel"], triple["tail"]) for triple in records])
-        print(f"✅ Received {len(records)} triples")
+def connect_close_stops(stop_pairs: list[tuple[str, str, float]], batch_size: int = 10_000) -> ResultSummary | None:
+    """
+    Connects each given pair of stops by a symmetric IS_CLOSE_TO relationship that stores their distance. The pairs
+    are written in batches of batch_size pairs, each in its own transaction.
+    """
+
+    if not stop_pairs:
+        return None
+
+    operation = """
+    UNWIND $stop_pairs AS pair
+    CALL (pair) {
+      MATCH (s:Stop {id: pair.start})
+      MATCH (t:Stop {id: pair.target})
+      MERGE (s)-[forward:IS_CLOSE_TO]->(t)
+      MERGE (t)-[backward:IS_CLOSE_TO]->(s)
+      SET forward.distance = pair.distance,
+          backward.distance = pair.distance
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """
+    pairs = [{"start": start, "target": target, "distance": distance} for start, target, distance in stop_pairs]
+    return execute_batched_operation(operation, stop_pairs=pairs, batch_size=batch_size)
+
+
+def stream_stop_times(fetch_size: int = 10_000) -> Iterator[tuple[str, str, str, int, int]]:
+    """
+    Lazily yields a (trip, mode, stop, stop_sequence, operations_per_year) tuple for every STOPS_AT relationship of a
+    trip with a known mode of transport (BUS, TRAM or SUBWAY).
+    """
+
+    query = """
+    MATCH (t:Trip)-[:OPERATING_ON]->(service:Service)
+    WITH t, sum(service.operations_per_year) AS operations_per_year,
+      CASE
+        WHEN t:BusTrip THEN 'BUS'
+        WHEN t:TramTrip THEN 'TRAM'
+        WHEN t:SubwayTrip THEN 'SUBWAY'
+      END AS mode
+    WHERE mode IS NOT NULL
+    MATCH (t)-[at:STOPS_AT]->(s:Stop)
+    RETURN t.id AS trip, mode, s.id AS stop, at.stop_sequence AS stop_sequence, operations_per_year
+    """
+
+    for record in stream_query(query, fetch_size):
+        yield record["trip"], record["mode"], record["stop"], record["stop_sequence"], record["operations_per_year"]
+
+def stream_pattern_stop_times(fetch_size: int = 10_000) -> Iterator[tuple[str, str, str, int, int]]:
+    """
+    Pattern-aware version of stream_stop_times(): Lazily yields a (pattern, mode, stop, stop_sequence,
+    operations_per_year) tuple for every stop of every trip pattern, where operations_per_year is summed up over
+    all trips following the pattern.
+    """
+
+    query = """
+    MATCH (t:Trip)-[:OPERATING_ON]->(service:Service)
+    WITH t, sum(service.operations_per_year) AS trip_operations
+    MATCH (t)-[:FOLLOWS_PATTERN]->(p:TripPattern)
+    WITH p, sum(trip_operations) AS operations_per_year
+    MATCH (p)-[:PART_OF_ROUTE]->(r:Route)
+    WITH p, operations_per_year,
+      CASE r.type
+        WHEN 0 THEN 'TRAM'
+        WHEN 1 THEN 'SUBWAY'
+        WHEN 3 THEN 'BUS'
+      END AS mode
+    WHERE mode IS NOT NULL
+    MATCH (p)-[v:VISITS]->(s:Stop)
+    RETURN p.id AS pattern, mode, s.id AS stop, v.stop_sequence AS stop_sequence, operations_per_year
+    """
+
+    for record in stream_query(query, fetch_size):
+        yield record["pattern"], record["mode"], record["stop"], record["stop_sequence"], record["operations_per_year"]
+
+def stream_scheduled_stop_times(fetch_size: int = 10_000) -> Iterator[tuple[str, str, str, int, int | None, int | None]]:
+    """
+    Lazily yields a (trip, route, stop, stop_sequence, arrival_seconds, departure_seconds) tuple for every STOPS_AT
+    relationship, where the times are given in seconds since midnight.
+    """
+
+    query = """
+    MATCH (r:Route)<-[:PART_OF_ROUTE]-(t:Trip)-[at:STOPS_AT]->(s:Stop)
+    RETURN t.id AS trip, r.id AS route, s.id AS stop, at.stop_sequence AS stop_sequence,
+      at.arrival_time.hour * 3600 + at.arrival_time.minute * 60 + at.arrival_time.second AS arrival_seconds,
+      at.departure_time.hour * 3600 + at.departure_time.minute * 60 + at.departure_time.second AS departure_seconds
+    """
+
+    for record in stream_query(query, fetch_size):
+        yield (record["trip"], record["route"], record["stop"], record["stop_sequence"],
+               record["arrival_seconds"], record["departure_seconds"])
+
+def has_trip_patterns() -> bool:
+    return len(execute_query("MATCH (p:TripPattern) RETURN 1 LIMIT 1")) > 0
+
+def create_trip_patterns(patterns: pd.DataFrame, pattern_stops: pd.DataFrame, trip_patterns: pd.DataFrame,
+                         batch_size: int = 10_000) -> dict[str, ResultSummary | None]:
+    """
+    Replaces all existing TripPattern nodes by the given patterns (see schedule.build_trip_patterns()). Every pattern
+    is linked to its route and to its stops (VISITS), and every trip is linked to the pattern it follows by a
+    FOLLOWS_PATTERN relationship that stores the trip's start time and time offsets at each stop of the pattern.
+
+    Returns a summary for each of the write steps.
+    """
+
+    summaries = {}
+    summaries["delete_patterns"] = execute_batched_operation("""
+    MATCH (p:TripPattern)
+    CALL (p) {
+      DETACH DELETE p
+    } IN TRANSACTIONS OF 1000 ROWS
+    """)
+    summaries["constraint"] = execute_operation(
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (p:TripPattern) REQUIRE p.id IS UNIQUE")
+
+    summaries["patterns"] = execute_batched_operation("""
+    UNWIND $patterns AS row
+    CALL (row) {
+      MATCH (r:Route {id: row.route})
+      CREATE (p:TripPattern {id: row.pattern, stop_count: row.stop_count})
+      CREATE (p)-[:PART_OF_ROUTE]->(r)
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """, patterns=_to_rows(patterns), batch_size=batch_size)
+
+    summaries["pattern_stops"] = execute_batched_operation("""
+    UNWIND $pattern_stops AS row
+    CALL (row) {
+      MATCH (p:TripPattern {id: row.pattern})
+      MATCH (s:Stop {id: row.stop})
+      CREATE (p)-[:VISITS {stop_sequence: row.stop_sequence}]->(s)
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """, pattern_stops=_to_rows(pattern_stops), batch_size=batch_size)
+
+    summaries["trip_patterns"] = execute_batched_operation("""
+    UNWIND $trip_patterns AS row
+    CALL (row) {
+      MATCH (t:Trip {id: row.trip})
+      MATCH (p:TripPattern {id: row.pattern})
+      MERGE (t)-[f:FOLLOWS_PATTERN]->(p)
+      SET f.start_time = row.start_time,
+          f.arrival_offsets = row.arrival_offsets,
+          f.departure_offsets = row.departure_offsets
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """, trip_patterns=_to_rows(trip_patterns), batch_size=batch_size)
+
+    return summaries
+
+def drop_pattern_stop_times(batch_size: int = 10_000) -> ResultSummary | None:
+    """
+    Deletes the STOPS_AT relationships of all trips that follow a trip pattern, since their stops and times are
+    fully described by the pattern and the trip's FOLLOWS_PATTERN relationship.
+    """
+
+    operation = """
+    MATCH (t:Trip)-[:FOLLOWS_PATTERN]->(:TripPattern)
+    MATCH (t)-[at:STOPS_AT]->(:Stop)
+    CALL (at) {
+      DELETE at
+    } IN TRANSACTIONS OF $batch_size ROWS
+    """
+    return execute_batched_operation(operation, batch_size=batch_size)
+
+def create_stop_connections(connections: pd.DataFrame) -> dict[str, ResultSummary | None]:
+    """
+    Writes a *_CONNECTS_TO relationship with the given number of yearly operations for every row of connections
+    (columns 'from_stop', 'to_stop', 'mode' and 'yearly'). The relationships of different modes of transport are
+    written concurrently, one bulk UNWIND per mode.
+    """
+
+    operation = """
+    UNWIND $connections AS connection
+    MATCH (s1:Stop {{id: connection.from_stop}})
+    MATCH (s2:Stop {{id: connection.to_stop}})
+    MERGE (s1)-[conn:{connection_type}]->(s2)
+    SET conn.yearly = connection.yearly
+    """
+
+    named_operations = {}
+    for mode, mode_connections in connections.groupby("mode", observed=True):
+        connection_type = f"{mode}_CONNECTS_TO"
+        rows = [
+            {"from_stop": from_stop, "to_stop": to_stop, "yearly": int(yearly)}
+            for from_stop, to_stop, yearly in zip(mode_connections["from_stop"].astype(str),
+                                                  mode_connections["to_stop"].astype(str),
+                                                  mode_connections["yearly"])
+        ]
+        # We need to do string interpolation here since Neo4j does not allow parameters in relationship types
+        named_operations[connection_type] = (operation.format(connection_type=connection_type), {"connections": rows})
+
+    return execute_operations_concurrently(named_operations)
+
+
+def query_triples(names_queries: dict[str, str], fetch_size: int = DEFAULT_FETCH_SIZE,
+                  triple_sink: Callable[[str, str, str], None] = None) -> list[tuple[str, str, str]]:
+    """
+    Runs the given (head, rel, tail) queries concurrently and returns all triples. If a triple_sink is given (e.g.
+    learning.TripleVocabulary.add), every triple is passed to it as soon as it arrives instead, and an empty list is
+    returned.
+
+    Raises:
+        RuntimeError: if a query fails while triples are passed to a triple_sink, since the sink has then already
+            received part of that query's triples
+    """
+
+    print(f"Running {len(names_queries)} queries concurrently...")
+    if triple_sink is None:
+        # Records are converted to triples as they arrive, so no intermediate list of records is ever built
+        record_mapper = lambda record: (record["head"], record["rel"], record["tail"])
+        triples_per_query = query_concurrently(names_queries, fetch_size, record_mapper=record_mapper)
+
+        triples = []
+        for name, query_triples_list in triples_per_query.items():
+            print(f"✅ Received {len(query_triples_list)} triples from query '{name}'")
+            triples.extend(query_triples_list)
+
+        print("Finished collecting training triples!")
+        return triples
+
+    # All queries run on one event loop, so the sink is never called concurrently. Only the rows are counted here.
+    record_sink = lambda record: triple_sink(record["head"], record["rel"], record["tail"])
+    results = _run_coroutine(_gather_queries(names_queries, fetch_size, record_sink=record_sink))
+
+    failed = []
+    for name, (rows, error) in results.items():
+        if error is not None:
+            print(f"❌ Database query '{name}' failed with error: {error}")
+            failed.append(name)
+        else:
+            print(f"✅ Received {rows} triples from query '{name}'")
+    if failed:
+        raise RuntimeError(f"Queries {', '.join(failed)} failed, the triple sink only holds part of their triples")
 
     print("Finished collecting training triples!")
-    return triples
+    return []
 
 def execute_operation(cypher_operation, **params) -> ResultSummary | None:
     """
@@ -253,13 +811,19 @@ def execute_operation(cypher_operation, **params) -> ResultSummary | None:
     a summary about the actions performed.
     """
 
+    _track_query_plan(cypher_operation, params)
+    started_at = time.perf_counter()
     try:
         with driver.session() as session:
-            result = session.run(cypher_operation, **params)
-            return result.consume()
+            result = session.run(profiler.prepare(cypher_operation), **params)
+            summary = result.consume()
+            profiler.record(_describe_query(cypher_operation), started_at, 0, summary)
+            return summary
     except Exception as e:
         print(f"Database operation failed with error: {e}")
         return None
+    finally:
+        result_cache.invalidate()
 
 def execute_query(cypher_query, **params) -> list[Record]:
     """
@@ -267,12 +831,56 @@ def execute_query(cypher_query, **params) -> list[Record]:
     """
 
     try:
-        result = driver.execute_query(cypher_query, **params)
-        return result.records
+        return _fetch_records(cypher_query, params)
+    except Exception as e:
+        print(f"Database query failed with error: {e}")
+        return []
+
+def execute_cached_query(cypher_query, **params) -> list[Record]:
+    """
+    Same as execute_query(), but serves repeated calls with the same query and parameters from the in-process
+    result cache until the next write operation on the graph.
+    """
+
+    key = _cache_key(cypher_query, params)
+    cached_records = result_cache.get(key)
+    if cached_records is not None:
+        return list(cached_records)
+
+    epoch = result_cache.epoch
+    try:
+        records = _fetch_records(cypher_query, params)
     except Exception as e:
         print(f"Database query failed with error: {e}")
         return []
 
+    result_cache.put(key, records, epoch)
+    return list(records)
+
+def stream_query(cypher_query, fetch_size: int = DEFAULT_FETCH_SIZE, **params) -> Iterator[Record]:
+    """
+    Runs a cypher query that is meant to return some data on the connected neo4j instance and lazily yields the
+    returned records one by one. Records are pulled from the database in chunks of fetch_size records, so only one
+    chunk is held in memory at any time, regardless of the total size of the result.
+    """
+
+    _track_query_plan(cypher_query, params)
+    started_at = time.perf_counter()
+    rows = 0
+    try:
+        with driver.session(fetch_size=fetch_size) as session:
+            result = session.run(profiler.prepare(cypher_query), **params)
+            for record in result:
+                rows += 1
+                yield record
+            # Note: the recorded wall time includes the time the consumer spent processing the records
+            profiler.record(_describe_query(cypher_query), started_at, rows, result.consume())
+    except Exception as e:
+        # Unlike the non-streaming helpers, a failing stream must not end quietly: consumers would otherwise take
+        # the records yielded so far for the complete result
+        print(f"Database query failed after {rows} streamed records with error: {e}")
+        raise
+
 def execute_batched_operation(batched_operation, **params) -> ResultSummary | None:
     """
     Runs a cypher operation that is meant to update the database without a managed transaction.
@@ -280,45 +888,380 @@ def execute_batched_operation(batched_operation, **params) -> ResultSummary | No
     OF X ROWS cypher feature.
     """
 
+    _track_query_plan(batched_operation, params)
+    started_at = time.perf_counter()
     try:
         with driver.session() as session:
-            result = session.run(batched_operation, **params)
-            return result.consume()
+            result = session.run(profiler.prepare(batched_operation), **params)
+            summary = result.consume()
+            profiler.record(_describe_query(batched_operation), started_at, 0, summary)
+            return summary
     except Exception as e:
         print(f"Database operation failed with error: {e}")
         return None
+    finally:
+        result_cache.invalidate()
 
 def execute_batched_query(batched_query, **params) -> list[Record] | None:
+    _track_query_plan(batched_query, params)
+    started_at = time.perf_counter()
     try:
         with driver.session() as session:
-            result = session.run(batched_query, **params)
-            return [record for record in result]
+            result = session.run(profiler.prepare(batched_query), **params)
+            records = [record for record in result]
+            profiler.record(_describe_query(batched_query), started_at, len(records), result.consume())
+            return records
     except Exception as e:
         print(f"Database query failed with error: {e}")
         return None
+    finally:
+        # Batched queries are used for large refactorings of the graph
+        result_cache.invalidate()
 
 def execute_operation_returning_count(cypher_query_returning_count, **params) -> int:
     """
     Runs a cypher query that executes some create/update/delete operations on the connected neo4j instance
-    and returns an integer, most commonly the number of affected rows.
+    and returns an integer, most commonly the number of affected rows. The result cache is only invalidated if the
+    query actually wrote to the graph, so read-only counts (e.g. status checks) keep it intact.
+    """
+    try:
+        records, summary = _fetch_result(cypher_query_returning_count, params)
+    except Exception as e:
+        # The operation might have written to the graph before it failed
+        result_cache.invalidate()
+        print(f"Database query failed with error: {e}")
+        return 0
+
+    if summary.counters.contains_updates:
+        result_cache.invalidate()
+    return int(records[0][0]) if records else 0
+
+
+def query_concurrently(named_queries: dict[str, str | tuple[str, dict[str, Any]]], fetch_size: int = DEFAULT_FETCH_SIZE,
+                       record_mapper: Callable[[Record], Any] = None) -> dict[str, list]:
     """
-    result = execute_query(cypher_query_returning_count, **params)
-    return int(result[0][0]) if result else 0
+    Runs several independent cypher queries concurrently on the connected neo4j instance and returns their results
+    by name once all of them have finished. Each query is either given as plain cypher or as a tuple of cypher and
+    its parameters.
+
+    If a record_mapper is given, it is applied to every record as soon as it arrives, such that only the mapped
+    values are kept in memory.
+    """
+
+    results = _run_coroutine(_gather_queries(named_queries, fetch_size, record_mapper))
+    return _unpack_concurrent_results(results, "query", default=[])
+
+async def query_concurrently_async(named_queries: dict[str, str | tuple[str, dict[str, Any]]], fetch_size: int = DEFAULT_FETCH_SIZE,
+                                   record_mapper: Callable[[Record], Any] = None) -> dict[str, list]:
+    """
+    Asynchronous version of query_concurrently() for callers that already run inside an event loop.
+    """
+
+    results = await _gather_queries(named_queries, fetch_size, record_mapper)
+    return _unpack_concurrent_results(results, "query", default=[])
+
+def execute_operations_concurrently(named_operations: dict[str, str | tuple[str, dict[str, Any]]]) -> dict[str, ResultSummary | None]:
+    """
+    Runs several independent create/update/delete operations concurrently on the connected neo4j instance and
+    returns a summary of each operation by name. Every operation runs in its own managed transaction, which is
+    retried by the driver if it fails due to a transient error (e.g. a deadlock between the concurrent operations).
+    """
+
+    try:
+        results = _run_coroutine(_gather_operations(named_operations))
+    finally:
+        result_cache.invalidate()
+    return _unpack_concurrent_results(results, "operation", default=None)
+
+async def execute_operations_concurrently_async(named_operations: dict[str, str | tuple[str, dict[str, Any]]]) -> dict[str, ResultSummary | None]:
+    """
+    Asynchronous version of execute_operations_concurrently() for callers that already run inside an event loop.
+    """
+
+    try:
+        results = await _gather_operations(named_operations)
+    finally:
+        result_cache.invalidate()
+    return _unpack_concurrent_results(results, "operation", default=None)
+
+async def _gather_queries(named_queries: dict[str, str | tuple[str, dict[str, Any]]], fetch_size: int,
+                          record_mapper: Callable[[Record], Any] | None = None,
+                          record_sink: Callable[[Record], None] | None = None) -> dict[str, tuple[Any, Exception | None]]:
+    # The async driver is bound to the event loop it is used in, hence every fan-out gets its own driver
+    async with AsyncGraphDatabase.driver(URI, auth=AUTH) as async_driver:
+        async def run_query(name: str, cypher_query: str, params: dict[str, Any]) -> list | int:
+            _track_query_plan(cypher_query, params)
+            started_at = time.perf_counter()
+            async with async_driver.session(fetch_size=fetch_size) as session:
+                result = await session.run(profiler.prepare(cypher_query), **params)
+                if record_sink:
+                    # Records are handed over without being kept, so only their number is returned
+                    rows = 0
+                    async for record in result:
+                        record_sink(record)
+                        rows += 1
+                    profiler.record(name, started_at, rows, await result.consume())
+                    return rows
+                if record_mapper:
+                    records = [record_mapper(record) async for record in result]
+                else:
+                    records = [record async for record in result]
+                profiler.record(name, started_at, len(records), await result.consume())
+                return records
+
+        return await _gather_named(named_queries, run_query)
+
+async def _gather_operations(named_operations: dict[str, str | tuple[str, dict[str, Any]]]) -> dict[str, tuple[Any, Exception | None]]:
+    async with AsyncGraphDatabase.driver(URI, auth=AUTH) as async_driver:
+        async def run_operation(name: str, cypher_operation: str, params: dict[str, Any]) -> ResultSummary:
+            async def transaction_work(tx):
+                result = await tx.run(profiler.prepare(cypher_operation), **params)
+                return await result.consume()
+
+            _track_query_plan(cypher_operation, params)
+            started_at = time.perf_counter()
+            async with async_driver.session() as session:
+                summary = await session.execute_write(transaction_work)
+                profiler.record(name, started_at, 0, summary)
+                return summary
 
+        return await _gather_named(named_operations, run_operation)
+
+async def _gather_named(named_statements: dict[str, str | tuple[str, dict[str, Any]]],
+                        run_statement: Callable[[str, str, dict[str, Any]], Coroutine]) -> dict[str, tuple[Any, Exception | None]]:
+    async def run_safely(name: str, statement: str | tuple[str, dict[str, Any]]) -> tuple[Any, Exception | None]:
+        cypher, params = statement if isinstance(statement, tuple) else (statement, {})
+        try:
+            return await run_statement(name, cypher, params), None
+        except Exception as e:
+            return None, e
+
+    names = list(named_statements.keys())
+    results = await asyncio.gather(*(run_safely(name, named_statements[name]) for name in names))
+    return dict(zip(names, results))
+
+def _unpack_concurrent_results(results: dict[str, tuple[Any, Exception | None]], kind: str, default: Any) -> dict[str, Any]:
+    # Errors are only reported here, since the statements might have run on a separate thread
+    unpacked = {}
+    for name, (value, error) in results.items():
+        if error is not None:
+            print(f"Database {kind} '{name}' failed with error: {error}")
+            value = default
+        unpacked[name] = value
+
+    return unpacked
+
+def _run_coroutine(coroutine: Coroutine):
+    """
+    Runs a coroutine to completion from synchronous code. If the current thread already runs an event loop
+    (like inside a marimo cell), the coroutine is run on a fresh event loop in a separate thread instead.
+    """
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def query_profiles() -> pd.DataFrame:
+    """
+    Returns all statements recorded by the query profiler during this session (up to its capacity) in the order
+    of their execution.
+    """
+
+    return profiler.to_dataframe()
+
+def slowest_queries(n: int = 10) -> pd.DataFrame:
+    """
+    Returns the n statements with the highest wall time recorded by the query profiler during this session.
+    """
+
+    return profiler.to_dataframe().nlargest(n, "wall_time_s").reset_index(drop=True)
+
+def result_cache_statistics() -> pd.DataFrame:
+    """
+    Summarizes the usage of the in-process result cache for read queries.
+    """
+
+    lookups = result_cache.hits + result_cache.misses
+    return pd.DataFrame([{
+        "entries": len(result_cache),
+        "max_entries": result_cache.max_entries,
+        "hits": result_cache.hits,
+        "misses": result_cache.misses,
+        "hit_rate": result_cache.hits / lookups if lookups else 0.0,
+        "graph_epoch": result_cache.epoch,
+    }])
+
+def plan_cache_statistics() -> pd.DataFrame:
+    """
+    Summarizes how often each query template was (presumably) planned from scratch by neo4j (misses) and how often
+    it could reuse a cached execution plan (hits). The numbers are tracked on the client side, so they assume that
+    neo4j never evicts a plan from its cache.
+    """
+
+    return pd.DataFrame(
+        [(record.template, record.hits, record.misses) for record in _plan_cache.values()],
+        columns=["template", "hits", "misses"]
+    ).sort_values(["misses", "hits"], ascending=False, ignore_index=True)
+
+def reset_plan_cache_statistics() -> None:
+    _plan_cache.clear()
+
+def _track_query_plan(cypher_query: str, params: dict) -> None:
+    parameter_types = tuple(sorted((name, type(value).__name__) for name, value in params.items()))
+    key = (cypher_query, parameter_types)
+
+    record = _plan_cache.get(key)
+    if record is None:
+        record = _plan_cache[key] = PlanCacheRecord(_describe_query(cypher_query))
+        record.misses += 1
+    else:
+        record.hits += 1
+
+def _fetch_records(cypher_query: str, params: dict) -> list[Record]:
+    records, _ = _fetch_result(cypher_query, params)
+    return records
+
+def _fetch_result(cypher_query: str, params: dict) -> tuple[list[Record], ResultSummary]:
+    _track_query_plan(cypher_query, params)
+    started_at = time.perf_counter()
+    result = driver.execute_query(profiler.prepare(cypher_query), **params)
+    profiler.record(_describe_query(cypher_query), started_at, len(result.records), result.summary)
+    return result.records, result.summary
+
+def _cache_key(cypher_query: str, params: dict) -> str:
+    return cypher_query + json.dumps(params, sort_keys=True, default=str)
+
+def _describe_query(cypher_query: str, max_length: int = 80) -> str:
+    """
+    Creates a short, human-readable label for a cypher query. Queries that start with a comment are labelled
+    by that comment, all other queries by their first (whitespace-normalized) lines.
+    """
+
+    lines = [line.strip() for line in cypher_query.strip().splitlines() if line.strip()]
+    if lines and lines[0].startswith("//"):
+        label = lines[0].lstrip("/ ")
+    else:
+        label = " ".join(" ".join(lines).split())
+
+    return label if len(label) <= max_length else label[:max_length - 3] + "..."
+
+
+def _move_stop_relations_pass(batch_size: int, concurrency: int) -> tuple[int, int]:
+    """
+    Runs one pass of move_stop_relations_to_root() with the given concurrency and returns the number of moved
+    relationships along with the number of failed batches.
+    """
+
+    operation = """
+    MATCH (c:Stop:ClusterStop)
+    CALL (c) {
+      CALL (c) {
+        MATCH (t:Trip)-[at:STOPS_AT]->(s:Stop)-[:IN_CLUSTER]->(c)
+        WHERE s.id <> c.id
+        CREATE (t)-[moved:STOPS_AT]->(c)
+        SET moved = properties(at)
+        DELETE at
+        RETURN count(moved) AS moved_stop_times
+      }
+      // Trips whose STOPS_AT relationships were dropped only visit their stops through their trip pattern
+      CALL (c) {
+        MATCH (p:TripPattern)-[v:VISITS]->(s:Stop)-[:IN_CLUSTER]->(c)
+        WHERE s.id <> c.id
+        CREATE (p)-[moved:VISITS]->(c)
+        SET moved = properties(v)
+        DELETE v
+        RETURN count(moved) AS moved_visits
+      }
+      RETURN moved_stop_times + moved_visits AS moved
+    } IN $concurrency CONCURRENT TRANSACTIONS OF $batch_size ROWS
+      ON ERROR CONTINUE
+      REPORT STATUS AS status
+    RETURN moved, status.transactionId AS transaction, status.committed AS committed, status.errorMessage AS error
+    """
+
+    batches: dict[str, dict[str, Any]] = {}
+    _track_query_plan(operation, {"batch_size": batch_size, "concurrency": concurrency})
+    started_at = time.perf_counter()
+    try:
+        with driver.session() as session:
+            result = session.run(profiler.prepare(operation), batch_size=batch_size, concurrency=concurrency)
+            batch = None
+            for record in result:
+                if record["transaction"] not in batches:
+                    # Rows of a batch arrive together, so a new transaction means the previous batch is done
+                    if batch is not None:
+                        _print_moved_batch(len(batches), batch)
+                    batch = batches[record["transaction"]] = {"clusters": 0, "moved": 0, "error": None}
+                batch = batches[record["transaction"]]
+                batch["clusters"] += 1
+                batch["moved"] += record["moved"] or 0
+                if not record["committed"]:
+                    batch["error"] = record["error"]
+            if batch is not None:
+                _print_moved_batch(len(batches), batch)
+            profiler.record(_describe_query(operation), started_at, sum(b["clusters"] for b in batches.values()),
+                            result.consume())
+    except Exception as e:
+        print(f"Database operation failed with error: {e}")
+        raise
+    finally:
+        result_cache.invalidate()
+
+    moved = sum(batch["moved"] for batch in batches.values() if batch["error"] is None)
+    failed = sum(1 for batch in batches.values() if batch["error"] is not None)
+    mode = "serially" if concurrency == 1 else f"with {concurrency} concurrent transactions"
+    print(f"Moved {moved} relationships {mode} in {len(batches) - failed} batches, {failed} batches failed")
+    return moved, failed
+
+def _print_moved_batch(number: int, batch: dict[str, Any]) -> None:
+    if batch["error"] is None:
+        print(f"  Batch {number}: moved {batch['moved']} relationships of {batch['clusters']} clusters")
+    else:
+        print(f"  Batch {number}: failed for {batch['clusters']} clusters and will be retried ({batch['error']})")
+
+def _to_rows(dataframe: pd.DataFrame) -> list[dict[str, Any]]:
+    # Note: pandas already converts numpy scalars to plain python values that the neo4j driver can serialize
+    return dataframe.to_dict(orient="records")
 
 def _parse_stops_from_response(response: list[Record]) -> list[Stop]:
     stops: list[Stop] = []
     for record in response:
         if record["is_cluster"]:
             stops.append(ClusterStop(record["id"], record["lat"], record["lon"], record["name"],
-                                     record["cluster_lat"], record["cluster_lon"], record["cluster_points"]))
+                                     record["cluster_lat"], record["cluster_lon"], record.get("cluster_points"),
+                                     record.get("cluster_hull")))
         else:
             stops.append(Stop(record["id"], record["lat"], record["lon"], record["name"]))
 
     return stops
 
-def _finalize_stop_query(base_query: str, stop_variable: str, with_clusters = False) -> str:
-    if with_clusters:
+def _bbox_params(bbox: BoundingBox | None) -> dict[str, WGS84Point]:
+    if bbox is None:
+        return {}
+    return {"lower_left": WGS84Point((bbox.west, bbox.south)), "upper_right": WGS84Point((bbox.east, bbox.north))}
+
+def _finalize_stop_query(base_query: str, stop_variable: str, with_clusters = False, with_hulls = False) -> str:
+    if with_clusters and with_hulls:
+        # The precomputed hull replaces collecting the positions of all cluster members
+        return f"""
+        {base_query}
+        WITH {stop_variable}
+        RETURN DISTINCT
+            {stop_variable}.id as id,
+            {stop_variable}.lat as lat,
+            {stop_variable}.lon as lon,
+            {stop_variable}.name as name,
+            apoc.label.exists({stop_variable}, "ClusterStop") as is_cluster,
+            {stop_variable}.cluster_lat as cluster_lat,
+            {stop_variable}.cluster_lon as cluster_lon,
+            {stop_variable}.cluster_hull as cluster_hull;
+        """
+    elif with_clusters:
         return f"""
         {base_query}
         WITH {stop_variable}
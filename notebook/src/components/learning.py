@@ -17,10 +17,71 @@ MODELS_SOURCE = os.path.join("notebook", "trained_models")
 if not os.path.exists(MODELS_SOURCE):
     os.makedirs(MODELS_SOURCE)
 
-def generate_training_set(fact_triples: list[tuple[str, str, str]]) -> tuple[TriplesFactory, TriplesFactory, TriplesFactory]:
-    triples_array = np.array(fact_triples)
+class TripleVocabulary:
+    """
+    Maps streamed (head, relation, tail) labels to integer IDs as they arrive and collects the mapped triples in a
+    growing int64 buffer, such that no array of labelled triples is ever built. Pass add() as the triple sink of
+    graph.query_triples() and create the TriplesFactory with to_triples_factory() once all triples are added.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        self.entity_to_id: dict[str, int] = {}
+        self.relation_to_id: dict[str, int] = {}
+        self._buffer: np.ndarray = np.empty((capacity, 3), dtype=np.int64)
+        self._size: int = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, head: str, relation: str, tail: str) -> None:
+        if self._size == len(self._buffer):
+            self._buffer = np.resize(self._buffer, (max(2 * len(self._buffer), 1), 3))
+
+        entities = self.entity_to_id
+        self._buffer[self._size] = (
+            entities.setdefault(head, len(entities)),
+            self.relation_to_id.setdefault(relation, len(self.relation_to_id)),
+            entities.setdefault(tail, len(entities)),
+        )
+        self._size += 1
+
+    def to_triples_factory(self) -> TriplesFactory:
+        """
+        Returns a TriplesFactory of all added triples. IDs are renumbered in the order of their labels, so entities and
+        relations get the same IDs as with TriplesFactory.from_labeled_triples().
+        """
+
+        entity_to_id, entity_lookup = _sorted_vocabulary(self.entity_to_id)
+        relation_to_id, relation_lookup = _sorted_vocabulary(self.relation_to_id)
+
+        mapped_triples = self._buffer[:self._size].copy()
+        mapped_triples[:, 0] = entity_lookup[mapped_triples[:, 0]]
+        mapped_triples[:, 1] = relation_lookup[mapped_triples[:, 1]]
+        mapped_triples[:, 2] = entity_lookup[mapped_triples[:, 2]]
+        return TriplesFactory(torch.from_numpy(mapped_triples), entity_to_id=entity_to_id, relation_to_id=relation_to_id)
+
 
-    tf = TriplesFactory.from_labeled_triples(triples_array)
+def _sorted_vocabulary(label_to_id: dict[str, int]) -> tuple[dict[str, int], np.ndarray]:
+    """
+    Returns the vocabulary with IDs in the order of the labels, along with a lookup from old to new IDs.
+    """
+
+    labels = sorted(label_to_id)
+    lookup = np.empty(len(labels), dtype=np.int64)
+    lookup[[label_to_id[label] for label in labels]] = np.arange(len(labels))
+    return {label: i for i, label in enumerate(labels)}, lookup
+
+
+def generate_training_set(fact_triples: list[tuple[str, str, str]] | TripleVocabulary) -> tuple[TriplesFactory, TriplesFactory, TriplesFactory]:
+    """
+    Splits the given triples into training, validation and testing data. Triples that were streamed into a
+    TripleVocabulary are used as they are, a list of labelled triples is indexed first.
+    """
+
+    if isinstance(fact_triples, TripleVocabulary):
+        tf = fact_triples.to_triples_factory()
+    else:
+        tf = TriplesFactory.from_labeled_triples(np.array(fact_triples))
     training, validation, testing = tf.split([0.8, 0.1, 0.1], random_state=42)
 
     # Reduce data leakage between training and testing triples
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import shapely
+
+from src.components.types import ConnectionTable, ModeOfTransport, Frequency, StopTable, SubDistrict
+from src.components import geometry_store
+
+TILE_SIZE_PIXELS = 256
+INDEX_FILE_NAME = "index.json"
+
+
+class TileIndex:
+    """
+    Describes a pyramid of GeoJSON tiles written by build_tile_pyramid(): its zoom levels, the zoom level from which
+    on every stop and connection is shown individually, and which (non-empty) tiles exist on each zoom level.
+    """
+
+    def __init__(self, min_zoom: int, max_zoom: int, detail_zoom: int, tiles: dict[int, list[tuple[int, int]]], version: str):
+        self.min_zoom: int = min_zoom
+        self.max_zoom: int = max_zoom
+        self.detail_zoom: int = detail_zoom
+        self.tiles: dict[int, list[tuple[int, int]]] = tiles
+        self.version: str = version  # Hash of the content of all tiles
+
+    def __len__(self):
+        return sum(len(tiles) for tiles in self.tiles.values())
+
+    def to_json(self) -> dict:
+        return {
+            "min_zoom": self.min_zoom,
+            "max_zoom": self.max_zoom,
+            "detail_zoom": self.detail_zoom,
+            "tiles": {str(zoom): [list(tile) for tile in tiles] for zoom, tiles in self.tiles.items()},
+            "version": self.version,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "TileIndex":
+        tiles = {int(zoom): [(x, y) for x, y in tiles] for zoom, tiles in data["tiles"].items()}
+        return cls(data["min_zoom"], data["max_zoom"], data["detail_zoom"], tiles, data["version"])
+
+
+def read_tile_index(directory: str) -> TileIndex | None:
+    """
+    Returns the index of the tile pyramid in the given directory, or None if no pyramid was built there yet.
+    """
+
+    try:
+        with open(os.path.join(directory, INDEX_FILE_NAME), encoding="utf-8") as file:
+            return TileIndex.from_json(json.load(file))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def build_tile_pyramid(directory: str, stops: StopTable, connections: ConnectionTable | None = None,
+                       subdistricts: list[SubDistrict] | None = None, *,
+                       min_zoom: int = 10, max_zoom: int = 16, detail_zoom: int = 14, cell_size_pixels: int = 24) -> TileIndex:
+    """
+    Writes a pyramid of GeoJSON tiles ({zoom}/{x}/{y}.json in the XYZ tiling scheme of web maps) for the given stops,
+    connections and subdistricts to the given directory, along with an index of all tiles.
+
+    Below detail_zoom, stops are aggregated on a grid of cell_size_pixels wide cells and connections between the
+    same two cells are merged into one corridor, so the tiles of low zoom levels stay small no matter how large the
+    network is. From detail_zoom on, the tiles contain every stop (with its cluster hull) and connection. Subdistrict
+    shapes are simplified to the resolution of each zoom level along their shared boundaries, so neighbouring
+    subdistricts still fit together.
+
+    Every feature is stored in exactly one tile, namely the one of its anchor point (the position of a stop, the
+    midpoint of a connection), so a viewer has to load the tiles around the visible extent as well.
+
+    Args:
+        directory: the directory of the pyramid, where a previously built pyramid is replaced (other files are kept)
+        stops: the stops to show, where stops are shown at the position of their cluster (if any)
+        connections: the connections between the stops, or None
+        subdistricts: the subdistricts to show, or None
+    """
+
+    _remove_tile_pyramid(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    lats, lons = stops.display_lat(), stops.display_lon()
+    hulls = _cluster_hulls(stops)
+    districts = geometry_store.geometries_of(subdistricts).geometries if subdistricts else np.array([], dtype=object)
+    district_anchors = shapely.get_coordinates(shapely.point_on_surface(districts))
+
+    version = hashlib.sha256()
+    tiles: dict[int, list[tuple[int, int]]] = {}
+    for zoom in range(min_zoom, max_zoom + 1):
+        features: dict[tuple[int, int], list[dict]] = {}
+
+        def add(tile_x: int, tile_y: int, feature: dict) -> None:
+            features.setdefault((int(tile_x), int(tile_y)), []).append(feature)
+
+        if zoom >= detail_zoom:
+            _add_stops(add, zoom, stops, lats, lons, hulls)
+            if connections is not None:
+                _add_connections(add, zoom, connections, lats, lons)
+        else:
+            cells = _grid_cells(zoom, lats, lons, cell_size_pixels)
+            _add_aggregated_stops(add, zoom, stops, lats, lons, cells)
+            if connections is not None:
+                _add_corridors(add, zoom, connections, lats, lons, cells)
+
+        if len(districts):
+            simplified = geometry_store.simplified_geometries_of(subdistricts, geometry_store.tolerance_for_zoom(zoom))
+            tile_xs, tile_ys = _tile_of(zoom, district_anchors[:, 1], district_anchors[:, 0])
+            for district, geometry, tile_x, tile_y in zip(subdistricts, simplified, tile_xs, tile_ys):
+                add(tile_x, tile_y, _feature("districts", shapely.geometry.mapping(geometry), zoom, name=district.name))
+
+        tiles[zoom] = sorted(features)
+        for (tile_x, tile_y), tile_features in features.items():
+            content = json.dumps({"type": "FeatureCollection", "features": tile_features}, separators=(",", ":"))
+            version.update(f"{zoom}/{tile_x}/{tile_y}".encode())
+            version.update(content.encode())
+
+            os.makedirs(os.path.join(directory, str(zoom), str(tile_x)), exist_ok=True)
+            with open(os.path.join(directory, str(zoom), str(tile_x), f"{tile_y}.json"), "w", encoding="utf-8") as file:
+                file.write(content)
+
+    index = TileIndex(min_zoom, max_zoom, detail_zoom, tiles, version.hexdigest()[:16])
+    with open(os.path.join(directory, INDEX_FILE_NAME), "w", encoding="utf-8") as file:
+        json.dump(index.to_json(), file, separators=(",", ":"))
+    return index
+
+
+def _remove_tile_pyramid(directory: str) -> None:
+    """
+    Removes a previously built pyramid from the given directory, i.e. the zoom level directories listed in its index
+    and the index itself, leaving any other files in the directory untouched.
+    """
+
+    previous = read_tile_index(directory)
+    if previous is None:
+        return
+
+    # The index goes first, so an interrupted removal never leaves an index that points to missing tiles
+    os.remove(os.path.join(directory, INDEX_FILE_NAME))
+    for zoom in previous.tiles:
+        zoom_directory = os.path.join(directory, str(zoom))
+        if os.path.isdir(zoom_directory):
+            shutil.rmtree(zoom_directory)
+
+
+def _add_stops(add, zoom: int, stops: StopTable, lats: np.ndarray, lons: np.ndarray, hulls: dict[int, shapely.Geometry]) -> None:
+    tile_xs, tile_ys = _tile_of(zoom, lats, lons)
+    for row in range(len(stops)):
+        add(tile_xs[row], tile_ys[row], _feature(
+            "stops", {"type": "Point", "coordinates": [lons[row], lats[row]]}, zoom,
+            id=stops.ids[row], name=stops.names[row]
+        ))
+        if row in hulls:
+            add(tile_xs[row], tile_ys[row], _feature("clusters", shapely.geometry.mapping(hulls[row]), zoom))
+
+
+def _add_connections(add, zoom: int, connections: ConnectionTable, lats: np.ndarray, lons: np.ndarray) -> None:
+    names = connections.stops.names
+    from_rows, to_rows = connections.from_rows, connections.to_rows
+    tile_xs, tile_ys = _tile_of(zoom, (lats[from_rows] + lats[to_rows]) / 2, (lons[from_rows] + lons[to_rows]) / 2)
+    for i, (from_row, to_row) in enumerate(zip(from_rows, to_rows)):
+        add(tile_xs[i], tile_ys[i], _feature(
+            "connections", {"type": "LineString", "coordinates": [[lons[from_row], lats[from_row]], [lons[to_row], lats[to_row]]]}, zoom,
+            mode=ModeOfTransport(int(connections.modes[i])).name, frequency=Frequency(int(connections.frequencies[i])).name,
+            name=f"{names[from_row]} --> {names[to_row]}"
+        ))
+
+
+def _add_aggregated_stops(add, zoom: int, stops: StopTable, lats: np.ndarray, lons: np.ndarray, cells: np.ndarray) -> None:
+    """
+    Adds one point per grid cell at the mean position of the stops in that cell.
+    """
+
+    cell_ids, cell_of_stop, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    cell_lats = np.bincount(cell_of_stop, weights=lats) / counts
+    cell_lons = np.bincount(cell_of_stop, weights=lons) / counts
+    first_stop = np.full(len(cell_ids), -1)
+    first_stop[cell_of_stop[::-1]] = np.arange(len(stops))[::-1]
+
+    tile_xs, tile_ys = _tile_of(zoom, cell_lats, cell_lons)
+    for cell in range(len(cell_ids)):
+        count = int(counts[cell])
+        name = stops.names[first_stop[cell]] if count == 1 else f"{stops.names[first_stop[cell]]} and {count - 1} more stops"
+        add(tile_xs[cell], tile_ys[cell], _feature(
+            "stops", {"type": "Point", "coordinates": [cell_lons[cell], cell_lats[cell]]}, zoom, name=name, count=count
+        ))
+
+
+def _add_corridors(add, zoom: int, connections: ConnectionTable, lats: np.ndarray, lons: np.ndarray, cells: np.ndarray) -> None:
+    """
+    Merges all connections of the same mode of transport and frequency between the same two grid cells into a single
+    line between the mean positions of the stops in these cells.
+    """
+
+    cell_ids, cell_of_stop, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    cell_lats = np.bincount(cell_of_stop, weights=lats) / counts
+    cell_lons = np.bincount(cell_of_stop, weights=lons) / counts
+
+    from_cells, to_cells = cell_of_stop[connections.from_rows], cell_of_stop[connections.to_rows]
+    keep = from_cells != to_cells  # Connections within a cell are not visible on this zoom level
+    corridors = np.column_stack([
+        np.minimum(from_cells, to_cells)[keep], np.maximum(from_cells, to_cells)[keep],
+        connections.modes[keep], connections.frequencies[keep]
+    ])
+    corridors, corridor_counts = np.unique(corridors, axis=0, return_counts=True)
+
+    from_cells, to_cells = corridors[:, 0], corridors[:, 1]
+    tile_xs, tile_ys = _tile_of(zoom, (cell_lats[from_cells] + cell_lats[to_cells]) / 2, (cell_lons[from_cells] + cell_lons[to_cells]) / 2)
+    for i, (from_cell, to_cell, mode, frequency) in enumerate(corridors):
+        count = int(corridor_counts[i])
+        add(tile_xs[i], tile_ys[i], _feature(
+            "connections", {"type": "LineString", "coordinates": [[cell_lons[from_cell], cell_lats[from_cell]], [cell_lons[to_cell], cell_lats[to_cell]]]}, zoom,
+            mode=ModeOfTransport(int(mode)).name, frequency=Frequency(int(frequency)).name,
+            name=f"{count} connection{'s' if count != 1 else ''}", count=count
+        ))
+
+
+def _cluster_hulls(stops: StopTable) -> dict[int, shapely.Geometry]:
+    """
+    Returns the hull polygon of every cluster by the row of its root.
+    """
+
+    return {row: shapely.polygons(outline[:, ::-1]) for row, outline in geometry_store.cluster_outlines(stops).items()}
+
+
+def _grid_cells(zoom: int, lats: np.ndarray, lons: np.ndarray, cell_size_pixels: int) -> np.ndarray:
+    """
+    Returns the ID of the grid cell of every position, for square cells of cell_size_pixels at the given zoom level.
+    """
+
+    x, y = _world_pixels(zoom, lats, lons)
+    cells_per_row = int(np.ceil(TILE_SIZE_PIXELS * 2 ** zoom / cell_size_pixels))
+    return (y // cell_size_pixels).astype(np.int64) * cells_per_row + (x // cell_size_pixels).astype(np.int64)
+
+
+def _tile_of(zoom: int, lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    x, y = _world_pixels(zoom, lats, lons)
+    return (x // TILE_SIZE_PIXELS).astype(np.int64), (y // TILE_SIZE_PIXELS).astype(np.int64)
+
+
+def _world_pixels(zoom: int, lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Projects WGS84 positions to pixel coordinates of the web mercator world map at the given zoom level.
+    """
+
+    world_size = TILE_SIZE_PIXELS * 2 ** zoom
+    lat_radians = np.radians(np.clip(lats, -85.0511, 85.0511))
+    x = (np.asarray(lons) + 180) / 360 * world_size
+    y = (1 - np.log(np.tan(lat_radians) + 1 / np.cos(lat_radians)) / np.pi) / 2 * world_size
+    return np.clip(x, 0, world_size - 1), np.clip(y, 0, world_size - 1)
+
+
+def _feature(layer: str, geometry: dict, zoom: int, **properties) -> dict:
+    # Round coordinates to the precision that is still visible at the zoom level (six decimals are about 10 cm)
+    decimals = 6 if zoom >= 14 else 5
+    geometry = {"type": geometry["type"], "coordinates": _round(geometry["coordinates"], decimals)}
+    properties = {key: value.item() if isinstance(value, np.generic) else value for key, value in properties.items()}
+    return {"type": "Feature", "geometry": geometry, "properties": {"layer": layer, **properties}}
+
+
+def _round(coordinates, decimals: int):
+    if isinstance(coordinates, (list, tuple)):
+        return [_round(coordinate, decimals) for coordinate in coordinates]
+    return round(float(coordinates), decimals)
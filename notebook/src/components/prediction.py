@@ -6,7 +6,8 @@ from pykeen.models import Model
 from pykeen.predict import predict_triples, predict_target, Predictions
 from pykeen.triples import TriplesFactory
 
-from src.components.types import Stop, ModeOfTransport, Frequency, parse_mode_of_transport, parse_frequency, Connection
+from src.components.types import Stop, ModeOfTransport, Frequency, parse_mode_of_transport, parse_frequency, Connection, \
+    StopTable, ConnectionTable
 
 
 class PredictionMachine:
@@ -96,4 +97,7 @@ def create_connections(connection_triples: list[tuple[str,str,str]], stops_by_id
 
         connections.append(Connection(from_stop, to_stop, mode_of_transport, frequency))
 
-    return connections
\ No newline at end of file
+    return connections
+
+def create_connection_table(connection_triples: list[tuple[str,str,str]], stops: StopTable) -> ConnectionTable:
+    return ConnectionTable.from_triples(connection_triples, stops)
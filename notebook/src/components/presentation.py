@@ -1,15 +1,117 @@
+import gzip
+import hashlib
 import html
 import io
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
 from contextlib import contextmanager, redirect_stdout
 from enum import Flag, auto
-from typing import Callable, Any, Literal
+from typing import Callable, Any, Iterator, Literal
 
 import folium
+from branca.element import MacroElement
+from folium.utilities import JsCode
+from jinja2 import Template
 import marimo as mo
-from shapely import MultiPoint, wkt
+import numpy as np
+import pandas as pd
 
 from components.types import SubDistrict
-from src.components.types import Stop, ClusterStop, Connection, ModeOfTransport, Frequency
+from src.components import geometry_store
+from src.components.map_tiles import TileIndex
+from src.components.types import Stop, ClusterStop, Connection, ModeOfTransport, Frequency, StopTable, ConnectionTable, BoundingBox
+
+DEFAULT_MIN_UPDATE_INTERVAL = 0.1  # seconds between two renders of a code output area
+DEFAULT_MAX_LINES = 1000  # lines shown in a code output area before older ones are collapsed
+
+
+class MapHtmlCache:
+    """
+    Size-bounded LRU cache for the HTML of rendered maps, keyed by a hash of everything that was drawn on them.
+
+    If a directory is given, rendered maps are additionally stored there (gzip-compressed) and served from disk
+    when they dropped out of memory or were rendered in an earlier session.
+    """
+
+    def __init__(self, max_entries: int = 16, directory: str | None = None):
+        self.max_entries: int = max_entries
+        self.directory: str | None = directory
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        html_content = self._entries.get(key)
+        if html_content is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return html_content
+
+        if self.directory is not None:
+            try:
+                with gzip.open(self._path_of(key), "rt", encoding="utf-8") as file:
+                    html_content = file.read()
+            except (OSError, EOFError):
+                html_content = None
+            if html_content is not None:
+                self.disk_hits += 1
+                self._remember(key, html_content)
+                return html_content
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, html_content: str) -> None:
+        self._remember(key, html_content)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first, such that a concurrent reader never sees a partial map
+            temporary_path = f"{self._path_of(key)}.{os.getpid()}.tmp"
+            with gzip.open(temporary_path, "wt", encoding="utf-8", compresslevel=5) as file:
+                file.write(html_content)
+            os.replace(temporary_path, self._path_of(key))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for file_name in os.listdir(self.directory):
+                if file_name.endswith(".html.gz"):
+                    os.remove(os.path.join(self.directory, file_name))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key: str, html_content: str) -> None:
+        self._entries[key] = html_content
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)  # Evict the least recently used map
+
+    def _path_of(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.html.gz")
+
+map_cache = MapHtmlCache()
+
+
+def map_cache_statistics() -> pd.DataFrame:
+    """
+    Summarizes the usage of the cache for rendered maps.
+    """
+
+    lookups = map_cache.hits + map_cache.disk_hits + map_cache.misses
+    return pd.DataFrame([{
+        "entries": len(map_cache),
+        "max_entries": map_cache.max_entries,
+        "hits": map_cache.hits,
+        "disk_hits": map_cache.disk_hits,
+        "misses": map_cache.misses,
+        "hit_rate": (map_cache.hits + map_cache.disk_hits) / lookups if lookups else 0.0,
+    }])
 
 
 # noinspection PyTypeChecker
@@ -38,16 +140,61 @@ class TransportMap:
         Frequency.UNKNOWN: "#7a7671",
     }
 
+    connection_thickness: dict[ModeOfTransport, int] = {
+        ModeOfTransport.SUBWAY: 3,
+        ModeOfTransport.TRAM: 2,
+        ModeOfTransport.BUS: 1,
+    }
+
+    frequency_thickness: dict[Frequency, int] = {
+        Frequency.NONSTOP_TO: 3,
+        Frequency.VERY_FREQUENTLY_TO: 3,
+        Frequency.FREQUENTLY_TO: 2,
+        Frequency.REGULARLY_TO: 2,
+    }
+
     # noinspection PyTypeChecker
     def __init__(self, lat: float, lon: float, zoom: int, *,
                  name: str = None, custom_tile_source: str = None, custom_attribution: str = None,
-                 visible_layers: VisibleLayers = VisibleLayers.STOPS | VisibleLayers.CLUSTERS):
+                 visible_layers: VisibleLayers = VisibleLayers.STOPS | VisibleLayers.CLUSTERS,
+                 renderer: Literal["markers", "geojson"] = "markers", cache: MapHtmlCache | None = map_cache,
+                 viewport_margin: float | None = None, viewport_size: tuple[int, int] = (1000, 650)):
+        # With the "geojson" renderer, every layer is emitted as a single GeoJSON FeatureCollection that is styled by
+        # its feature properties and drawn on a canvas, instead of one folium object per marker
+        self.renderer = renderer
+        self.zoom = zoom
+
+        # In viewport mode, the map only covers the initially visible extent (of a map of viewport_size pixels) plus
+        # the given margin on every side, which is the extent to query the data for (see the viewport attribute)
+        self.viewport: BoundingBox | None = None
+        viewport_options = {}
+        if viewport_margin is not None:
+            self.viewport = _visible_extent(lat, lon, zoom, *viewport_size).expanded(viewport_margin)
+            viewport_options = dict(
+                max_bounds=True, min_lat=self.viewport.south, max_lat=self.viewport.north,
+                min_lon=self.viewport.west, max_lon=self.viewport.east, max_bounds_viscosity=1.0,
+            )
+        self._features: dict[str, list[dict]] = {"stops": [], "clusters": [], "nodes": [], "connections": [], "districts": []}
+
+        # Everything added to the map is only drawn once as_html() misses the cache. Until then, the added data is
+        # recorded and hashed, such that the same map is never drawn and serialized twice.
+        self.cache = cache
+        self._draws: list[tuple[Callable, tuple]] = []
+        self._digest = hashlib.sha256()
+        _update_digest(self._digest, "map", folium.__version__, lat, lon, zoom, name, custom_tile_source,
+                       custom_attribution, visible_layers.value, renderer, viewport_options)
+
         # Create a folium map centered on the mean of the coordinates
         self.base = folium.Map(
             tiles=None,
             location=[lat, lon],
             zoom_start=zoom,
+            prefer_canvas=(renderer == "geojson"),
+            **viewport_options,
         )
+        if viewport_margin is not None:
+            # Do not zoom out further than the margin can fill (folium only passes min_zoom on to its default tiles)
+            self.base.options["min_zoom"] = max(0, zoom - int(math.log2(1 + 2 * viewport_margin)))
 
         # Add map as base layer
         if custom_tile_source:
@@ -80,33 +227,36 @@ class TransportMap:
         folium.map.CustomPane("districts", z_index=400).add_to(self.base)
 
 
-    def add_stops(self, stops: list[Stop]) -> None:
+    def add_stops(self, stops: list[Stop] | StopTable) -> None:
+        _update_digest(self._digest, "stops", *_stop_digest_values(stops))
+        self._draws.append((self._draw_stops, (stops,)))
+
+    def _draw_stops(self, stops: list[Stop] | StopTable) -> None:
         # Add markers for each stop
-        for stop in stops:
+        for stop_id, name, lat, lon, hull_points in _stop_rows(stops):
+            if self.renderer == "geojson":
+                self._features["stops"].append(_feature("Point", [_round(lon), _round(lat)], id=stop_id, name=name))
+                if hull_points is not None:
+                    self._features["clusters"].append(_feature("Polygon", [[[_round(lon), _round(lat)] for lat, lon in hull_points]]))
+                continue
+
             # Add a small circle for a stop
             folium.CircleMarker(
-                location=[stop.lat, stop.lon],
+                location=[lat, lon],
                 radius=2,
                 color="red",
                 fill=True,
                 fill_opacity=0.4,
                 opacity=0.6,
-                tooltip=stop.name,
-                popup=stop.id,
+                tooltip=name,
+                popup=stop_id,
                 pane="stops"
             ).add_to(self.stop_marks)
 
             # Additionally, add a big translucent circle for a cluster
-            if isinstance(stop, ClusterStop):
-                # Compute convex hull
-                cluster_hull = MultiPoint(stop.cluster_points).convex_hull
-                # Grow the polygon by a very small buffer zone
-                # This is especially important for two-point clusters (thick line)
-                buffered_hull = cluster_hull.buffer(0.00004, cap_style="round", join_style="round")
-                hull_points = [(lat, lon) for lat, lon in buffered_hull.exterior.coords]
-
+            if hull_points is not None:
                 folium.Polygon(
-                    locations=hull_points,
+                    locations=hull_points.tolist(),
                     color="violet",
                     weight=1,
                     fill=True,
@@ -116,43 +266,62 @@ class TransportMap:
                     interactive=False
                 ).add_to(self.cluster_marks)
 
-    def add_transit_nodes(self, nodes: list[Stop]) -> None:
-        for node in nodes:
+    def add_transit_nodes(self, nodes: list[Stop] | StopTable) -> None:
+        _update_digest(self._digest, "nodes", *_stop_digest_values(nodes))
+        self._draws.append((self._draw_transit_nodes, (nodes,)))
+
+    def _draw_transit_nodes(self, nodes: list[Stop] | StopTable) -> None:
+        if isinstance(nodes, StopTable):
+            rows = zip(nodes.ids, nodes.names, nodes.display_lat(), nodes.display_lon())
+        else:
+            rows = ((node.id, node.name, node.display_lat(), node.display_lon()) for node in nodes)
+
+        for node_id, name, lat, lon in rows:
+            if self.renderer == "geojson":
+                self._features["nodes"].append(_feature("Point", [_round(lon), _round(lat)], id=node_id, name=name))
+                continue
+
             folium.CircleMarker(
-                location=[node.display_lat(), node.display_lon()],
+                location=[lat, lon],
                 radius=1,
                 color="#222222",
                 opacity=0.55,
                 fill=True,
                 fill_opacity=0.55,
-                tooltip=node.name,
-                popup=node.id,
+                tooltip=name,
+                popup=node_id,
                 pane="stops"
             ).add_to(self.stop_marks)
 
-    def add_transit_connections(self, connections: list[Connection], include_nodes = False, uniform_thickness: int | None = None) -> None:
-        for conn in connections:
+    def add_transit_connections(self, connections: list[Connection] | ConnectionTable, include_nodes = False, uniform_thickness: int | None = None) -> None:
+        _update_digest(self._digest, "connections", include_nodes, uniform_thickness, *_connection_digest_values(connections))
+        self._draws.append((self._draw_transit_connections, (connections, include_nodes, uniform_thickness)))
+
+    def _draw_transit_connections(self, connections: list[Connection] | ConnectionTable, include_nodes: bool, uniform_thickness: int | None) -> None:
+        for from_lat, from_lon, to_lat, to_lon, mode_of_transport, frequency, tooltip in _connection_rows(connections):
+            if mode_of_transport != ModeOfTransport.ANY:
+                thickness = uniform_thickness if uniform_thickness else self.connection_thickness.get(mode_of_transport, 1)
+            else:
+                thickness = uniform_thickness if uniform_thickness else self.frequency_thickness.get(frequency, 1)
+
+            if self.renderer == "geojson":
+                # The colour is derived from the mode/frequency in the browser (see _add_geojson_layers())
+                self._features["connections"].append(_feature(
+                    "LineString", [[_round(from_lon), _round(from_lat)], [_round(to_lon), _round(to_lat)]],
+                    mode=mode_of_transport.name, frequency=frequency.name, thickness=thickness, name=tooltip
+                ))
+                continue
+
             line_coords = [
-                [conn.from_stop.display_lat(), conn.from_stop.display_lon()],
-                [conn.to_stop.display_lat(), conn.to_stop.display_lon()]
+                [from_lat, from_lon],
+                [to_lat, to_lon]
             ]
 
-            if conn.mode_of_transport != ModeOfTransport.ANY:
-                colour = self.connection_colours[conn.mode_of_transport]
-                thickness = uniform_thickness if uniform_thickness else {
-                    ModeOfTransport.SUBWAY: 3,
-                    ModeOfTransport.TRAM: 2,
-                    ModeOfTransport.BUS: 1
-                }.get(conn.mode_of_transport, 1)
+            if mode_of_transport != ModeOfTransport.ANY:
+                colour = self.connection_colours[mode_of_transport]
                 opacity = 0.7
             else:
-                colour = self.frequency_colours[conn.frequency]
-                thickness = uniform_thickness if uniform_thickness else {
-                    Frequency.NONSTOP_TO: 3,
-                    Frequency.VERY_FREQUENTLY_TO: 3,
-                    Frequency.FREQUENTLY_TO: 2,
-                    Frequency.REGULARLY_TO: 2
-                }.get(conn.frequency, 1)
+                colour = self.frequency_colours[frequency]
                 opacity = 0.85
 
             # Add the line to the map
@@ -161,17 +330,34 @@ class TransportMap:
                 color=colour,
                 weight=thickness,
                 opacity=opacity,
-                tooltip=str(conn),
+                tooltip=tooltip,
                 pane="connections"
             ).add_to(self.connections)
 
-            if include_nodes:
-                self.add_transit_nodes([conn.from_stop, conn.to_stop])
+        if include_nodes:
+            if isinstance(connections, ConnectionTable):
+                self._draw_transit_nodes(connections.stops.take(np.unique(np.concatenate([connections.from_rows, connections.to_rows]))))
+            else:
+                for conn in connections:
+                    self._draw_transit_nodes([conn.from_stop, conn.to_stop])
 
     def add_subdistricts(self, subdistricts: list[SubDistrict], visible=True) -> None:
-        for district in subdistricts:
-            # Get the coordinates of the subdistricts outline from its WKT shape
-            geometry = wkt.loads(district.shape)
+        _update_digest(self._digest, "districts", visible, *((district.id, district.shape) for district in subdistricts))
+        self._draws.append((self._draw_subdistricts, (subdistricts, visible)))
+
+    def _draw_subdistricts(self, subdistricts: list[SubDistrict], visible: bool) -> None:
+        # Survey-grade shapes have far more vertices than visible, so use the coarsest simplification that looks the
+        # same at the zoom level of the map
+        tolerance = geometry_store.tolerance_for_zoom(self.zoom)
+        geometries = geometry_store.simplified_geometries_of(subdistricts, tolerance)
+        for district, geometry in zip(subdistricts, geometries):
+            if self.renderer == "geojson":
+                self._features["districts"].append(_feature(
+                    "Polygon", [[[_round(lon), _round(lat)] for lon, lat in geometry.exterior.coords]], name=district.name
+                ))
+                continue
+
+            # Get the coordinates of the subdistricts outline from its (parsed) WKT shape
             coords = [(lat, lon) for lon, lat in geometry.exterior.coords]
 
             # Create a polygon on the map
@@ -190,7 +376,31 @@ class TransportMap:
         self.subdistricts.control = visible
         self.subdistricts.show = visible
 
+    def add_tile_pyramid(self, tile_url: str, index: TileIndex) -> None:
+        """
+        Shows the content of a tile pyramid written by map_tiles.build_tile_pyramid(), which is served as static
+        files from tile_url (e.g. "public/map_tiles" for the public directory of the notebook). Instead of embedding
+        the data into the map, the browser only loads the tiles around the visible extent of the current zoom level.
+        """
+
+        _update_digest(self._digest, "tiles", tile_url, index.version)
+        self._draws.append((self._draw_tile_pyramid, (tile_url, index)))
+
+    def _draw_tile_pyramid(self, tile_url: str, index: TileIndex) -> None:
+        _TileLoader(
+            tile_url, index,
+            layers={"stops": self.stop_marks, "clusters": self.cluster_marks, "connections": self.connections, "districts": self.subdistricts},
+            colours={mode.name: colour for mode, colour in self.connection_colours.items()}
+                    | {frequency.name: colour for frequency, colour in self.frequency_colours.items()},
+            thickness={mode.name: thickness for mode, thickness in self.connection_thickness.items()}
+                      | {frequency.name: thickness for frequency, thickness in self.frequency_thickness.items()},
+        ).add_to(self.base)
+
     def add_legend(self, title: str, entries: list[tuple[str, str]]):
+        _update_digest(self._digest, "legend", title, *entries)
+        self._draws.append((self._draw_legend, (title, entries)))
+
+    def _draw_legend(self, title: str, entries: list[tuple[str, str]]):
         legend_html = self._create_color_map_legend(title, entries)
         self.base.get_root().html.add_child(folium.Element(legend_html))
 
@@ -198,7 +408,69 @@ class TransportMap:
         # Save the map to an HTML file
         # self.base.save("stops_map.html")
 
-        return self.base._repr_html_()
+        key = self._digest.hexdigest()
+        if self.cache is not None:
+            cached_html = self.cache.get(key)
+            if cached_html is not None:
+                return cached_html
+
+        for draw, args in self._draws:
+            draw(*args)
+        self._draws = []
+
+        if self.renderer == "geojson":
+            self._add_geojson_layers()
+        map_html = self.base._repr_html_()
+
+        if self.cache is not None:
+            self.cache.put(key, map_html)
+        return map_html
+
+    def _add_geojson_layers(self) -> None:
+        """
+        Adds one GeoJSON layer for all features collected for each layer so far.
+        """
+
+        mode_colours = json.dumps({mode.name: colour for mode, colour in self.connection_colours.items()})
+        frequency_colours = json.dumps({frequency.name: colour for frequency, colour in self.frequency_colours.items()})
+        layers = {
+            "districts": (self.subdistricts, dict(
+                pane="districts", interactive=False,
+                style=JsCode("function() { return {color: 'green', weight: 1, fill: true, fillOpacity: 0.15, opacity: 0.3}; }"),
+            )),
+            "clusters": (self.cluster_marks, dict(
+                pane="clusters", interactive=False,
+                style=JsCode("function() { return {color: 'violet', weight: 1, fill: true, fillOpacity: 0.35, opacity: 0.5}; }"),
+            )),
+            "connections": (self.connections, dict(
+                pane="connections", tooltip=folium.GeoJsonTooltip(fields=["name"], labels=False),
+                style=JsCode(f"""function(feature) {{
+                    const modeColours = {mode_colours}, frequencyColours = {frequency_colours};
+                    const p = feature.properties, byMode = p.mode !== 'ANY';
+                    return {{color: byMode ? modeColours[p.mode] : frequencyColours[p.frequency],
+                             weight: p.thickness, opacity: byMode ? 0.7 : 0.85}};
+                }}"""),
+            )),
+            "stops": (self.stop_marks, dict(
+                pane="stops", tooltip=folium.GeoJsonTooltip(fields=["name"], labels=False),
+                popup=folium.GeoJsonPopup(fields=["id"], labels=False),
+                pointToLayer=JsCode("""function(feature, latlng) {
+                    return L.circleMarker(latlng, {radius: 2, color: 'red', fill: true, fillOpacity: 0.4, opacity: 0.6, pane: 'stops'});
+                }"""),
+            )),
+            "nodes": (self.stop_marks, dict(
+                pane="stops", tooltip=folium.GeoJsonTooltip(fields=["name"], labels=False),
+                popup=folium.GeoJsonPopup(fields=["id"], labels=False),
+                pointToLayer=JsCode("""function(feature, latlng) {
+                    return L.circleMarker(latlng, {radius: 1, color: '#222222', fill: true, fillOpacity: 0.55, opacity: 0.55, pane: 'stops'});
+                }"""),
+            )),
+        }
+
+        for layer, (feature_group, options) in layers.items():
+            if self._features[layer]:
+                folium.GeoJson({"type": "FeatureCollection", "features": self._features[layer]}, **options).add_to(feature_group)
+                self._features[layer] = []
 
     @staticmethod
     def _create_color_map_legend(title: str, entries: list[tuple[str, str]]) -> str:
@@ -259,9 +531,195 @@ class TransportMap:
         '''
 
 
+class _TileLoader(MacroElement):
+    """
+    Loads the tiles of a tile pyramid around the visible extent of a map whenever it is moved or zoomed, and drops
+    the tiles that went out of view. Features are styled the same way as by the "geojson" renderer.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            const map = {{ this._parent.get_name() }};
+            const index = {{ this.index|tojson }}, tileUrl = {{ this.tile_url|tojson }};
+            const colours = {{ this.colours|tojson }}, thickness = {{ this.thickness|tojson }};
+            const layers = { {% for layer, group in this.layers.items() %}{{ layer|tojson }}: {{ group.get_name() }}, {% endfor %} };
+            const available = new Set();
+            for (const [zoom, tiles] of Object.entries(index.tiles)) {
+                for (const [x, y] of tiles) available.add(`${zoom}/${x}/${y}`);
+            }
+
+            const options = {
+                districts: {pane: 'districts', interactive: false,
+                            style: () => ({color: 'green', weight: 1, fill: true, fillOpacity: 0.15, opacity: 0.3})},
+                clusters: {pane: 'clusters', interactive: false,
+                           style: () => ({color: 'violet', weight: 1, fill: true, fillOpacity: 0.35, opacity: 0.5})},
+                connections: {pane: 'connections', style: feature => {
+                    const p = feature.properties, byMode = p.mode !== 'ANY', key = byMode ? p.mode : p.frequency;
+                    return {color: colours[key], weight: thickness[key] || 1, opacity: byMode ? 0.7 : 0.85};
+                }},
+                stops: {pane: 'stops', pointToLayer: (feature, latlng) => L.circleMarker(latlng, {
+                    radius: feature.properties.count ? Math.min(2 + Math.sqrt(feature.properties.count - 1), 7) : 2,
+                    color: 'red', fill: true, fillOpacity: 0.4, opacity: 0.6, pane: 'stops'
+                })},
+            };
+            const bindLabels = (feature, layer) => {
+                if (feature.properties.name) layer.bindTooltip(feature.properties.name);
+                if (feature.properties.id) layer.bindPopup(feature.properties.id);
+            };
+
+            const loaded = new Map();  // "zoom/x/y" -> the GeoJSON layers of the tile
+            function update() {
+                const zoom = Math.max(index.min_zoom, Math.min(index.max_zoom, Math.round(map.getZoom())));
+                const size = 2 ** zoom, bounds = map.getBounds();
+                const tileX = lon => Math.floor((lon + 180) / 360 * size);
+                const tileY = lat => {
+                    const radians = Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180;
+                    return Math.floor((1 - Math.log(Math.tan(radians) + 1 / Math.cos(radians)) / Math.PI) / 2 * size);
+                };
+
+                // Features are stored in the tile of their anchor point, so also load one ring of tiles around the view
+                const wanted = new Set();
+                for (let x = tileX(bounds.getWest()) - 1; x <= tileX(bounds.getEast()) + 1; x++) {
+                    for (let y = tileY(bounds.getNorth()) - 1; y <= tileY(bounds.getSouth()) + 1; y++) {
+                        const key = `${zoom}/${x}/${y}`;
+                        if (available.has(key)) wanted.add(key);
+                    }
+                }
+
+                for (const [key, tileLayers] of loaded) {
+                    if (!wanted.has(key)) {
+                        tileLayers.forEach(layer => layer.remove());
+                        loaded.delete(key);
+                    }
+                }
+                for (const key of wanted) {
+                    if (loaded.has(key)) continue;
+                    const tileLayers = [];
+                    loaded.set(key, tileLayers);
+                    fetch(`${tileUrl}/${key}.json?v=${index.version}`)
+                        .then(response => response.json())
+                        .then(collection => {
+                            if (loaded.get(key) !== tileLayers) return;  // Went out of view in the meantime
+                            for (const [layer, group] of Object.entries(layers)) {
+                                const features = collection.features.filter(feature => feature.properties.layer === layer);
+                                if (features.length === 0) continue;
+                                const geoJson = L.geoJSON(features, {...options[layer], onEachFeature: bindLabels});
+                                tileLayers.push(geoJson.addTo(group));
+                            }
+                        })
+                        .catch(error => console.warn(`Could not load map tile ${key}`, error));
+                }
+            }
+
+            map.on('moveend', update);
+            update();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, tile_url: str, index: TileIndex, layers: dict[str, folium.FeatureGroup], colours: dict[str, str], thickness: dict[str, int]):
+        super().__init__()
+        self._name = "TileLoader"
+        self.tile_url = tile_url.rstrip("/")
+        self.index = index.to_json()
+        self.layers = layers
+        self.colours = colours
+        self.thickness = thickness
+
+
+def _feature(geometry_type: str, coordinates: list, **properties) -> dict:
+    return {"type": "Feature", "geometry": {"type": geometry_type, "coordinates": coordinates}, "properties": properties}
+
+def _round(coordinate: float) -> float:
+    # Six decimal places are still accurate to about 10 cm and keep the GeoJSON compact
+    return round(float(coordinate), 6)
+
+def _visible_extent(lat: float, lon: float, zoom: int, width_pixels: int, height_pixels: int) -> BoundingBox:
+    """
+    Returns the extent that a web mercator map of the given size shows around the given center at the given zoom level.
+    """
+
+    world_size = 256 * 2 ** zoom
+    center_y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2 * world_size
+    lat_at = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world_size))))
+    half_width_degrees = width_pixels / 2 * 360 / world_size
+    return BoundingBox(lat_at(center_y + height_pixels / 2), lon - half_width_degrees,
+                       lat_at(center_y - height_pixels / 2), lon + half_width_degrees)
+
+def _stop_rows(stops: list[Stop] | StopTable) -> Iterator[tuple[str, str, float, float, np.ndarray | None]]:
+    """
+    Yields (id, name, lat, lon, hull outline or None) for every stop, where only cluster roots have a hull outline
+    of (lat, lon) points.
+    """
+
+    if not isinstance(stops, StopTable):
+        stops = StopTable.from_stops(stops)
+
+    outlines = geometry_store.cluster_outlines(stops)
+    for row in range(len(stops)):
+        yield stops.ids[row], stops.names[row], stops.lat[row], stops.lon[row], outlines.get(row)
+
+def _update_digest(digest: "hashlib._Hash", *values: Any) -> None:
+    for value in values:
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            digest.update(str(value.dtype).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, np.ndarray):
+            digest.update("\x1f".join(map(str, value)).encode())
+        else:
+            digest.update(repr(value).encode())
+        digest.update(b"\x1e")
+
+def _stop_digest_values(stops: list[Stop] | StopTable) -> Iterator[Any]:
+    """
+    Yields everything about the given stops that ends up on a map, as input to _update_digest().
+    """
+
+    if isinstance(stops, StopTable):
+        yield from (stops.ids, stops.names, stops.lat, stops.lon, stops.is_root, stops.cluster_lat, stops.cluster_lon,
+                    stops.cluster_point_offsets, stops.cluster_points, stops.cluster_hulls)
+    else:
+        for stop in stops:
+            if isinstance(stop, ClusterStop):
+                yield stop.id, stop.name, stop.lat, stop.lon, stop.display_lat(), stop.display_lon(), stop.cluster_points, stop.cluster_hull
+            else:
+                yield stop.id, stop.name, stop.lat, stop.lon
+
+def _connection_digest_values(connections: list[Connection] | ConnectionTable) -> Iterator[Any]:
+    if isinstance(connections, ConnectionTable):
+        yield from _stop_digest_values(connections.stops)
+        yield from (connections.from_rows, connections.to_rows, connections.modes, connections.frequencies)
+    else:
+        for conn in connections:
+            yield from _stop_digest_values([conn.from_stop, conn.to_stop])
+            yield conn.mode_of_transport, conn.frequency
+
+def _connection_rows(connections: list[Connection] | ConnectionTable) -> Iterator[tuple[float, float, float, float, ModeOfTransport, Frequency, str]]:
+    """
+    Yields (from lat, from lon, to lat, to lon, mode of transport, frequency, tooltip) for every connection.
+    """
+
+    if isinstance(connections, ConnectionTable):
+        stops = connections.stops
+        lat, lon = stops.display_lat(), stops.display_lon()
+        for from_row, to_row, mode, frequency in zip(connections.from_rows, connections.to_rows, connections.modes, connections.frequencies):
+            yield (lat[from_row], lon[from_row], lat[to_row], lon[to_row], ModeOfTransport(int(mode)),
+                   Frequency(int(frequency)), f"{stops.names[from_row]} --> {stops.names[to_row]}")
+    else:
+        for conn in connections:
+            yield (conn.from_stop.display_lat(), conn.from_stop.display_lon(), conn.to_stop.display_lat(),
+                   conn.to_stop.display_lon(), conn.mode_of_transport, conn.frequency, str(conn))
+
+
 class MarimoHtmlOutput(io.StringIO):
     """
     Captures stdout and streams it to marimo through marimo.output as an HTML object.
+
+    Every line is escaped only once when it completes, and the output area is re-rendered at most once every
+    min_update_interval seconds (and always on flush), so chatty tasks do not pay for their own logging. Writes that
+    arrive within that interval are rendered by a deferred update at its end, so the last line before a long-running
+    call still shows up in time. Only the last max_lines lines are kept, older ones are collapsed into a single line.
     """
 
     Container_Html_Template: str = """
@@ -271,17 +729,30 @@ class MarimoHtmlOutput(io.StringIO):
     """
 
     Line_Html_Template: str = """
-    <li class={line_class}>{content}</li>
+    <li class="{line_class}">{content}</li>
     """
 
-    def __init__(self, container_css_class="code-output-area", line_css_class="code-output-line"):
+    def __init__(self, container_css_class="code-output-area", line_css_class="code-output-line",
+                 min_update_interval: float = DEFAULT_MIN_UPDATE_INTERVAL, max_lines: int | None = DEFAULT_MAX_LINES):
         super().__init__()
         self.container_css_class = container_css_class
         self.line_css_class = line_css_class
-        self.lines = []
+        self.min_update_interval = min_update_interval
+        self.max_lines = max_lines
+        self.lines: deque[str] = deque(maxlen=max_lines)  # The last max_lines complete lines
+        self.line_count = 0  # Number of complete lines written so far, including the ones no longer kept
         self.current_line = ""  # Buffer for incomplete lines
+        self._html_lines: deque[str] = deque(maxlen=max_lines)  # Escaped HTML of the last max_lines complete lines
+        self._last_update = -math.inf
+        self._is_dirty = False
+        self._is_update_scheduled = False
+        self._lock = threading.RLock()  # Guards the output state against the deferred update thread
 
     def write(self, text):
+        with self._lock:
+            return self._write(text)
+
+    def _write(self, text):
         # Extend the current line by the newly arrived text
         self.current_line += text
 
@@ -292,24 +763,54 @@ class MarimoHtmlOutput(io.StringIO):
         self.current_line = parts[-1]
 
         self.lines.extend(complete_lines)
+        self.line_count += len(complete_lines)
+        self._html_lines.extend(
+            self.Line_Html_Template.format(line_class=self.line_css_class, content=html.escape(line))
+            for line in complete_lines
+        )
+        self._is_dirty = True
         self._update_html()
 
         return len(text)
 
     def flush(self):
-        # If there's remaining content in current_line, treat it as a complete line
-        if self.current_line:
-            self.lines.append(self.current_line)
-            self.current_line = ""
-            self._update_html()
+        with self._lock:
+            # If there's remaining content in current_line, treat it as a complete line
+            if self.current_line:
+                self.lines.append(self.current_line)
+                self.line_count += 1
+                self._html_lines.append(
+                    self.Line_Html_Template.format(line_class=self.line_css_class, content=html.escape(self.current_line))
+                )
+                self.current_line = ""
+                self._is_dirty = True
+            if self._is_dirty:
+                self._update_html(force=True)
+
+    def _update_html(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_update < self.min_update_interval:
+            # Coalesced into a deferred update at the end of the interval, unless one is already on its way
+            if not self._is_update_scheduled:
+                self._is_update_scheduled = True
+                delay = self.min_update_interval - (now - self._last_update)
+                # mo.Thread carries over the cell's output context, so the deferred update lands in the same cell
+                mo.Thread(target=self._deferred_update, args=(delay,), daemon=True).start()
+            return
+        self._last_update = now
+        self._is_dirty = False
 
-    def _update_html(self):
         html_lines = []
 
-        # Complete lines
-        for line in self.lines:
-            html_line = self.Line_Html_Template.format(line_class=self.line_css_class, content=html.escape(line))
-            html_lines.append(html_line)
+        # Lines that dropped out of the retained ones
+        hidden_lines = self.line_count - len(self._html_lines)
+        if hidden_lines > 0:
+            html_lines.append(self.Line_Html_Template.format(
+                line_class=f"{self.line_css_class} hidden-lines",
+                content=f"… {hidden_lines} earlier line{'s' if hidden_lines != 1 else ''} hidden"
+            ))
+
+        html_lines.extend(self._html_lines)
 
         # Add current incomplete line if it exists (for real-time feedback)
         if self.current_line:
@@ -326,8 +827,16 @@ class MarimoHtmlOutput(io.StringIO):
         # Use mo.output to stream the updated HTML object to marimo
         mo.output.replace(mo.Html(html_content))
 
+    def _deferred_update(self, delay: float):
+        time.sleep(delay)
+        with self._lock:
+            self._is_update_scheduled = False
+            # Skip if a later write or flush has rendered everything in the meantime
+            if self._is_dirty:
+                self._update_html(force=True)
+
     def getvalue(self):
-        # Return all lines joined with newlines, plus current incomplete line
+        # Return the retained lines joined with newlines, plus current incomplete line
         all_content = '\n'.join(self.lines)
         if self.current_line:
             all_content += '\n' + self.current_line if all_content else self.current_line
@@ -335,7 +844,8 @@ class MarimoHtmlOutput(io.StringIO):
 
 
 @contextmanager
-def in_output_area(container_css_class="code-output-area", line_css_class="code-output-line"):
+def in_output_area(container_css_class="code-output-area", line_css_class="code-output-line",
+                   min_update_interval: float = DEFAULT_MIN_UPDATE_INTERVAL, max_lines: int | None = DEFAULT_MAX_LINES):
     """
     Use this context manager in a with statement to redirect all STDOUT writes to custom HTML
     output area that is live-streamed to marimo using marimo.output.
@@ -345,7 +855,7 @@ def in_output_area(container_css_class="code-output-area", line_css_class="code-
             print("This gets redirected to a custom output area!")
     """
 
-    output = MarimoHtmlOutput(container_css_class, line_css_class)
+    output = MarimoHtmlOutput(container_css_class, line_css_class, min_update_interval, max_lines)
     with redirect_stdout(output):
         try:
             yield
@@ -353,10 +863,13 @@ def in_output_area(container_css_class="code-output-area", line_css_class="code-
             output.flush()
 
 
-def run_code(run_signal: bool, task: Callable[[Any], Any], container_css_class="code-output-area", line_css_class="code-output-line", **kwargs) -> Any:
+def run_code(run_signal: bool, task: Callable[[Any], Any], container_css_class="code-output-area", line_css_class="code-output-line",
+             min_update_interval: float = DEFAULT_MIN_UPDATE_INTERVAL, max_lines: int | None = DEFAULT_MAX_LINES, **kwargs) -> Any:
     """
     Executed the given task once the run_signal changes to True. During the execution of the task, all STDOUT write
     operations are redirected to a custom HTML output area that is live-streamed to marimo using marimo.output.
+    The output area is updated at most once every min_update_interval seconds and shows the last max_lines lines
+    (None to show all of them).
 
     Example:
         ```
@@ -371,7 +884,7 @@ def run_code(run_signal: bool, task: Callable[[Any], Any], container_css_class="
         ```
     """
     if run_signal:
-        output = MarimoHtmlOutput(container_css_class, line_css_class)
+        output = MarimoHtmlOutput(container_css_class, line_css_class, min_update_interval, max_lines)
         with redirect_stdout(output):
             try:
                 return task(**kwargs)
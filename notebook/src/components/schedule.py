@@ -0,0 +1,161 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+def load_stop_times(rows: Iterable[tuple[str, str, str, int, int]]) -> pd.DataFrame:
+    """
+    Collects a stream of (trip, mode, stop, stop_sequence, operations_per_year) rows into a compact DataFrame.
+    Trips, modes and stops are encoded as integer codes while streaming, so every distinct ID is only kept in
+    memory once instead of once per row.
+
+    Returns:
+        DataFrame: columns 'trip' (int codes), 'mode' and 'stop' (categorical), 'stop_sequence' and
+        'operations_per_year'.
+    """
+
+    trip_codes: dict[str, int] = {}
+    mode_codes: dict[str, int] = {}
+    stop_codes: dict[str, int] = {}
+    trips, modes, stops, sequences, operations = [], [], [], [], []
+
+    for trip, mode, stop, stop_sequence, operations_per_year in rows:
+        trips.append(trip_codes.setdefault(trip, len(trip_codes)))
+        modes.append(mode_codes.setdefault(mode, len(mode_codes)))
+        stops.append(stop_codes.setdefault(stop, len(stop_codes)))
+        sequences.append(stop_sequence)
+        operations.append(operations_per_year or 0)
+
+    return pd.DataFrame({
+        "trip": np.array(trips, dtype=np.int32),
+        "mode": pd.Categorical.from_codes(np.array(modes, dtype=np.int8), categories=list(mode_codes.keys())),
+        "stop": pd.Categorical.from_codes(np.array(stops, dtype=np.int32), categories=list(stop_codes.keys())),
+        "stop_sequence": np.array(sequences, dtype=np.int32),
+        "operations_per_year": np.array(operations, dtype=np.int64),
+    })
+
+
+def build_trip_patterns(rows: Iterable[tuple[str, str, str, int, int, int]]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Groups trips that serve the exact same sequence of stops on the same route into trip patterns. Each pattern only
+    stores its ordered stops once, while every trip only keeps its start time and the arrival/departure offsets (in
+    seconds since its start) at the stops of its pattern.
+
+    Args:
+        rows: a stream of (trip, route, stop, stop_sequence, arrival_seconds, departure_seconds) tuples
+
+    Returns:
+        A tuple of three DataFrames:
+        - patterns: columns 'pattern', 'route' and 'stop_count'
+        - pattern_stops: columns 'pattern', 'stop' and 'stop_sequence'
+        - trip_patterns: columns 'trip', 'pattern', 'start_time', 'arrival_offsets' and 'departure_offsets'
+          (unknown start times and offsets are -1)
+    """
+
+    trip_codes: dict[str, int] = {}
+    route_codes: dict[str, int] = {}
+    stop_codes: dict[str, int] = {}
+    trips, routes, stops, sequences, arrivals, departures = [], [], [], [], [], []
+
+    for trip, route, stop, stop_sequence, arrival_seconds, departure_seconds in rows:
+        trips.append(trip_codes.setdefault(trip, len(trip_codes)))
+        routes.append(route_codes.setdefault(route, len(route_codes)))
+        stops.append(stop_codes.setdefault(stop, len(stop_codes)))
+        sequences.append(stop_sequence)
+        # Fall back to the other time if a stop time only defines one of them
+        arrivals.append(arrival_seconds if arrival_seconds is not None else departure_seconds)
+        departures.append(departure_seconds if departure_seconds is not None else arrival_seconds)
+
+    trip_ids, route_ids, stop_ids = list(trip_codes.keys()), list(route_codes.keys()), list(stop_codes.keys())
+    trips, routes, stops = np.array(trips, dtype=np.int32), np.array(routes, dtype=np.int32), np.array(stops, dtype=np.int32)
+    sequences = np.array(sequences, dtype=np.int32)
+    arrivals = np.array(arrivals, dtype=np.float64)
+    departures = np.array(departures, dtype=np.float64)
+
+    order = np.lexsort((sequences, trips))
+    trips, routes, stops, sequences = trips[order], routes[order], stops[order], sequences[order]
+    arrivals, departures = arrivals[order], departures[order]
+    trip_starts = np.concatenate([[0], np.flatnonzero(trips[1:] != trips[:-1]) + 1]) if len(trips) else np.array([], dtype=int)
+    trip_ends = np.append(trip_starts[1:], len(trips))
+
+    pattern_keys: dict[tuple[int, bytes, bytes], str] = {}
+    patterns_per_route: dict[int, int] = {}
+    patterns, pattern_stops, trip_patterns = [], [], []
+
+    for start, end in zip(trip_starts, trip_ends):
+        route = int(routes[start])
+        key = (route, stops[start:end].tobytes(), sequences[start:end].tobytes())
+
+        pattern = pattern_keys.get(key)
+        if pattern is None:
+            pattern_number = patterns_per_route[route] = patterns_per_route.get(route, 0) + 1
+            pattern = pattern_keys[key] = f"{route_ids[route]}:{pattern_number}"
+            patterns.append((pattern, route_ids[route], end - start))
+            pattern_stops.extend((pattern, stop_ids[stop], int(sequence))
+                                 for stop, sequence in zip(stops[start:end], sequences[start:end]))
+
+        start_time = departures[start]
+        trip_patterns.append((
+            trip_ids[trips[start]],
+            pattern,
+            -1 if np.isnan(start_time) else int(start_time),
+            _time_offsets(arrivals[start:end], start_time),
+            _time_offsets(departures[start:end], start_time),
+        ))
+
+    return (
+        pd.DataFrame(patterns, columns=["pattern", "route", "stop_count"]),
+        pd.DataFrame(pattern_stops, columns=["pattern", "stop", "stop_sequence"]),
+        pd.DataFrame(trip_patterns, columns=["trip", "pattern", "start_time", "arrival_offsets", "departure_offsets"]),
+    )
+
+
+def aggregate_consecutive_connections(stop_times: pd.DataFrame) -> pd.DataFrame:
+    """
+    Finds every pair of stops (s1, s2) that some trip serves directly after each other and sums up the yearly
+    operations of all trips through s1 -> s2, separately for each mode of transport.
+
+    Instead of pairing up every two stops of a trip, the stop times are sorted by trip and stop sequence once,
+    such that consecutive stops of a trip end up in adjacent rows and can be paired up by shifting the columns
+    by one row.
+
+    Args:
+        stop_times (DataFrame): columns 'trip', 'mode', 'stop', 'stop_sequence' and 'operations_per_year',
+            as returned by load_stop_times()
+
+    Returns:
+        DataFrame: columns 'from_stop', 'to_stop', 'mode' and 'yearly' with one row per connected pair of stops
+        and mode of transport.
+    """
+
+    order = np.lexsort((stop_times["stop_sequence"].to_numpy(), stop_times["trip"].to_numpy()))
+    trips = stop_times["trip"].to_numpy()[order]
+    sequences = stop_times["stop_sequence"].to_numpy()[order]
+    stops = stop_times["stop"].cat.codes.to_numpy()[order]
+    modes = stop_times["mode"].cat.codes.to_numpy()[order]
+    operations = stop_times["operations_per_year"].to_numpy()[order]
+
+    # Pair each row with its successor: same trip, directly following stop, and not a hop within the same cluster
+    is_connection = (
+        (trips[1:] == trips[:-1])
+        & (sequences[1:] == sequences[:-1] + 1)
+        & (stops[1:] != stops[:-1])
+    )
+
+    stop_categories = stop_times["stop"].cat.categories
+    connections = pd.DataFrame({
+        "from_stop": pd.Categorical.from_codes(stops[:-1][is_connection], categories=stop_categories),
+        "to_stop": pd.Categorical.from_codes(stops[1:][is_connection], categories=stop_categories),
+        "mode": pd.Categorical.from_codes(modes[:-1][is_connection], categories=stop_times["mode"].cat.categories),
+        "yearly": operations[:-1][is_connection],
+    })
+
+    return (connections
+            .groupby(["from_stop", "to_stop", "mode"], observed=True, sort=False, as_index=False)["yearly"]
+            .sum())
+
+
+def _time_offsets(times: np.ndarray, start_time: float) -> list[int]:
+    offsets = times - start_time
+    return np.where(np.isnan(offsets), -1, offsets).astype(np.int64).tolist()
@@ -1,4 +1,8 @@
 from enum import Enum
+from functools import cached_property
+from typing import Any, Iterable
+
+import numpy as np
 
 
 class Stop:
@@ -15,7 +19,8 @@ class Stop:
         return self.lat
 
 class ClusterStop(Stop):
-    def __init__(self, stop_id: str, latitude: float, longitude: float, name: str, cluster_lat: float, cluster_lon: float, cluster_points: list[list[float]]):
+    def __init__(self, stop_id: str, latitude: float, longitude: float, name: str, cluster_lat: float, cluster_lon: float, cluster_points: list[list[float]],
+                 cluster_hull: str | None = None):
        super().__init__(stop_id, latitude, longitude, name)
        self.is_root = True
        self.cluster_lat: float = cluster_lat
@@ -24,6 +29,7 @@ class ClusterStop(Stop):
            self.cluster_points: list[tuple[float, float]] = [(point[0], point[1]) for point in cluster_points]
        else:
            self.cluster_points = []
+       self.cluster_hull: str | None = cluster_hull  # Precomputed outline of the cluster as encoded polyline
 
     def display_lon(self) -> float:
         return self.cluster_lon
@@ -95,3 +101,234 @@ class Connection:
 
     def __str__(self):
         return f"{self.from_stop.name} --> {self.to_stop.name}"
+
+
+class BoundingBox:
+    """
+    A rectangle of WGS84 coordinates, e.g. the part of the city that is visible on a map.
+    """
+
+    def __init__(self, south: float, west: float, north: float, east: float):
+        self.south: float = south
+        self.west: float = west
+        self.north: float = north
+        self.east: float = east
+
+    def expanded(self, margin: float) -> "BoundingBox":
+        """
+        Returns this box grown by the given fraction of its height/width on every side.
+        """
+
+        lat_margin, lon_margin = (self.north - self.south) * margin, (self.east - self.west) * margin
+        return BoundingBox(self.south - lat_margin, self.west - lon_margin, self.north + lat_margin, self.east + lon_margin)
+
+    def __repr__(self):
+        return f"BoundingBox(south={self.south}, west={self.west}, north={self.north}, east={self.east})"
+
+
+class StopTable:
+    """
+    Column-oriented alternative to a list of Stop/ClusterStop objects: every attribute is kept in one NumPy array
+    with one row per stop. The cluster points of all cluster roots are stored in one (n, 2) array of [lat, lon],
+    where the points of row i are cluster_points[cluster_point_offsets[i]:cluster_point_offsets[i + 1]].
+    If the precomputed outlines of the clusters were queried, they are kept in cluster_hulls (as encoded polylines).
+    """
+
+    def __init__(self, ids: np.ndarray, names: np.ndarray, lat: np.ndarray, lon: np.ndarray, is_root: np.ndarray,
+                 cluster_lat: np.ndarray, cluster_lon: np.ndarray, cluster_point_offsets: np.ndarray,
+                 cluster_points: np.ndarray, cluster_hulls: np.ndarray | None = None):
+        self.ids: np.ndarray = ids
+        self.names: np.ndarray = names
+        self.lat: np.ndarray = lat
+        self.lon: np.ndarray = lon
+        self.is_root: np.ndarray = is_root
+        self.cluster_lat: np.ndarray = cluster_lat  # NaN for stops that are no cluster root
+        self.cluster_lon: np.ndarray = cluster_lon
+        self.cluster_point_offsets: np.ndarray = cluster_point_offsets
+        self.cluster_points: np.ndarray = cluster_points
+        self.cluster_hulls: np.ndarray | None = cluster_hulls  # None for stops that are no cluster root
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[str, str, float, float, bool, float | None, float | None, list[list[float]] | None]]) -> "StopTable":
+        """
+        Builds a table from (id, name, lat, lon, is_root, cluster_lat, cluster_lon, cluster_points) tuples.
+        """
+
+        ids, names, lats, lons, roots, cluster_lats, cluster_lons, offsets, points = [], [], [], [], [], [], [], [0], []
+        for stop_id, name, lat, lon, is_root, cluster_lat, cluster_lon, cluster_points in rows:
+            ids.append(stop_id)
+            names.append(name)
+            lats.append(lat)
+            lons.append(lon)
+            roots.append(bool(is_root))
+            cluster_lats.append(cluster_lat if is_root and cluster_lat is not None else np.nan)
+            cluster_lons.append(cluster_lon if is_root and cluster_lon is not None else np.nan)
+            if is_root and cluster_points:
+                points.extend(cluster_points)
+            offsets.append(len(points))
+
+        return cls(
+            ids=np.array(ids, dtype=object),
+            names=np.array(names, dtype=object),
+            lat=np.array(lats, dtype=np.float64),
+            lon=np.array(lons, dtype=np.float64),
+            is_root=np.array(roots, dtype=bool),
+            cluster_lat=np.array(cluster_lats, dtype=np.float64),
+            cluster_lon=np.array(cluster_lons, dtype=np.float64),
+            cluster_point_offsets=np.array(offsets, dtype=np.int64),
+            cluster_points=np.array(points, dtype=np.float64).reshape(-1, 2),
+        )
+
+    @classmethod
+    def from_records(cls, records: Iterable[Any]) -> "StopTable":
+        """
+        Builds a table from neo4j records with the columns id, name, lat, lon, is_cluster and optionally cluster_lat,
+        cluster_lon, cluster_points and cluster_hull.
+        """
+
+        hulls = []
+
+        def rows():
+            for record in records:
+                hulls.append(record.get("cluster_hull") if record["is_cluster"] else None)
+                yield (record["id"], record["name"], record["lat"], record["lon"], record["is_cluster"],
+                       record.get("cluster_lat"), record.get("cluster_lon"), record.get("cluster_points"))
+
+        table = cls.from_rows(rows())
+        if any(hull is not None for hull in hulls):
+            table.cluster_hulls = np.array(hulls, dtype=object)
+        return table
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[Any]) -> "StopTable":
+        """
+        Builds a table from neo4j :Stop nodes (without cluster points).
+        """
+
+        return cls.from_rows(
+            (node["id"], node["name"], float(node["lat"]), float(node["lon"]), "ClusterStop" in node.labels,
+             node.get("cluster_lat"), node.get("cluster_lon"), None)
+            for node in nodes
+        )
+
+    @classmethod
+    def from_stops(cls, stops: Iterable[Stop]) -> "StopTable":
+        stops = list(stops)
+        table = cls.from_rows(
+            (stop.id, stop.name, stop.lat, stop.lon, stop.is_root,
+             getattr(stop, "cluster_lat", None), getattr(stop, "cluster_lon", None), getattr(stop, "cluster_points", None))
+            for stop in stops
+        )
+        hulls = [getattr(stop, "cluster_hull", None) for stop in stops]
+        if any(hull is not None for hull in hulls):
+            table.cluster_hulls = np.array(hulls, dtype=object)
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+    @cached_property
+    def index(self) -> dict[str, int]:
+        """The row of every stop ID"""
+        return {stop_id: row for row, stop_id in enumerate(self.ids)}
+
+    def display_lat(self) -> np.ndarray:
+        return np.where(np.isnan(self.cluster_lat), self.lat, self.cluster_lat)
+
+    def display_lon(self) -> np.ndarray:
+        return np.where(np.isnan(self.cluster_lon), self.lon, self.cluster_lon)
+
+    def cluster_points_of(self, row: int) -> np.ndarray:
+        return self.cluster_points[self.cluster_point_offsets[row]:self.cluster_point_offsets[row + 1]]
+
+    def take(self, rows: np.ndarray) -> "StopTable":
+        """
+        Returns a new table with only the given rows.
+        """
+
+        points = [self.cluster_points_of(row) for row in rows]
+        return StopTable(
+            self.ids[rows], self.names[rows], self.lat[rows], self.lon[rows], self.is_root[rows],
+            self.cluster_lat[rows], self.cluster_lon[rows],
+            np.concatenate([[0], np.cumsum([len(p) for p in points], dtype=np.int64)]),
+            np.concatenate(points) if points else np.empty((0, 2), dtype=np.float64),
+            self.cluster_hulls[rows] if self.cluster_hulls is not None else None,
+        )
+
+    def to_stops(self) -> list[Stop]:
+        return [
+            ClusterStop(self.ids[row], self.lat[row], self.lon[row], self.names[row], self.cluster_lat[row],
+                        self.cluster_lon[row], self.cluster_points_of(row).tolist(),
+                        self.cluster_hulls[row] if self.cluster_hulls is not None else None)
+            if self.is_root[row] else Stop(self.ids[row], self.lat[row], self.lon[row], self.names[row])
+            for row in range(len(self))
+        ]
+
+
+class ConnectionTable:
+    """
+    Column-oriented alternative to a list of Connection objects: the stops are kept in a StopTable, while each
+    connection is a row of the start/end stop rows and the int8 codes (enum values) of its mode of transport and
+    frequency.
+    """
+
+    def __init__(self, stops: StopTable, from_rows: np.ndarray, to_rows: np.ndarray, modes: np.ndarray, frequencies: np.ndarray):
+        self.stops: StopTable = stops
+        self.from_rows: np.ndarray = from_rows
+        self.to_rows: np.ndarray = to_rows
+        self.modes: np.ndarray = modes
+        self.frequencies: np.ndarray = frequencies
+
+    @classmethod
+    def from_records(cls, records: Iterable[Any]) -> "ConnectionTable":
+        """
+        Builds a table from neo4j records with the start and end :Stop nodes in the columns 'from' and 'to' and the
+        relationship type or frequency in the column 'label'.
+        """
+
+        nodes: dict[str, Any] = {}
+        from_ids, to_ids, labels = [], [], []
+        for record in records:
+            from_node, to_node = record["from"], record["to"]
+            nodes.setdefault(from_node["id"], from_node)
+            nodes.setdefault(to_node["id"], to_node)
+            from_ids.append(from_node["id"])
+            to_ids.append(to_node["id"])
+            labels.append(record["label"])
+
+        return cls.from_triples(zip(from_ids, labels, to_ids), StopTable.from_nodes(nodes.values()))
+
+    @classmethod
+    def from_triples(cls, triples: Iterable[tuple[str, str, str]], stops: StopTable) -> "ConnectionTable":
+        """
+        Builds a table from (head, relation, tail) triples, where head and tail are IDs of the given stops.
+        """
+
+        codes: dict[str, tuple[int, int]] = {}
+        from_rows, to_rows, modes, frequencies = [], [], [], []
+        for head, rel, tail in triples:
+            if rel not in codes:
+                codes[rel] = (parse_mode_of_transport(rel).value, parse_frequency(rel).value)
+            mode, frequency = codes[rel]
+            from_rows.append(stops.index[head])
+            to_rows.append(stops.index[tail])
+            modes.append(mode)
+            frequencies.append(frequency)
+
+        return cls(
+            stops,
+            from_rows=np.array(from_rows, dtype=np.int32),
+            to_rows=np.array(to_rows, dtype=np.int32),
+            modes=np.array(modes, dtype=np.int8),
+            frequencies=np.array(frequencies, dtype=np.int8),
+        )
+
+    def __len__(self):
+        return len(self.from_rows)
+
+    def to_connections(self) -> list[Connection]:
+        stops = self.stops.to_stops()
+        return [
+            Connection(stops[from_row], stops[to_row], ModeOfTransport(int(mode)), Frequency(int(frequency)))
+            for from_row, to_row, mode, frequency in zip(self.from_rows, self.to_rows, self.modes, self.frequencies)
+        ]
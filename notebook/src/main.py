@@ -12,13 +12,31 @@ def imports():
 
     import src.components.graph as graph
     import src.components.geo_spatial as geo
+    import src.components.geometry_store as geometry_store
     import src.components.presentation as present
     import src.components.learning as learning
+    import src.components.map_tiles as map_tiles
     import src.components.prediction as prediction
+    import src.components.schedule as schedule
+    import src.components.clustering as clustering
 
     def print_raw(message: str):
         mo.output.append(mo.plain_text(message))
-    return geo, graph, learning, mo, np, pd, prediction, present, print_raw
+    return (
+        clustering,
+        geo,
+        geometry_store,
+        graph,
+        learning,
+        map_tiles,
+        mo,
+        np,
+        pd,
+        prediction,
+        present,
+        print_raw,
+        schedule,
+    )
 
 
 @app.cell(hide_code=True)
@@ -75,6 +93,13 @@ def _(graph, mo, print_raw):
     RETURN count(r) as count
     """
 
+    # Stop times of trips whose STOPS_AT relationships were dropped in favour of their trip pattern
+    _pattern_stop_times_query = """
+    MATCH (t:Trip)-[:FOLLOWS_PATTERN]->(p:TripPattern)
+    WHERE NOT EXISTS { (t)-[:STOPS_AT]->() }
+    RETURN count(t) AS trips, coalesce(sum(p.stop_count), 0) AS count
+    """
+
     _city_data_query = """
     OPTIONAL MATCH (n:SubDistrict)
     WHERE n.name IS NULL
@@ -90,19 +115,32 @@ def _(graph, mo, print_raw):
         mo.output.append(_status_header)
 
         if _kg_available:
+            # The status checks are independent of each other, so we run them concurrently
+            _status = graph.query_concurrently({
+                "node_counts": _node_count_query,
+                "stop_times": _stop_times_query,
+                "pattern_stop_times": _pattern_stop_times_query,
+                "city_data": _city_data_query,
+            })
+
             print_raw("Verifying GTFS data presence:")
-            _node_counts = graph.execute_query(_node_count_query)[0]
+            _node_counts = _status["node_counts"][0]
             for name, key in _labels:
                 _count = _node_counts[key] if key in _node_counts.keys() else 0
                 print_raw(f"\t✅ {name}: {_count}" if _count > 0 else f"\t❌ No {name.lower()}")
 
-            _stop_times = graph.execute_query(_stop_times_query)
-            print_raw(f"\t✅ Stop times: {_stop_times[0]["count"]}" if _stop_times else f"\t❌ No stop times")
+            _stop_times = _status["stop_times"][0]["count"] if _status["stop_times"] else 0
+            _pattern_stop_times = _status["pattern_stop_times"][0] if _status["pattern_stop_times"] else None
+            _compressed = _pattern_stop_times["count"] if _pattern_stop_times else 0
+            if _compressed > 0:
+                print_raw(f"\t✅ Stop times: {_stop_times + _compressed} ({_compressed} of {_pattern_stop_times['trips']} trips compressed into trip patterns)")
+            else:
+                print_raw(f"\t✅ Stop times: {_stop_times}" if _stop_times > 0 else f"\t❌ No stop times")
 
             print_raw("Verifying geographic/demographic data presence:")
             _count = _node_counts["subdistricts"] if "subdistricts" in _node_counts.keys() else 0
             print_raw(f"\t✅ Subdistricts: {_count}" if _count > 0 else f"\t❌ No subdistricts")
-            _city_data = graph.execute_query(_city_data_query)[0]
+            _city_data = _status["city_data"][0]
             print_raw(f"\t✅ Subdistricts names" if _city_data['no_name_count'] == 0 else f"\t❌ Some subdistricts have no name")
             print_raw(f"\t✅ Subdistricts shapes" if _city_data['no_shape_count'] == 0 else f"\t❌ Some subdistricts have no shape")
 
@@ -270,6 +308,9 @@ def merge_nearby_stops(
         - Created {_summary.counters.relationships_created} relationships
         - Added {_summary.counters.labels_added} labels""")
 
+        # Remember the clustered stops, so later changes to the stops can be clustered incrementally
+        graph.save_clustering_snapshot(_stops, 200, 400)
+
         check_status_clusters_created()
 
 
@@ -278,6 +319,54 @@ def merge_nearby_stops(
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    ### Updating clusters incrementally
+
+    When the stops change after a refresh of the GTFS feed, only few clusters are usually affected. Thus, instead of deleting and recreating all clusters, we can compare the current stops with the stops of the last clustering and only recluster the neighbourhoods of stops that were added, moved or removed. Only the `:IN_CLUSTER` relationships and `ClusterStop` labels that actually change are written to the graph.
+    """
+    )
+    return
+
+
+@app.cell
+def _(present):
+    button_update_clusters = present.create_run_button(label="Update Clusters")
+    return (button_update_clusters,)
+
+
+@app.cell
+def _(button_update_clusters, check_status_clusters_created, geo, graph, present):
+    def _update_clusters():
+        _snapshot = graph.get_clustering_snapshot()
+        if _snapshot is None:
+            print("❌ No previous clustering found, please merge nearby stops from scratch first")
+            return
+        _previous_stops, _parameters = _snapshot
+
+        _stops = graph.get_stops()
+        print(f"Queried {len(_stops)} stops from the graph (previously {len(_previous_stops)})")
+
+        _stop_clusters, _reclustered_ids = geo.find_stop_clusters_incremental(_stops, _previous_stops, **_parameters)
+        print(f"Reclustered {len(_reclustered_ids)} stops into {len(_stop_clusters)} clusters")
+
+        _summary = graph.cluster_stops(_stop_clusters, reclustered_ids=_reclustered_ids)
+        graph.save_clustering_snapshot(_stops, **_parameters)
+        if _summary:
+            print(f"""\nOperation successful:
+        - Created {_summary.counters.relationships_created} and deleted {_summary.counters.relationships_deleted} relationships
+        - Added {_summary.counters.labels_added} and removed {_summary.counters.labels_removed} labels""")
+        else:
+            print("\nAll clusters are up to date")
+
+        check_status_clusters_created()
+
+    present.run_code(button_update_clusters.value, _update_clusters)
+    return
+
+
 @app.cell(hide_code=True)
 def _(mo):
     mo.md(
@@ -287,6 +376,8 @@ def _(mo):
     ### Merging hierarchichally related stops
 
     Luckily, the Wiener Linien used somewhat of a hierarchichal structure when assigning unique IDs to their stops. In particular, the IDs consist of five components delimited by a colon, where the last (fifth) component denotes the respective exit/platform of a station. Using these semantics, we can further improve our stop clustering and stitch together all platforms/exits of each station.
+
+    Instead of comparing every pair of stops in the database, we load all stops with their current cluster root once and merge the existing clusters with the stops of each station using a union-find structure. Every resulting group of stops is then written back as a single flat cluster, so no cluster can end up nested in another.
     """
     )
     return
@@ -299,11 +390,20 @@ def _(present):
 
 
 @app.cell
-def detect_station_exits(button_merge_related_stops, graph, present):
+def detect_station_exits(button_merge_related_stops, clustering, graph, present):
     def _merge_related_stops():
+        print("Loading stops and their clusters...")
+        _stop_ids, _current_roots = graph.get_cluster_roots()
+        _current_roots = dict(zip(_stop_ids, _current_roots))
+
         print("Merging related clusters...")
-        _updated_clusters: int = graph.merge_related_clusters()
-        print(f"Updated {_updated_clusters} stop clusters")
+        _new_roots = clustering.merge_related_clusters(_stop_ids, list(_current_roots.values()))
+        _changed_roots = {_stop: _root for _stop, _root in _new_roots.items() if _current_roots[_stop] != _root}
+        _previous_cluster_count = len(set(_root for _root in _current_roots.values() if _root is not None))
+        print(f"Grouped {len(_new_roots)} stops into {len(set(_new_roots.values()))} clusters (previously {_previous_cluster_count})")
+
+        _summary = graph.assign_clusters(_changed_roots)
+        print(f"Re-assigned {len(_changed_roots)} stops, created {_summary.counters.relationships_created if _summary else 0} relationships")
 
         # Since this is such a complex operation, we verify that everything worked as expected
         print("Verifying integrity...")
@@ -350,7 +450,11 @@ def _(mo):
     // For each cluster, rank members by usage
     MATCH (stop:Stop)-[:IN_CLUSTER]->(parent:ClusterStop)
     OPTIONAL MATCH (stop)<-[:STOPS_AT]-(t:Trip)
-    WITH parent, stop, count(t) AS tripCount
+    WITH parent, stop, count(t) AS directTrips
+    // Trips whose STOPS_AT relationships were dropped only visit the stop through their trip pattern
+    OPTIONAL MATCH (stop)<-[:VISITS]-(:TripPattern)<-[:FOLLOWS_PATTERN]-(pt:Trip)
+    WHERE NOT EXISTS { (pt)-[:STOPS_AT]->() }
+    WITH parent, stop, directTrips + count(pt) AS tripCount
     ORDER BY parent, tripCount DESC, stop.name DESC, stop.id ASC
     WITH parent, collect(stop) AS clusterMembers
     WITH parent, clusterMembers, clusterMembers[0] AS mainStop
@@ -405,28 +509,46 @@ def reassign_cluster_stops(
 
 @app.cell(hide_code=True)
 def _(mo):
-    operation_move_stop_relations_to_root = """
-    MATCH (:Trip)-[at:STOPS_AT]->(s:Stop)-[:IN_CLUSTER]->(c:Stop:ClusterStop)
-    WHERE s.id <> c.id
-    CALL (at, c) {
-      CALL apoc.refactor.to(at, c) YIELD output
-      RETURN count(output) AS refactoredCount
-    } IN TRANSACTIONS OF 10000 ROWS
-    RETURN sum(refactoredCount) AS movedRelationships
-    """
-
-    mo.md(fr"""
+    mo.md(
+        r"""
     ### Move transport-related relationships to cluster stop
 
     Now that we have created clusters with the busiest stop in them as their root node (the `ClusterStop`), we move all `:STOPS_AT` relationships of the other nodes in the cluster to that `ClusterStop` instead.
 
+    Rather than refactoring one relationship after another, we re-create each relationship at the cluster root (with all of its properties) and delete the old one. The work is partitioned by cluster root and runs in several concurrent transactions, where each transaction moves the relationships of a batch of whole clusters:
+
     ```cypher
-    {operation_move_stop_relations_to_root}
+    MATCH (c:Stop:ClusterStop)
+    CALL (c) {
+      CALL (c) {
+        MATCH (t:Trip)-[at:STOPS_AT]->(s:Stop)-[:IN_CLUSTER]->(c)
+        WHERE s.id <> c.id
+        CREATE (t)-[moved:STOPS_AT]->(c)
+        SET moved = properties(at)
+        DELETE at
+        RETURN count(moved) AS moved_stop_times
+      }
+      // Trips whose STOPS_AT relationships were dropped only visit their stops through their trip pattern
+      CALL (c) {
+        MATCH (p:TripPattern)-[v:VISITS]->(s:Stop)-[:IN_CLUSTER]->(c)
+        WHERE s.id <> c.id
+        CREATE (p)-[moved:VISITS]->(c)
+        SET moved = properties(v)
+        DELETE v
+        RETURN count(moved) AS moved_visits
+      }
+      RETURN moved_stop_times + moved_visits AS moved
+    } IN $concurrency CONCURRENT TRANSACTIONS OF $batch_size ROWS
+      ON ERROR CONTINUE
+      REPORT STATUS AS status
     ```
-    **WARNING**: Be aware that this is a very expensive operation and might take a while to finish execution.
+
+    Batches of different clusters never share stops, but they do share the trips at the other end of the moved relationships. Batches that fail because their transactions deadlock on such a trip are therefore redone in a single serial pass afterwards, and the step fails loudly if any relationships still could not be moved.
+
+    **WARNING**: Be aware that this is still an expensive operation and might take a while to finish execution.
     """
     )
-    return (operation_move_stop_relations_to_root,)
+    return
 
 
 @app.cell
@@ -436,17 +558,11 @@ def _(present):
 
 
 @app.cell
-def _(
-    button_move_stop_relations_to_root,
-    graph,
-    operation_move_stop_relations_to_root,
-    present,
-):
+def _(button_move_stop_relations_to_root, graph, present):
     def _move_stop_relations_to_root():
-        print("Moving over all :STOPS_AT relationships to cluster roots...")
-        _response = graph.execute_batched_query(operation_move_stop_relations_to_root)
-        _moved_relationships: int = int(_response[0][0]) if _response else 0
-        print(f"Moved a total of {_moved_relationships} :STOPS_AT relationships")
+        print("Moving over all :STOPS_AT and :VISITS relationships to cluster roots...")
+        _moved_relationships = graph.move_stop_relations_to_root(batch_size=100, concurrency=4)
+        print(f"Moved a total of {_moved_relationships} :STOPS_AT and :VISITS relationships")
 
     present.run_code(button_move_stop_relations_to_root.value, _move_stop_relations_to_root)
     return
@@ -492,14 +608,13 @@ def match_stops_with_districts(
         _subdistricts = graph.get_subdistricts()
         print(f"Queried {len(_subdistricts)} subdistricts from the graph")
 
-        print("Detecting stops within subdistricts...")
-        _stops_within_districts = geo.match_stops_to_subdistricts(_stops, _subdistricts, buffer_metres = 20)
-        _summary = graph.connect_stop_to_subdistricts(_stops_within_districts, 'LOCATED_IN')
+        print("Detecting stops within and near subdistricts...")
+        _matches = geo.match_stops_to_subdistricts_within(_stops, _subdistricts, radii_metres=[20, 500])
+
+        _summary = graph.connect_stop_to_subdistricts(_matches[20], 'LOCATED_IN')
         print(f"Created {_summary.counters.relationships_created} LOCATED_IN relationships")
 
-        print("Detecting stops near subdistricts...")
-        _stops_close_to_districts = geo.match_stops_to_subdistricts(_stops, _subdistricts, buffer_metres = 500)
-        _summary = graph.connect_stop_to_subdistricts(_stops_close_to_districts, 'LOCATED_NEARBY')
+        _summary = graph.connect_stop_to_subdistricts(_matches[500], 'LOCATED_NEARBY')
         print(f"Created {_summary.counters.relationships_created} LOCATED_NEARBY relationships")
 
         check_locations_added()
@@ -662,6 +777,72 @@ def _(
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    For the maps below, every cluster is drawn as the (slightly enlarged) convex hull of its stops. Instead of collecting the positions of all members and computing the hull whenever a map is drawn, we compute the hulls once and store their outlines on the cluster stops as [encoded polylines](https://developers.google.com/maps/documentation/utilities/polylinealgorithm). Repeat this step whenever the clusters change.
+    """
+    )
+    return
+
+
+@app.cell
+def _(present):
+    button_compute_cluster_hulls = present.create_run_button(label="Compute Cluster Hulls")
+    return (button_compute_cluster_hulls,)
+
+
+@app.cell
+def _(button_compute_cluster_hulls, geo, graph, present):
+    def _compute_cluster_hulls():
+        print("Querying the stops of all clusters...")
+        _stops = graph.get_stops(with_clusters=True, as_table=True)
+
+        print("Computing the hull of each cluster...")
+        _hulls = geo.compute_cluster_hulls(_stops)
+
+        _summaries = graph.store_cluster_hulls(_hulls)
+        if _summaries["hulls"]:
+            print(f"Stored the hulls of {_summaries['hulls'].counters.properties_set} clusters")
+        if _summaries["outdated_hulls"]:
+            print(f"Removed {_summaries['outdated_hulls'].counters.properties_set} hulls of former clusters")
+
+    present.run_code(button_compute_cluster_hulls.value, _compute_cluster_hulls)
+    return
+
+
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    To quickly find all stops in a part of the city (e.g. the visible part of a map), we additionally store the position of every stop as a spatial point, once at its own position and once at the position it is displayed at (the cluster position for cluster roots). Both are indexed by a **point index**, which answers bounding box queries without looking at every stop.
+    """
+    )
+    return
+
+
+@app.cell
+def _(present):
+    button_create_stop_locations = present.create_run_button(label="Create Stop Locations")
+    return (button_create_stop_locations,)
+
+
+@app.cell
+def _(button_create_stop_locations, graph, present):
+    def _create_stop_locations():
+        print("Storing the locations of all stops and indexing them...")
+        _summaries = graph.create_stop_locations()
+        if _summaries["locations"]:
+            print(f"Set {_summaries['locations'].counters.properties_set} location properties")
+        for _name in ["location_index", "display_location_index"]:
+            if _summaries[_name]:
+                print(f"Created {_summaries[_name].counters.indexes_added} point index(es) for '{_name}'")
+
+    present.run_code(button_create_stop_locations.value, _create_stop_locations)
+    return
+
+
 @app.cell(hide_code=True)
 def _(mo):
     mo.md(
@@ -803,9 +984,10 @@ def _(
         stops = []
         districts = []
         description = "No data selected"
+        with_hulls = graph.has_cluster_hulls()  # Use the precomputed cluster hulls instead of the members' positions
 
         if active_tab == "All Stops":
-            stops = graph.get_stops(with_clusters=True)
+            stops = graph.get_stops(with_clusters=True, with_hulls=with_hulls)
             description = "Zoom in to see the clusters!"
         elif active_tab == "Specific Stops":
             # Parse the comma-separated stop IDs
@@ -816,12 +998,12 @@ def _(
         elif active_tab == "Specific Cluster":
             stop_identifier = stops_map_stop_input.value.strip()
             if stop_identifier:
-                stops = graph.get_stop_cluster(stop_identifier)
+                stops = graph.get_stop_cluster(stop_identifier, with_hulls=with_hulls)
                 description = f"Found {len(stops)} stop(s) in {sum(1 for node in stops if node.is_root)} cluster(s)"
         elif active_tab == "Near Subdistrict":
             district = stops_map_district_num_combobox.value
             subdistrict = stops_map_subdistrict_num_combobox.value
-            stops = graph.get_stops_for_subdistrict(district, subdistrict)
+            stops = graph.get_stops_for_subdistrict(district, subdistrict, with_hulls=with_hulls)
             districts = graph.get_subdistricts(id_list=[f"{district}-{subdistrict}"])
             description = f"{districts[0].name} ({district}-{subdistrict})" if districts else "Unknown district"
 
@@ -829,6 +1011,14 @@ def _(
     return (stops_map_get_data,)
 
 
+@app.cell
+def _(geometry_store, graph):
+    # Simplify the shapes of all subdistricts once (as one coverage, so neighbouring shapes keep fitting together), such
+    # that the maps only draw as many vertices as are visible at their zoom level
+    geometry_store.precompute_simplifications(graph.get_subdistricts())
+    return
+
+
 @app.cell
 def _(mo, present, stops_map_get_data, stops_map_search_button):
     _stack = []
@@ -987,19 +1177,31 @@ def _(mo):
     """
 
     operation_classify_stops = """
-    // Bus stops
-    MATCH (s:Stop)<-[:STOPS_AT]-(:BusTrip)
-    WHERE NOT (s:BusStop)
+    // Bus stops (visited directly or through the trip pattern a trip follows)
+    CALL () {
+      MATCH (s:Stop)<-[:STOPS_AT]-(:BusTrip) RETURN s
+      UNION
+      MATCH (s:Stop)<-[:VISITS]-(p:TripPattern) WHERE EXISTS { (p)<-[:FOLLOWS_PATTERN]-(:BusTrip) } RETURN s
+    }
+    WITH s WHERE NOT (s:BusStop)
     SET s: BusStop;
 
     // Tram stops
-    MATCH (s:Stop)<-[:STOPS_AT]-(:TramTrip)
-    WHERE NOT (s:TramStop)
+    CALL () {
+      MATCH (s:Stop)<-[:STOPS_AT]-(:TramTrip) RETURN s
+      UNION
+      MATCH (s:Stop)<-[:VISITS]-(p:TripPattern) WHERE EXISTS { (p)<-[:FOLLOWS_PATTERN]-(:TramTrip) } RETURN s
+    }
+    WITH s WHERE NOT (s:TramStop)
     SET s: TramStop;
 
     // Subway stops/stations
-    MATCH (s:Stop)<-[:STOPS_AT]-(:SubwayTrip)
-    WHERE NOT (s:SubwayStation)
+    CALL () {
+      MATCH (s:Stop)<-[:STOPS_AT]-(:SubwayTrip) RETURN s
+      UNION
+      MATCH (s:Stop)<-[:VISITS]-(p:TripPattern) WHERE EXISTS { (p)<-[:FOLLOWS_PATTERN]-(:SubwayTrip) } RETURN s
+    }
+    WITH s WHERE NOT (s:SubwayStation)
     SET s: SubwayStation;
     """
 
@@ -1097,39 +1299,30 @@ def _(
 
 @app.cell(hide_code=True)
 def _(mo):
-    operation_find_related_stops = """
-    MATCH (s:Stop:InUse), (t:Stop:InUse)
-    WHERE s.id < t.id
-    WITH s, t,
-         point({
-           latitude: CASE WHEN s:ClusterStop THEN s.cluster_lat ELSE s.lat END,
-           longitude: CASE WHEN s:ClusterStop THEN s.cluster_lon ELSE s.lon END
-         }) AS s_location,
-         point({
-           latitude: CASE WHEN t:ClusterStop THEN t.cluster_lat ELSE t.lat END,
-           longitude: CASE WHEN t:ClusterStop THEN t.cluster_lon ELSE t.lon END
-         }) AS t_location
-    WITH s, t, s_location, t_location,
-       point.distance(s_location, t_location) AS distance_meters
-    WHERE distance_meters < 800
-    MERGE (s)-[:IS_CLOSE_TO {distance: distance_meters}]->(t)
-    MERGE (t)-[:IS_CLOSE_TO {distance: distance_meters}]->(s)
-    """
-
     mo.md(
-        fr"""
+        r"""
     ## Finding relations between stops
 
     ### Geographic proximity of stops
 
     First, we collect all pairs of stops that are within 800 metres of each other and connect them by a symmetric `:IS_CLOSE_TO` relationship. For points that are the root of a cluster, we take the geographic midpoint of that cluster which we calculated earlier.
 
+    Comparing every stop with every other stop in Cypher would scale quadratically with the number of stops. Instead, we project all stops in use to metric coordinates and put them into a **KD-tree**, a spatial index that lets us look up all stops within 800 metres of a given stop by only visiting its immediate vicinity. The resulting pairs are then written back to the graph in batches:
+
     ```cypher
-    {operation_find_related_stops}
+    UNWIND $stop_pairs AS pair
+    CALL (pair) {
+      MATCH (s:Stop {id: pair.start})
+      MATCH (t:Stop {id: pair.target})
+      MERGE (s)-[forward:IS_CLOSE_TO]->(t)
+      MERGE (t)-[backward:IS_CLOSE_TO]->(s)
+      SET forward.distance = pair.distance,
+          backward.distance = pair.distance
+    } IN TRANSACTIONS OF $batch_size ROWS
     ```
     """
     )
-    return (operation_find_related_stops,)
+    return
 
 
 @app.cell
@@ -1139,16 +1332,19 @@ def _(present):
 
 
 @app.cell
-def _(
-    button_find_neighbouring_stops,
-    graph,
-    operation_find_related_stops,
-    present,
-):
+def _(button_find_neighbouring_stops, geo, graph, present):
     def _find_neighbouring_stops():
+        print("Querying stops in use...")
+        _stops = graph.get_stops(only_in_use=True, with_clusters=True)
+        print(f"Queried {len(_stops)} stops from the graph")
+
         print("Finding pairs of geographically close stops...")
-        _summary = graph.execute_operation(operation_find_related_stops)
-        print(f"Added {int(_summary.counters.relationships_created / 2)} symmetric :IS_CLOSE_TO relationships")
+        _stop_pairs = geo.find_close_stop_pairs(_stops, radius_metres=800)
+        print(f"Found {len(_stop_pairs)} pairs of stops within 800 metres")
+
+        _summary = graph.connect_close_stops(_stop_pairs)
+        _created = _summary.counters.relationships_created if _summary else 0
+        print(f"Added {int(_created / 2)} symmetric :IS_CLOSE_TO relationships")
 
     present.run_code(button_find_neighbouring_stops.value, _find_neighbouring_stops)
     return
@@ -1249,6 +1445,59 @@ def calculate_trips_per_year(
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    ### Compressing trips into trip patterns
+
+    Most trips of a route serve the exact same sequence of stops, only at different times of the day. Yet, every single trip carries its own full set of `:STOPS_AT` relationships, which makes them by far the most common relationship in our graph. Therefore, we group all trips that serve the same sequence of stops on the same route into a `:TripPattern` node. Each pattern is linked to its stops once (`:VISITS` with the stop sequence), while each trip only keeps a single `:FOLLOWS_PATTERN` relationship storing its start time and the time offsets at each stop of the pattern.
+
+    All following steps that are concerned with the order of stops (e.g. finding connections between stops) only need to look at the patterns instead of every single trip once they exist. Optionally, the now redundant `:STOPS_AT` relationships of all trips following a pattern can be dropped afterwards to shrink the graph significantly. All steps that look at the stops of a trip (classifying stops, choosing and moving to cluster roots, the stop time count in the status header) also follow the `:FOLLOWS_PATTERN` and `:VISITS` relationships, so they keep working on the compressed graph.
+    """
+    )
+    return
+
+
+@app.cell
+def _(present):
+    button_build_trip_patterns = present.create_run_button(label="Build Trip Patterns")
+    return (button_build_trip_patterns,)
+
+
+@app.cell
+def _(button_build_trip_patterns, graph, present, schedule):
+    def _build_trip_patterns():
+        print("Streaming stop times of all trips...")
+        _patterns, _pattern_stops, _trip_patterns = schedule.build_trip_patterns(graph.stream_scheduled_stop_times())
+        print(f"Grouped {len(_trip_patterns)} trips into {len(_patterns)} trip patterns with {len(_pattern_stops)} stops in total")
+
+        print("Writing trip patterns to the graph...")
+        _summaries = graph.create_trip_patterns(_patterns, _pattern_stops, _trip_patterns)
+        _created = sum(_summary.counters.relationships_created for _summary in _summaries.values() if _summary)
+        print(f"Created {len(_patterns)} ':TripPattern' nodes and {_created} relationships")
+
+    present.run_code(button_build_trip_patterns.value, _build_trip_patterns)
+    return
+
+
+@app.cell
+def _(present):
+    button_drop_pattern_stop_times = present.create_run_button(label="Drop Compressed Stop Times", kind="danger")
+    return (button_drop_pattern_stop_times,)
+
+
+@app.cell
+def _(button_drop_pattern_stop_times, graph, present):
+    def _drop_pattern_stop_times():
+        print("Deleting :STOPS_AT relationships of trips that follow a trip pattern...")
+        _summary = graph.drop_pattern_stop_times()
+        print(f"Deleted {_summary.counters.relationships_deleted if _summary else 0} ':STOPS_AT' relationships")
+
+    present.run_code(button_drop_pattern_stop_times.value, _drop_pattern_stop_times)
+    return
+
+
 @app.cell(hide_code=True)
 def _(mo):
     mo.md(
@@ -1277,6 +1526,8 @@ def _(mo):
 
     - `s1.id <> s2.id` -- This guarantees that we ignore trips within a cluster to prevent overcounting, since our bundling of stops may have lead to sequential stops being part of the same cluster (and thus the `:STOPS_AT` relationship was redirected to the same root node) .
     - `st2.stop_sequence = st1.stop_sequence + 1` -- This ensures that we only consider _direct_ connections between stops.
+
+    However, this query pairs up _every_ two stops of a trip before filtering for consecutive ones, which grows quadratically with the length of the trips. Therefore, we do the exact same thing outside of the database: We stream all `(trip, mode, stop, stop_sequence, operations_per_year)` rows from the graph, sort them by trip and stop sequence, and pair each row with the row right after it. After summing up the yearly operations per pair of stops and mode of transport, the connections are written back to the graph in one bulk operation per mode.
     """
     )
     return
@@ -1294,30 +1545,28 @@ def _(
     check_status_connections_added,
     graph,
     present,
+    schedule,
 ):
     def _find_connections_between_stops():
-        _operation = """
-        // Consider each pair of stops that appears consecutively in some trip t
-        MATCH (t:Trip:{type_of_trip})-[at1:STOPS_AT]->(s1:Stop),
-              (t)-[at2:STOPS_AT]->(s2:Stop)
-        WHERE s1.id <> s2.id AND at2.stop_sequence = at1.stop_sequence + 1
-        // Grab the unique Service connected to each trip t and sum up the yearly operations of all trips through s1 -> s2
-        MATCH (t)-[:OPERATING_ON]->(service:Service)
-        WITH s1, s2,
-          sum(service.operations_per_year) as total_operations_per_year
-        // Create a connection relationship with the number of connections per year
-        MERGE (s1)-[conn:{type_of_connection}]->(s2)
-        SET conn.yearly = total_operations_per_year
-        """
+        if graph.has_trip_patterns():
+            # Each pattern stands for all of its trips, so we only need to look at the stops of each pattern once
+            print("Streaming stops of all trip patterns...")
+            _stop_times = schedule.load_stop_times(graph.stream_pattern_stop_times())
+            print(f"Loaded {len(_stop_times)} stops of {_stop_times['trip'].nunique()} trip patterns")
+        else:
+            print("Streaming stop times of all trips...")
+            _stop_times = schedule.load_stop_times(graph.stream_stop_times())
+            print(f"Loaded {len(_stop_times)} stop times of {_stop_times['trip'].nunique()} trips")
 
-        _modes_of_transport = [("BusTrip", "BUS_CONNECTS_TO"), ("TramTrip", "TRAM_CONNECTS_TO"), ("SubwayTrip", "SUBWAY_CONNECTS_TO")]
+        print("Aggregating consecutive stops into connections...")
+        _connections = schedule.aggregate_consecutive_connections(_stop_times)
+        print(f"Found {len(_connections)} connections between stops")
 
-        for trip, connection in _modes_of_transport:
-            print(f"Finding '{trip}' connections...")
-            # We need to do string interpolation here since Neo4j does not allow parameters in labels
-            _query = _operation.format(type_of_trip=trip, type_of_connection=connection)
-            _summary = graph.execute_operation(_query)
-            print(f"Created {_summary.counters.relationships_created} new '{connection}' relationships and set {_summary.counters.properties_set} yearly operations properties")
+        print("Writing connections to the graph...")
+        _summaries = graph.create_stop_connections(_connections)
+        for connection, _summary in _summaries.items():
+            if _summary:
+                print(f"Created {_summary.counters.relationships_created} new '{connection}' relationships and set {_summary.counters.properties_set} yearly operations properties")
 
         check_status_connections_added()
 
@@ -1372,33 +1621,59 @@ def _(mo):
     return (connections_map_tabs,)
 
 
+@app.cell
+def _(geo, graph, mo):
+    # Zooming into a district only queries the stops and connections around it
+    _district_centres = geo.district_centres(graph.get_subdistricts())
+    connections_map_focus = mo.ui.dropdown(
+        options={"All of Vienna": None} | {
+            f"District {_district}": _centre
+            for _district, _centre in sorted(_district_centres.items(), key=lambda item: int(item[0]))
+        },
+        value="All of Vienna",
+        label="Focus on:"
+    )
+
+    connections_map_focus
+    return (connections_map_focus,)
+
+
 @app.cell(hide_code=True)
 def _(
     connections_map_tabs,
     graph,
     map_legend_frequency,
     map_legend_mode_of_transport,
+    mo,
 ):
     # Behind the scenes: Query the respective data based on the user-selection
-    def connections_map_get_data():
-        active_tab = connections_map_tabs.value
+    def connections_map_get_data(active_tab=None, within=None):
+        active_tab = active_tab or connections_map_tabs.value
         connections = []
-        nodes = graph.get_stops(with_clusters=True, only_in_use=True)
-        legend_config = ("Legend", [("key", "val")])
+        nodes = graph.get_stops(with_clusters=True, only_in_use=True, within=within, as_table=True)
+        legend_config = connections_map_legend(active_tab)
+
+        # Every connection between two stops once, or only those with at least one stop within the bounding box
+        if within is None:
+            connection_pairs = """
+            MATCH (s1:Stop)-[conn:SUBWAY_CONNECTS_TO|BUS_CONNECTS_TO|TRAM_CONNECTS_TO]-(s2:Stop)
+            WHERE s1.id < s2.id"""
+        else:
+            connection_pairs = f"""
+            MATCH (s1:Stop) WHERE {graph.within_bbox("s1")}
+            MATCH (s1)-[conn:SUBWAY_CONNECTS_TO|BUS_CONNECTS_TO|TRAM_CONNECTS_TO]-(s2:Stop)
+            WHERE (s1.id < s2.id OR NOT {graph.within_bbox("s2")})"""
 
         if active_tab == "Connection Types":
-            connections_query = """
-            MATCH (s:Stop)-[c:BUS_CONNECTS_TO|TRAM_CONNECTS_TO|SUBWAY_CONNECTS_TO]-(t:Stop)
-            WHERE s.id < t.id AND c.yearly > 4 * 365
-            RETURN DISTINCT s as from, t as to, type(c) as label
+            connections_query = f"""
+            {connection_pairs} AND conn.yearly > 4 * 365
+            RETURN DISTINCT s1 as from, s2 as to, type(conn) as label
             """
-            connections = graph.get_connections(connections_query)
-            legend_config = map_legend_mode_of_transport
+            connections = graph.get_connections(connections_query, within=within, as_table=True)
 
         elif active_tab == "Connection Frequency":
-            connections_query = """
-            MATCH (s1:Stop)-[conn:SUBWAY_CONNECTS_TO|BUS_CONNECTS_TO|TRAM_CONNECTS_TO]-(s2:Stop)
-            WHERE s1.id < s2.id AND conn.yearly > 4 * 365
+            connections_query = f"""
+            {connection_pairs} AND conn.yearly > 4 * 365
             WITH conn, s1, s2,
               CASE 
                 WHEN conn.yearly > 105_000 THEN 'NONSTOP_TO'
@@ -1410,27 +1685,64 @@ def _(
               END as level_of_service
             RETURN DISTINCT s1 as from, level_of_service as label, s2 as to
             """
-            connections = graph.get_connections(connections_query)
-            legend_config = map_legend_frequency
+            connections = graph.get_connections(connections_query, within=within, as_table=True)
 
         return nodes, connections, legend_config
-    return (connections_map_get_data,)
+
+    def connections_map_legend(active_tab=None):
+        return {
+            "Connection Types": map_legend_mode_of_transport,
+            "Connection Frequency": map_legend_frequency,
+        }.get(active_tab or connections_map_tabs.value, ("Legend", [("key", "val")]))
+
+    def connections_map_tiles(active_tab=None):
+        # The URL and the directory of the tile pyramid of a tab, which is served from the public directory of the notebook
+        tile_url = f"public/map_tiles/{(active_tab or connections_map_tabs.value).lower().replace(' ', '_')}"
+        return tile_url, str(mo.notebook_dir() / tile_url)
+    return connections_map_get_data, connections_map_legend, connections_map_tiles
 
 
 @app.cell
 def _(
+    button_build_map_tiles,
+    connections_map_focus,
     connections_map_get_data,
+    connections_map_legend,
+    connections_map_tiles,
     get_connections_added,
     get_trip_frequency_added,
+    graph,
+    map_tiles,
     mo,
     present,
 ):
+    _ = button_build_map_tiles.value  # Show the tiles once they are built
+
     def display_connections_map():
-        transport_map = present.TransportMap(lat=48.2102331, lon=16.3796424, zoom=12,
-                                             visible_layers=present.VisibleLayers.STOPS | present.VisibleLayers.CONNECTIONS)
-        nodes, connections, legend_config = connections_map_get_data()
-        transport_map.add_transit_nodes(nodes)
-        transport_map.add_transit_connections(connections)
+        focus = connections_map_focus.value if graph.has_stop_locations() else None
+        if focus is not None:
+            # Only query the visible part of the district plus a margin around it, to which the map is restricted
+            transport_map = present.TransportMap(lat=focus[0], lon=focus[1], zoom=14, renderer="geojson",
+                                                 visible_layers=present.VisibleLayers.STOPS | present.VisibleLayers.CONNECTIONS,
+                                                 viewport_margin=0.5)
+        else:
+            transport_map = present.TransportMap(lat=48.2102331, lon=16.3796424, zoom=12, renderer="geojson",
+                                                 visible_layers=present.VisibleLayers.STOPS | present.VisibleLayers.CONNECTIONS)
+
+        tile_url, tile_directory = connections_map_tiles()
+        tile_index = map_tiles.read_tile_index(tile_directory)
+        if transport_map.viewport is not None:
+            nodes, connections, legend_config = connections_map_get_data(within=transport_map.viewport)
+            transport_map.add_transit_nodes(nodes)
+            transport_map.add_transit_connections(connections)
+        elif tile_index is not None:
+            # Only load the pre-aggregated tiles around the visible part of the map
+            transport_map.add_tile_pyramid(tile_url, tile_index)
+            legend_config = connections_map_legend()
+        else:
+            nodes, connections, legend_config = connections_map_get_data()
+            transport_map.add_transit_nodes(nodes)
+            transport_map.add_transit_connections(connections)
 
         transport_map.add_legend(legend_config[0], legend_config[1])
 
@@ -1455,6 +1767,47 @@ def _(get_connections_added, show_warning):
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    #### Pre-aggregated map tiles
+
+    By default, the map above embeds every stop and connection of the city into the page, no matter how far you zoom out. Instead, we can write a pyramid of **map tiles** for each view into the `public/` directory of this notebook, from where the map only loads the tiles around the visible area. On low zoom levels, nearby stops are aggregated into a single dot and the connections between them are merged into corridors. Only from zoom level 14 on, every stop and connection is shown individually.
+
+    Since the tiles are a snapshot of the graph, build them again whenever the connections change.
+    """
+    )
+    return
+
+
+@app.cell
+def _(present):
+    button_build_map_tiles = present.create_run_button(label="Build Map Tiles")
+    return (button_build_map_tiles,)
+
+
+@app.cell
+def _(
+    button_build_map_tiles,
+    connections_map_get_data,
+    connections_map_tiles,
+    map_tiles,
+    present,
+):
+    def _build_map_tiles():
+        for _tab in ["Connection Types", "Connection Frequency"]:
+            print(f"Querying the stops and connections for '{_tab}'...")
+            _nodes, _connections, _ = connections_map_get_data(_tab)
+
+            _, _tile_directory = connections_map_tiles(_tab)
+            _index = map_tiles.build_tile_pyramid(_tile_directory, _nodes, _connections)
+            print(f"Wrote {len(_index)} tiles for zoom levels {_index.min_zoom} to {_index.max_zoom} to {_tile_directory}")
+
+    present.run_code(button_build_map_tiles.value, _build_map_tiles)
+    return
+
+
 @app.cell(hide_code=True)
 def _(mo):
     mo.md(
@@ -1482,7 +1835,14 @@ def _(mo):
     // Routes serving stops
     MATCH (t:Trip)-[:OPERATING_ON]->(ser:Service)
     WITH t, sum(ser.operations_per_year) as operations
-    MATCH (r:Route)<-[:PART_OF_ROUTE]-(t)-[:STOPS_AT]->(s:Stop)
+    MATCH (r:Route)<-[:PART_OF_ROUTE]-(t)
+    CALL (t) {
+      MATCH (t)-[:STOPS_AT]->(s:Stop)
+      RETURN s
+      UNION
+      MATCH (t)-[:FOLLOWS_PATTERN]->(:TripPattern)-[:VISITS]->(s:Stop)
+      RETURN s
+    }
     WITH r.short_name as route_name, s, sum(operations) as trip_count
     WHERE trip_count >= 365
     RETURN route_name as head, 'SERVES' as rel, s.id as tail""",
@@ -1626,10 +1986,13 @@ def _(
 @app.cell
 def _(button_query_triples, graph, learning, present, triples_queries):
     def _query_triples():
-        fact_triples = graph.query_triples(triples_queries)
+        # Index the entities/relations of the triples as they arrive
+        _vocabulary = learning.TripleVocabulary()
+        graph.query_triples(triples_queries, triple_sink=_vocabulary.add)
+        print(f"Indexed {len(_vocabulary)} triples of {len(_vocabulary.entity_to_id)} entities and {len(_vocabulary.relation_to_id)} relations")
 
-        # Index the entities/relations in the triples and split them into training, validation and testing data 
-        return learning.generate_training_set(fact_triples)
+        # Split them into training, validation and testing data
+        return learning.generate_training_set(_vocabulary)
 
     _result = present.run_code(button_query_triples.value, _query_triples)
     if _result:
@@ -1994,14 +2357,14 @@ def _(
 
     def display_connection_predictions(connection_triples, connected_stops, map_legend_config, spinner):
         spinner.update("Requesting stop data from database...")
-        _stops_dict = {stop.id: stop for stop in graph.get_stops(id_list=list(connected_stops))}
+        _stops = graph.get_stops(id_list=list(connected_stops), as_table=True)
 
         spinner.update("Drawing predicted connections...")
-        connections = prediction.create_connections(connection_triples, _stops_dict)
+        connections = prediction.create_connection_table(connection_triples, _stops)
 
         _transport_map = present.TransportMap(lat=48.2102331, lon=16.3796424, zoom=12,
                                              visible_layers=present.VisibleLayers.STOPS | present.VisibleLayers.CONNECTIONS)
-        _transport_map.add_transit_nodes(_stops_dict.values())
+        _transport_map.add_transit_nodes(_stops)
         _transport_map.add_transit_connections(connections, uniform_thickness=3)
         _transport_map.add_legend(*map_legend_config)
 
@@ -2234,5 +2597,59 @@ def _(mo):
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(
+        r"""
+    ----
+
+    ## Appendix: Query Diagnostics
+
+    Every statement this notebook sends to Neo4j is parameterized, i.e., the Cypher text only depends on the _shape_ of a request and never on the concrete stop IDs or search terms. This allows Neo4j to reuse the execution plan of a query template instead of planning it from scratch on every call. The table below shows how often each template was sent to the database for the first time (misses) and how often it could reuse a cached plan (hits).
+
+    Additionally, the results of frequently repeated reads (stops, subdistricts, stop neighbourhoods) are kept in an in-process cache. Since this data only changes when one of the steps above writes to the graph, every write operation starts a new _graph epoch_ and clears the cache.
+
+    Maps are cached in the same way: every rendered map is stored under a hash of the stops, connections, layers and legend drawn on it, so switching back to a map view that shows the same data reuses the rendered page instead of drawing it again.
+
+    Lastly, every statement is timed to find out which steps dominate the evolution of the knowledge graph. If you enable the recording of execution plans, statements are run with Cypher's `PROFILE` prefix, which additionally reports the database hits and the execution plan of each statement (at the cost of slightly slower statements).
+    """
+    )
+    return
+
+
+@app.cell
+def _(graph, mo):
+    profile_plans_switch = mo.ui.switch(
+        value=graph.profiler.profile_plans,
+        label="Record execution plans and database hits (PROFILE)",
+        on_change=lambda _value: setattr(graph.profiler, "profile_plans", _value)
+    )
+    profile_plans_switch
+    return
+
+
+@app.cell
+def _(present):
+    button_refresh_query_diagnostics = present.create_run_button(label="Refresh Diagnostics")
+    return (button_refresh_query_diagnostics,)
+
+
+@app.cell
+def _(button_refresh_query_diagnostics, graph, mo, present):
+    _ = button_refresh_query_diagnostics.value  # Re-run this cell whenever the button is pressed
+
+    mo.vstack([
+        mo.md("**Slowest statements** of this session"),
+        mo.ui.table(graph.slowest_queries(15), selection=None, pagination=False),
+        mo.md("**Result cache**"),
+        mo.ui.table(graph.result_cache_statistics(), selection=None, pagination=False),
+        mo.md("**Rendered maps cache**"),
+        mo.ui.table(present.map_cache_statistics(), selection=None, pagination=False),
+        mo.md("**Query plan reuse** (per query template)"),
+        mo.ui.table(graph.plan_cache_statistics(), selection=None),
+    ])
+    return
+
+
 if __name__ == "__main__":
     app.run()